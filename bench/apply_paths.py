@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Apply Path Benchmark
+Measures latency, subprocesses and DB statements of the ruleset apply paths
+
+Runs entirely offline: every scenario gets a temporary SQLite database and
+NFTABLES_CONF, and bench/stubs/ (nft, conntrack, systemctl) is put first on
+PATH. The stubs keep a fake ruleset, hand out rule handles and log every
+invocation, so subprocess counts are exact even though nothing is applied.
+
+    python3 bench/apply_paths.py                        # 1/100/1000 custom rules, 10k/100k blacklist
+    python3 bench/apply_paths.py --rules 1 100 --blacklist 10000 --samples 3
+    python3 bench/apply_paths.py --linear --json linear.json
+
+Custom rule scenarios seed N rules, time restore_custom_rules() once, then
+time adding and removing one more rule, toggling a seeded rule and
+toggling a policy.
+Blacklist scenarios time one bulk import of N entries, then single adds and
+deletes against the full table. Compare runs with --json. DB statements
+are counted with sqlite3's trace callback, so an executemany() counts once.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'firewall'))
+import api  # noqa: E402
+
+STUB_DIR = os.path.join(BENCH_DIR, 'stubs')
+TEMPLATE = os.path.join(os.path.dirname(api.__file__), 'nftables.conf')
+
+class StatementCounter:
+    """Counts SQL statements on every pooled connection api.get_db() hands out"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._traced = set()
+        self._get_db = api.get_db
+        api.get_db = self.get_db
+
+    def get_db(self):
+        conn = self._get_db()
+        # Keep the connections themselves: a closed one's id() can be reused
+        if conn not in self._traced:
+            self._traced.add(conn)
+            conn.set_trace_callback(self._statement)
+        return conn
+
+    def _statement(self, sql):
+        with self._lock:
+            self.count += 1
+
+class Environment:
+    """A fresh database, nftables.conf and stub ruleset for one scenario"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.workdir = tempfile.mkdtemp(prefix='seer-bench-')
+        self.calls_log = os.path.join(self.workdir, 'calls.log')
+        os.environ['SEER_STUB_DIR'] = self.workdir
+        os.environ['SEER_STUB_CONF'] = os.path.join(self.workdir, 'nftables.conf')
+        api.DATABASE = os.path.join(self.workdir, 'seer.db')
+        api.NFTABLES_CONF = os.environ['SEER_STUB_CONF']
+        api.NFTABLES_TEMPLATE = TEMPLATE
+
+        with open(os.path.join(os.path.dirname(api.__file__), 'database.sql')) as f:
+            api.get_db().executescript(f.read())
+        api.migrate_database()
+        # Load the rendered config into the stub, as the device does on boot
+        api.generate_nftables_config()
+        api.reload_nftables()
+        open(self.calls_log, 'w').close()
+
+    def calls(self):
+        with open(self.calls_log) as f:
+            return [line.split()[0] for line in f if line.strip()]
+
+    def measure(self, name, size, operations):
+        """Run operations (callables) one after another; latency per operation"""
+        api.flush_audit_log()
+        calls_before = len(self.calls())
+        statements_before = self.counter.count
+        latencies = []
+        for operation in operations:
+            start = time.perf_counter()
+            operation()
+            latencies.append((time.perf_counter() - start) * 1000)
+        api.flush_audit_log()
+        calls = self.calls()[calls_before:]
+        count = len(operations)
+        return {
+            'scenario': name,
+            'size': size,
+            'operations': count,
+            'p50_ms': round(statistics.median(latencies), 3),
+            'max_ms': round(max(latencies), 3),
+            'total_ms': round(sum(latencies), 3),
+            'subprocesses_per_op': round(len(calls) / count, 2),
+            'subprocesses_by_binary': {binary: calls.count(binary) for binary in sorted(set(calls))},
+            'db_statements_per_op': round((self.counter.count - statements_before) / count, 2),
+        }
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def request(client, method, path, body=None):
+    """An API call that waits for its job; fails the run on an error response"""
+    response = client.open(path, method=method, json=body)
+    if response.status_code >= 400 or (response.json or {}).get('status') == 'failed':
+        raise RuntimeError(f'{method} {path}: {response.status_code} {response.get_data(as_text=True)}')
+    return response.json
+
+def custom_rule(index):
+    return {
+        'name': f'Bench {index}',
+        'port': 10000 + index,
+        'protocol': ('TCP', 'UDP', 'BOTH')[index % 3],
+        'accessLan': index % 2 == 0,
+        'accessTailnet': index % 2 == 1 or index % 3 == 0,
+        'accessWan': index % 5 == 0,
+        'action': ('ACCEPT', 'DROP')[index % 7 == 0],
+    }
+
+def seed_custom_rules(count):
+    with api.db_transaction() as conn:
+        conn.executemany('''
+            INSERT INTO custom_rules (name, port, protocol, access_lan, access_tailnet, access_wan, action)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (rule['name'], rule['port'], rule['protocol'], int(rule['accessLan']),
+             int(rule['accessTailnet']), int(rule['accessWan']), rule['action'])
+            for rule in map(custom_rule, range(count))
+        ])
+
+def custom_rule_scenarios(counter, client, size, samples):
+    env = Environment(counter)
+    try:
+        seed_custom_rules(size)
+        results = [env.measure('restore_custom_rules', size, [api.restore_custom_rules])]
+
+        added = []
+        def add(index):
+            added.append(request(client, 'POST', '/api/custom-rules?wait=1', custom_rule(index))['rule_id'])
+        results.append(env.measure('add_custom_rule', size, [
+            lambda index=index: add(index) for index in range(size, size + samples)
+        ]))
+        results.append(env.measure('remove_custom_rule', size, [
+            lambda rule_id=rule_id: request(client, 'DELETE', f'/api/custom-rules/{rule_id}?wait=1')
+            for rule_id in added
+        ]))
+        results.append(env.measure('toggle_custom_rule', size, [
+            lambda enabled=enabled: request(client, 'POST', '/api/custom-rules/1/toggle?wait=1', {'enabled': enabled})
+            for enabled in [index % 2 == 1 for index in range(samples)]
+        ]))
+        results.append(env.measure('toggle_rule', size, [
+            lambda value=value: request(client, 'POST', '/api/rules/15/toggle?wait=1',
+                                        {'field': 'rule_enabled', 'value': value})
+            for value in [index % 2 for index in range(samples)]
+        ]))
+        return results
+    finally:
+        env.close()
+
+def blacklist_scenarios(counter, client, size, samples):
+    env = Environment(counter)
+    try:
+        entries = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(size)]
+        results = [env.measure('blacklist_bulk_import', size, [
+            lambda: request(client, 'POST', '/api/blacklist/bulk?wait=1', {'ips': entries, 'reason': 'bench'})
+        ])]
+
+        added = [f'172.16.{i >> 8 & 255}.{i & 255}' for i in range(samples)]
+        results.append(env.measure('add_blacklist', size, [
+            lambda ip=ip: request(client, 'POST', '/api/blacklist?wait=1', {'ip_address': ip, 'reason': 'bench'})
+            for ip in added
+        ]))
+        ids = [row['id'] for row in api.get_db().execute(
+            f"SELECT id FROM firewall_blacklist WHERE ip_address IN ({', '.join('?' * len(added))})", added)]
+        results.append(env.measure('delete_blacklist', size, [
+            lambda ip_id=ip_id: request(client, 'DELETE', f'/api/blacklist/{ip_id}?wait=1') for ip_id in ids
+        ]))
+        return results
+    finally:
+        env.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, nargs='*', default=[1, 100, 1000], help='custom rule counts')
+    parser.add_argument('--blacklist', type=int, nargs='*', default=[10000, 100000], help='blacklist sizes')
+    parser.add_argument('--samples', type=int, default=5, help='timed single operations per scenario')
+    parser.add_argument('--linear', action='store_true', help='one nft rule per custom rule match, reload on toggle')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    os.environ['PATH'] = STUB_DIR + os.pathsep + os.environ['PATH']
+    api.NFT_BACKEND = 'subprocess'  # the stubs stand in for the nft binary
+    if args.linear:
+        api.NFT_COMPILED_RULES = False
+        api.NFT_LIVE_TOGGLE = False
+    counter = StatementCounter()
+    client = api.app.test_client()
+
+    results = []
+    # The API logs every step to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        api.start_apply_worker()
+        for size in args.rules:
+            results += custom_rule_scenarios(counter, client, size, args.samples)
+        for size in args.blacklist:
+            results += blacklist_scenarios(counter, client, size, args.samples)
+
+    mode = 'linear' if args.linear else 'compiled'
+    print(f"Mode: {mode}  samples: {args.samples}")
+    print(f"{'scenario':<24}{'size':>8}{'p50 ms':>10}{'max ms':>10}{'procs/op':>10}{'stmts/op':>10}")
+    for result in results:
+        print(f"{result['scenario']:<24}{result['size']:>8}{result['p50_ms']:>10}{result['max_ms']:>10}"
+              f"{result['subprocesses_per_op']:>10}{result['db_statements_per_op']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'mode': mode, 'samples': args.samples, 'scenarios': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
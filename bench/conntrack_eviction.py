@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Conntrack Eviction Check
+Checks which recorded flows a policy, custom rule or blacklist change evicts
+
+Runs entirely offline against bench/fixtures/conntrack-L.txt, a recorded
+'conntrack -L' listing (plain and extended lines, including an offloaded
+flow). Each case in bench/fixtures/conntrack_eviction.json names a change and
+the listing lines (1-based) whose flows must be deleted; any flow evicted that
+should survive, or kept that should go, is reported and the script exits 1.
+
+Each change is checked twice: the listing matcher (evictable_flows) and the
+real eviction path, run against a fake conntrack that replays the listing.
+The eviction path must delete the same flows, report their number and spawn
+exactly one conntrack process however many tuples the change expands to.
+
+    python3 bench/conntrack_eviction.py
+    python3 bench/conntrack_eviction.py --template firewall/nftables.conf
+"""
+
+import argparse
+import ipaddress
+import json
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'firewall'))
+import api  # noqa: E402
+
+def case_tuples(case):
+    """Tuples whose flows the change in a case would evict"""
+    if 'policy' in case:
+        return api.policy_conntrack_tuples(case['policy'], case.get('field', 'rule_enabled'))
+    return api.custom_rule_conntrack_tuples(case['custom_rule'])
+
+class FakeConntrack:
+    """run_command() stand-in: 'conntrack -D' / 'conntrack -R -' against a recorded listing"""
+
+    def __init__(self, listing):
+        self.table = listing.splitlines()
+        self.processes = 0
+        self.deleted = []
+
+    def delete(self, options):
+        """Apply one '-D -f <family> [-p proto] [--dport N] [-s|-d net]' and return the count"""
+        values = dict(zip(options[1::2], options[2::2]))
+        entry = (values['-f'], values.get('-p'), values.get('--dport'), values.get('-s'))
+        dst = ipaddress.ip_network(values['-d'], strict=False) if '-d' in values else None
+        kept = []
+        count = 0
+        for line in self.table:
+            flow = api.parse_conntrack_line(line)
+            if flow and api.conntrack_flow_matches(flow, entry) and (
+                    dst is None or ('dst' in flow and ipaddress.ip_address(flow['dst']) in dst)):
+                self.deleted.append(line)
+                count += 1
+            else:
+                kept.append(line)
+        self.table = kept
+        return count
+
+    def __call__(self, args, input=None, **kwargs):
+        self.processes += 1
+        if args[1] == '-R':
+            commands = [line.split() for line in input.splitlines() if line.strip()]
+        else:
+            commands = [args[1:]]
+        count = sum(self.delete(command) for command in commands)
+        # conntrack prints one total for the whole run
+        stderr = f'conntrack v1.4.7 (conntrack-tools): {count} flow entries have been deleted.\n'
+        return subprocess.CompletedProcess(args, 0 if count else 1, '', stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listing', default=os.path.join(BENCH_DIR, 'fixtures', 'conntrack-L.txt'))
+    parser.add_argument('--cases', default=os.path.join(BENCH_DIR, 'fixtures', 'conntrack_eviction.json'))
+    parser.add_argument('--template', default=os.path.join(BENCH_DIR, '..', 'firewall', 'nftables.conf'))
+    args = parser.parse_args()
+
+    api.NFTABLES_TEMPLATE = args.template
+    with open(args.listing, 'r') as f:
+        listing = f.read()
+    with open(args.cases, 'r') as f:
+        cases = json.load(f)['cases']
+    numbers = {line: number for number, line in enumerate(listing.splitlines(), 1)}
+
+    failures = 0
+    for case in cases:
+        if 'blacklist' in case:
+            evicted = api.evictable_address_flows(listing, ipaddress.ip_network(case['blacklist'], strict=False))
+        else:
+            evicted = api.evictable_flows(listing, case_tuples(case))
+        got = sorted(numbers[line] for line in evicted)
+        
+        conntrack = FakeConntrack(listing)
+        api.run_command = conntrack
+        if 'blacklist' in case:
+            removed = api.evict_address_flows(ipaddress.ip_network(case['blacklist'], strict=False))
+        else:
+            removed = api.evict_connections(case_tuples(case))
+        deleted = sorted(numbers[line] for line in conntrack.deleted)
+        
+        expected = sorted(case['evicted'])
+        problems = []
+        if got != expected:
+            problems.append(f'matcher got lines {got}')
+        if deleted != expected or removed != len(expected):
+            problems.append(f'eviction deleted lines {deleted}, reported {removed}')
+        if conntrack.processes != 1:
+            problems.append(f'{conntrack.processes} conntrack processes')
+        if not problems:
+            print(f"✓ {case['name']}: evicts lines {got} with 1 conntrack process")
+            continue
+        failures += 1
+        print(f"✗ {case['name']}: expected lines {expected}; " + '; '.join(problems))
+
+    print(f'{len(cases) - failures}/{len(cases)} eviction cases match')
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
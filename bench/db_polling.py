@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Dashboard Polling Benchmark
+Measures GET latency while several dashboards poll and a writer commits
+
+Runs entirely offline against a temporary SQLite database:
+
+    python3 bench/db_polling.py                 # pooled WAL connections
+    python3 bench/db_polling.py --legacy        # connection-per-call, default journal
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firewall'))
+import api  # noqa: E402
+
+ENDPOINTS = ['/api/rules', '/api/custom-rules', '/api/status']
+
+def seed_database(path, custom_rules, blacklist):
+    """Create the schema plus some custom rules and blacklist rows"""
+    conn = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(api.__file__), 'database.sql')) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        'INSERT INTO custom_rules (name, port, protocol, access_lan) VALUES (?, ?, ?, 1)',
+        [(f'Rule {i}', 10000 + i, 'TCP') for i in range(custom_rules)]
+    )
+    conn.executemany(
+        'INSERT INTO firewall_blacklist (ip_address, reason) VALUES (?, ?)',
+        [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 'bench') for i in range(blacklist)]
+    )
+    conn.commit()
+    conn.close()
+
+def use_legacy_connections():
+    """Swap in the old behaviour: a fresh connection for every call"""
+    def get_db():
+        conn = sqlite3.connect(api.DATABASE)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def db_transaction():
+        conn = get_db()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    api.get_db = get_db
+    api.db_transaction = db_transaction
+
+def poller(endpoints, count, latencies, errors):
+    client = api.app.test_client()
+    for i in range(count):
+        endpoint = endpoints[i % len(endpoints)]
+        start = time.perf_counter()
+        response = client.get(endpoint)
+        latencies.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            errors.append(endpoint)
+
+def writer(stop, interval, writes):
+    while not stop.is_set():
+        with api.db_transaction() as conn:
+            conn.execute(
+                'UPDATE custom_rules SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                (writes[0] % 50 + 1,)
+            )
+        writes[0] += 1
+        time.sleep(interval)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent dashboards')
+    parser.add_argument('--requests', type=int, default=300, help='requests per dashboard')
+    parser.add_argument('--write-interval', type=float, default=0.005, help='seconds between writes')
+    parser.add_argument('--custom-rules', type=int, default=200)
+    parser.add_argument('--blacklist', type=int, default=2000)
+    parser.add_argument('--legacy', action='store_true', help='connection per call, default journal mode')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='seer-bench-')
+    api.DATABASE = os.path.join(workdir, 'seer.db')
+    seed_database(api.DATABASE, args.custom_rules, args.blacklist)
+    if args.legacy:
+        use_legacy_connections()
+
+    latencies = {}
+    errors = []
+    writes = [0]
+    stop = threading.Event()
+    write_thread = threading.Thread(target=writer, args=(stop, args.write_interval, writes))
+    write_thread.start()
+
+    # Each dashboard keeps its own latency dict; merge afterwards
+    per_thread = [{} for _ in range(args.threads)]
+    threads = [threading.Thread(target=poller, args=(ENDPOINTS, args.requests, per_thread[i], errors))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    write_thread.join()
+
+    for result in per_thread:
+        for endpoint, values in result.items():
+            latencies.setdefault(endpoint, []).extend(values)
+
+    mode = 'legacy' if args.legacy else 'pooled-wal'
+    results = {
+        'mode': mode,
+        'threads': args.threads,
+        'requests': args.threads * args.requests,
+        'writes': writes[0],
+        'errors': len(errors),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(args.threads * args.requests / elapsed, 1),
+        'endpoints': {
+            endpoint: {
+                'p50_ms': round(statistics.median(values), 3),
+                'p95_ms': round(percentile(values, 95), 3),
+                'p99_ms': round(percentile(values, 99), 3),
+                'max_ms': round(max(values), 3),
+            }
+            for endpoint, values in sorted(latencies.items())
+        },
+    }
+
+    print(f"Mode: {mode}  dashboards: {args.threads}  requests: {results['requests']}  "
+          f"writes: {writes[0]}  errors: {len(errors)}  throughput: {results['throughput_rps']} req/s")
+    print(f"{'endpoint':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint, stats in results['endpoints'].items():
+        print(f"{endpoint:<22}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
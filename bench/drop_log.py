@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Drop Log Ingestion Benchmark
+Measures how many [NFT DROP] kernel log lines per second one core can ingest
+
+Generates a synthetic WAN scan as a log file and replays it offline:
+
+    python3 bench/drop_log.py                   # 200k lines, 5000 sources
+    python3 bench/drop_log.py --sources 100000  # botnet-sized source spread
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firewall'))
+import api  # noqa: E402
+
+LINE = ('Oct 17 06:00:00 seer kernel: [NFT DROP] IN=eth1 OUT= '
+        'MAC=52:54:00:12:34:56:52:54:00:65:43:21:08:00 SRC={src} DST=203.0.113.1 LEN=60 '
+        'TOS=0x00 PREC=0x00 TTL=51 ID=54321 DF PROTO={proto} SPT={spt} DPT={dpt} '
+        'WINDOW=64240 RES=0x00 SYN URGP=0\n')
+
+def write_fixture(path, lines, sources, seed):
+    rng = random.Random(seed)
+    pool = [f'198.{rng.randrange(18, 20)}.{rng.randrange(256)}.{rng.randrange(1, 255)}' for _ in range(sources)]
+    with open(path, 'w') as f:
+        for _ in range(lines):
+            f.write(LINE.format(
+                src=rng.choice(pool),
+                proto=rng.choice(('TCP', 'TCP', 'TCP', 'UDP')),
+                spt=rng.randrange(1024, 65536),
+                dpt=rng.choice((22, 23, 80, 443, 3389, 8080, rng.randrange(1, 65536))),
+            ))
+            # A little non-drop noise, as in the real kernel log
+            if rng.random() < 0.05:
+                f.write('Oct 17 06:00:00 seer kernel: br0: port 1(eth0) entered forwarding state\n')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200000, help='drop lines to replay')
+    parser.add_argument('--sources', type=int, default=5000, help='distinct source addresses')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='seer-bench-'), 'kern.log')
+    write_fixture(path, args.lines, args.sources, args.seed)
+
+    start = time.perf_counter()
+    parsed = sum(1 for line in api.follow_drop_log(path, follow=False) if api.parse_drop_line(line))
+    parse_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for line in api.follow_drop_log(path, follow=False):
+        api.ingest_drop_line(line)
+    ingest_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    summary = api.drop_summary()
+    summary_ms = (time.perf_counter() - start) * 1000
+
+    results = {
+        'lines': parsed,
+        'sources': args.sources,
+        'parse_lines_per_s': round(parsed / parse_elapsed),
+        'ingest_lines_per_s': round(parsed / ingest_elapsed),
+        'summary_ms': round(summary_ms, 3),
+        'top_sources': summary['top_sources'][:3],
+    }
+
+    print(f"Lines: {parsed}  sources: {args.sources}")
+    print(f"parse only: {results['parse_lines_per_s']} lines/s  "
+          f"parse + aggregate: {results['ingest_lines_per_s']} lines/s  "
+          f"summary: {results['summary_ms']} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Golden nftables.conf Check
+Renders the template for fixed policy, custom rule and schedule states and
+diffs the output against the expected files in bench/fixtures/golden/
+
+Runs entirely offline. Each state in states.json starts from the
+database.sql defaults; <state>.conf is the expected nftables.conf and, for
+states with custom rules, <state>.rules.nft the expected custom rule script
+(map elements plus linear rules). The system zone is pinned to UTC so
+schedule windows render the same everywhere. Exits 1 on any difference.
+
+    python3 bench/render_golden.py
+    python3 bench/render_golden.py --update     # rewrite the expected files
+"""
+
+import argparse
+import difflib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIREWALL_DIR = os.path.join(BENCH_DIR, '..', 'firewall')
+GOLDEN_DIR = os.path.join(BENCH_DIR, 'fixtures', 'golden')
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+sys.path.insert(0, FIREWALL_DIR)
+import api  # noqa: E402
+
+def default_rows():
+    """policy_rules and autoban_policies rows seeded by database.sql"""
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    with open(os.path.join(FIREWALL_DIR, 'database.sql'), 'r') as f:
+        conn.executescript(f.read())
+    rules = [dict(row) for row in conn.execute('SELECT * FROM policy_rules ORDER BY id').fetchall()]
+    autoban = [dict(row) for row in conn.execute('SELECT * FROM autoban_policies ORDER BY name').fetchall()]
+    conn.close()
+    return rules, autoban
+
+def custom_rule_row(rule):
+    row = {'access_lan': 0, 'access_tailnet': 0, 'access_wan': 0, 'source_group_id': None,
+           'schedule': 'Always', 'enabled': 1}
+    row.update(rule)
+    return row
+
+def custom_rule_script(rules, compiled):
+    """Custom rule nft lines an apply from empty maps would run"""
+    if not compiled:
+        return api.compile_custom_rules(rules)
+    wanted = {name: {key: verdict for key, (verdict, _) in entries.items()}
+              for name, entries in api.compile_custom_rule_elements(rules).items()}
+    lines = api.custom_rule_element_script({}, wanted)
+    return ''.join(line + '\n' for line in lines) + api.compile_custom_rules(
+        [rule for rule in rules if api.rule_schedule(rule)])
+
+def render_state(model, state):
+    """{file name suffix: text} for one state"""
+    rules, autoban = default_rows()
+    for rule in rules:
+        rule.update(state.get('policies', {}).get(str(rule['id']), {}))
+    for policy in autoban:
+        policy.update(state.get('autoban', {}).get(policy['name'], {}))
+    compiled = state.get('compiled', False)
+    rendered = {'.conf': api.render_nftables_config(
+        model, rules, live=state.get('live', False), autoban=autoban, flowtable=state.get('flowtable'),
+        compiled=compiled, groups=state.get('groups', ()))}
+    if 'custom_rules' in state:
+        rows = [custom_rule_row(rule) for rule in state['custom_rules']]
+        rendered['.rules.nft'] = custom_rule_script(rows, compiled)
+    return rendered
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--template', default=os.path.join(FIREWALL_DIR, 'nftables.conf'))
+    parser.add_argument('--update', action='store_true', help='write the rendered output as the expected files')
+    args = parser.parse_args()
+
+    api.NFTABLES_TEMPLATE = args.template
+    model = api.load_nftables_template()
+    with open(os.path.join(GOLDEN_DIR, 'states.json'), 'r') as f:
+        states = json.load(f)['states']
+
+    checked = failures = 0
+    for name, state in states.items():
+        for suffix, text in render_state(model, state).items():
+            path = os.path.join(GOLDEN_DIR, name + suffix)
+            checked += 1
+            if args.update:
+                with open(path, 'w') as f:
+                    f.write(text)
+                print(f'Wrote {os.path.relpath(path)}')
+                continue
+            try:
+                with open(path, 'r') as f:
+                    expected = f.read()
+            except FileNotFoundError:
+                expected = ''
+            if text == expected:
+                print(f'✓ {name}{suffix}')
+                continue
+            failures += 1
+            print(f'✗ {name}{suffix} differs from {os.path.relpath(path)}:')
+            sys.stdout.writelines(difflib.unified_diff(
+                expected.splitlines(True), text.splitlines(True), 'expected', 'rendered'))
+
+    if not args.update:
+        print(f'{checked - failures}/{checked} golden files match')
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+SEER Firewall API - Custom Rule Verdict Map Benchmark
+Checks that compiled verdict maps give the same verdict as the linear rules
+
+Runs entirely offline. Random custom rule sets (with deliberately colliding
+ports, port ranges and port lists) are compiled both ways and every generated packet is evaluated
+against each form; rules are then removed one at a time and the map state
+reached through element adds/deletes is compared to a fresh compile.
+
+    python3 bench/verdict_map.py                    # 200 rule sets
+    python3 bench/verdict_map.py --rules 500 --sets 20
+"""
+
+import argparse
+import ipaddress
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firewall'))
+import api  # noqa: E402
+
+LINEAR_RULE = re.compile(
+    r'^add rule inet filter (?P<chain>\S+) (?:(?P<iftype>[io]ifname) "(?P<iface>[^"]+)" )?'
+    r'(?P<proto>tcp|udp) dport (?P<port>\d+|\{[^}]*\})(?: ip saddr (?P<source>\S+))? counter (?P<verdict>\S+) comment'
+)
+INTERFACES = [api.LAN_IFACE, api.WAN_IFACE, 'tailscale0', 'wlan0']
+SOURCES = ['192.168.50.20', '100.100.7.1', '100.64.0.9', '203.0.113.5', '2001:db8::5']
+
+def random_port(rng, ports):
+    """A single port, a range or a list drawn from ports"""
+    shape = rng.random()
+    if shape < 0.6:
+        return rng.choice(ports)
+    if shape < 0.8:
+        low = rng.randrange(len(ports) - 1)
+        return f'{ports[low]}-{ports[rng.randrange(low + 1, len(ports))]}'
+    return ','.join(str(port) for port in rng.sample(ports, rng.randint(2, 4)))
+
+def random_rules(rng, count, ports):
+    rules = []
+    for rule_id in range(1, count + 1):
+        access = [rng.random() < 0.5 for _ in range(3)]
+        if not any(access):
+            access[rng.randrange(3)] = True
+        rules.append({
+            'id': rule_id,
+            'port': random_port(rng, ports),
+            'protocol': rng.choice(['TCP', 'UDP', 'BOTH']),
+            'action': rng.choice(['ACCEPT', 'DROP', 'REJECT']),
+            'access_lan': int(access[0]),
+            'access_tailnet': int(access[1]),
+            'access_wan': int(access[2]),
+        })
+    return rules
+
+def linear_rules(rules):
+    """Linear form: compile_custom_rule() lines in id order, parsed back into matches"""
+    parsed = []
+    for rule in sorted(rules, key=lambda rule: rule['id']):
+        for line in api.compile_custom_rule(rule['id'], rule):
+            match = LINEAR_RULE.match(line)
+            if not match:
+                raise ValueError(f'Unexpected linear rule: {line}')
+            parsed.append(match.groupdict())
+    return parsed
+
+def linear_verdict(parsed, packet):
+    """First matching rule's verdict, and how many rules were evaluated"""
+    for evaluated, rule in enumerate(parsed, 1):
+        if rule['chain'] != packet['chain'] or rule['proto'] != packet['proto']:
+            continue
+        if not any(low <= packet['port'] <= high for low, high in api.parse_port_spec(rule['port'].strip('{} '))):
+            continue
+        if rule['iface'] and rule['iface'] != packet['iface']:
+            continue
+        if rule['source']:
+            address = ipaddress.ip_address(packet['source'])
+            if address.version != 4 or address not in ipaddress.ip_network(rule['source']):
+                continue
+        return rule['verdict'], evaluated
+    return None, len(parsed)
+
+def compiled_verdict(elements, packet):
+    """Verdict from the verdict map lookups at the chain's anchor, and the lookup count"""
+    lookups = 0
+    address = ipaddress.ip_address(packet['source'])
+    for name, (chain, key) in api.CUSTOM_RULE_MAPS.items():
+        if chain != packet['chain']:
+            continue
+        if 'ip saddr' in key and address.version != 4:
+            continue  # 'ip saddr' implies meta nfproto ipv4
+        lookups += 1
+        for text, (verdict, _) in elements[name].items():
+            fields = text.split(' . ')
+            if 'ip saddr' in key:
+                if address not in ipaddress.ip_network(fields.pop()):
+                    continue
+            low, _, high = fields.pop().partition('-')
+            if not int(low) <= packet['port'] <= int(high or low):
+                continue
+            wanted = [f'"{packet["iface"]}"'] if 'ifname' in key else []
+            wanted += [packet['proto']]
+            if fields == wanted:
+                return ('reject' if verdict == f'jump {api.CUSTOM_REJECT_CHAIN}' else verdict), lookups
+    return None, lookups
+
+def packets(ports):
+    for chain in ('input', 'forward', 'output'):
+        for iface in INTERFACES:
+            for proto in ('tcp', 'udp'):
+                for port in ports:
+                    for source in SOURCES:
+                        yield {'chain': chain, 'iface': iface, 'proto': proto, 'port': port, 'source': source}
+
+def state_of(elements):
+    return {name: {key: verdict for key, (verdict, _) in entries.items()} for name, entries in elements.items()}
+
+def apply_script(state, lines):
+    """Apply 'add/delete element' lines to a {map: {key: verdict}} state"""
+    for line in lines:
+        op, _, _, _, name, body = line.split(' ', 5)
+        for item in body.strip('{} ').split(', '):
+            key, _, verdict = item.partition(' : ')
+            if op == 'delete':
+                del state[name][key]
+            else:
+                state[name][key] = verdict
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sets', type=int, default=200, help='random rule sets to check')
+    parser.add_argument('--rules', type=int, default=40, help='custom rules per set')
+    parser.add_argument('--ports', type=int, default=8, help='distinct ports (fewer = more collisions)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ports = [8000 + i for i in range(args.ports)]
+    checked = mismatches = 0
+    linear_evaluated = compiled_lookups = 0
+    element_updates = linear_updates = 0
+    compile_seconds = 0.0
+
+    for _ in range(args.sets):
+        rules = random_rules(rng, args.rules, ports)
+        start = time.perf_counter()
+        elements = api.compile_custom_rule_elements(rules)
+        compile_seconds += time.perf_counter() - start
+        parsed = linear_rules(rules)
+
+        for packet in packets(ports):
+            linear, evaluated = linear_verdict(parsed, packet)
+            compiled, lookups = compiled_verdict(elements, packet)
+            checked += 1
+            linear_evaluated += evaluated
+            compiled_lookups += lookups
+            if linear != compiled:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f'✗ {packet}: linear={linear} compiled={compiled}')
+
+        # Remove rules in random order; element diffs must reach the fresh compile
+        state = state_of(elements)
+        remaining = list(rules)
+        rng.shuffle(remaining)
+        while remaining:
+            removed = remaining.pop()
+            wanted = state_of(api.compile_custom_rule_elements(remaining))
+            lines = api.custom_rule_element_script(state, wanted)
+            apply_script(state, lines)
+            element_updates += sum(len(line.split(', ')) for line in lines)
+            linear_updates += len(api.compile_custom_rule(removed['id'], removed))
+            if state != wanted:
+                mismatches += 1
+                print(f'✗ element diff after removing rule {removed["id"]} diverged from a fresh compile')
+
+    results = {
+        'sets': args.sets,
+        'rules_per_set': args.rules,
+        'packets_checked': checked,
+        'mismatches': mismatches,
+        'linear_rules_evaluated_per_packet': round(linear_evaluated / checked, 2),
+        'compiled_lookups_per_packet': round(compiled_lookups / checked, 2),
+        'element_updates_per_removal': round(element_updates / (args.sets * args.rules), 2),
+        'linear_rules_per_removal': round(linear_updates / (args.sets * args.rules), 2),
+        'compile_ms_per_set': round(compile_seconds / args.sets * 1000, 3),
+    }
+
+    print(f"Checked {checked} packets against {args.sets} rule sets of {args.rules} rules: "
+          f"{mismatches} mismatches")
+    print(f"Per packet: {results['linear_rules_evaluated_per_packet']} linear rules evaluated vs "
+          f"{results['compiled_lookups_per_packet']} map lookups")
+    print(f"Per removal: {results['element_updates_per_removal']} element updates vs "
+          f"{results['linear_rules_per_removal']} linear rule deletes; "
+          f"compile {results['compile_ms_per_set']} ms per set")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
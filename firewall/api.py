@@ -4,238 +4,1572 @@ SEER Firewall API Backend
 Handles database operations and nftables rule management
 """
 
+import atexit
+import ctypes
+import ctypes.util
+import bisect
+import functools
+import hashlib
+import heapq
+import ipaddress
+import logging
+import os
+import queue
+import re
 import sqlite3
 import subprocess
+import sys
 import json
-from datetime import datetime
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from itertools import groupby, islice
+from datetime import datetime, timedelta, timezone
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python < 3.9 - schedules use the system time zone only
+    ZoneInfo = None
+
 app = Flask(__name__)
 CORS(app)
 
 DATABASE = '/home/admin/.node-red/seer_database/seer.db'
 NFTABLES_CONF = '/etc/nftables.conf'
+NFTABLES_TEMPLATE = '/etc/nftables.conf.template'
+
+# SQLite connection settings (one pooled connection per worker thread)
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHED_STATEMENTS = 256
+
+# Bulk blacklist import limits
+BLACKLIST_BULK_MAX = 100000
+BLACKLIST_CHUNK_SIZE = 1000
+
+# Expired blacklist rows are deleted in batches by a background reaper
+BLACKLIST_REAP_INTERVAL = 60
+BLACKLIST_REAP_BATCH = 500
+SQLITE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Toggle policies by updating verdict map elements instead of reloading nftables
+NFT_LIVE_TOGGLE = True
+# Custom rules as concatenated-set verdict map elements instead of one rule per match
+NFT_COMPILED_RULES = True
+# Run nft commands in process through libnftables ('auto' falls back to the nft binary) or 'subprocess'
+NFT_BACKEND = 'auto'
+TEMPLATE_INDENT = ' ' * 8
+
+# Ruleset changes are applied by one writer thread; finished jobs kept for polling
+APPLY_COALESCE_DELAY = 0.05
+JOB_HISTORY = 500
+JOB_WAIT_TIMEOUT = 30
+
+# Cached blacklist responses with expiring entries are rebuilt this often (seconds)
+BLACKLIST_EXPIRY_RESOLUTION = 5
+
+# Rule hit counters are sampled from the live ruleset this often (seconds)
+METRICS_INTERVAL = 10
+
+# Drop log ingestion: 'journal', 'kmsg' or a file path; windowed top-N aggregates
+DROP_LOG_SOURCE = 'journal'
+DROP_LOG_BUFFER = 5000
+DROP_WINDOW = 300
+DROP_BUCKET_SECONDS = 10
+DROP_TOP_CAPACITY = 1000
+DROP_STREAM_MAX_CLIENTS = 4
+DROP_STREAM_BACKLOG = 1000
+DROP_STREAM_HEARTBEAT = 15
+
+# Auto-ban: kernel ban sets are copied into firewall_blacklist this often (seconds)
+AUTOBAN_SYNC_INTERVAL = 60
+AUTOBAN_SET_SIZE = 65536
+AUTOBAN_MAX_THRESHOLD = 100000
+AUTOBAN_MAX_WINDOW = 86400
+AUTOBAN_MAX_BAN = 30 * 86400
+
+# Audit entries are written in batches; older rows are rolled into daily counts
+AUDIT_BATCH_SIZE = 100
+AUDIT_FLUSH_INTERVAL = 1
+AUDIT_PAGE_MAX = 1000
+AUDIT_RETENTION_DAYS = 90
+AUDIT_ROLLUP_INTERVAL = 3600
+AUDIT_ROLLUP_BATCH = 5000
+
+# Schedules are enforced by the kernel; time zone offsets (DST) are rechecked this often
+SCHEDULE_CHECK_INTERVAL = 3600
+
+# Custom rule ports: entries in a port list, and the widest range evicted port by port
+CUSTOM_RULE_MAX_PORTS = 32
+CONNTRACK_MAX_PORTS = 64
+
+# Address groups: members per group (nft interval sets, so size does not cost lookups)
+ADDRESS_GROUP_MAX_MEMBERS = 100000
+
+# Flowtable fast path (policy 18): offloaded flows are counted from the conntrack table
+FLOWTABLE_NAME = 'fastpath'
+FLOWTABLE_POLICY_ID = 18
+FLOWTABLE_MAX_DEVICES = 8
+CONNTRACK_PROC = '/proc/net/nf_conntrack'
+
+# JSON log lines on stdout; tracing keeps per-span histograms and recent slow traces
+LOG_LEVEL = 'INFO'
+TRACING_ENABLED = True
+TRACE_SLOW_MS = 500
+TRACE_RECENT = 50
+TRACE_MAX_SPANS = 200
+TRACE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Ruleset snapshots kept for rollback, and the dead-man timer's range (seconds)
+SNAPSHOT_KEEP = 50
+SNAPSHOT_MIN_CONFIRM = 10
+SNAPSHOT_MAX_CONFIRM = 3600
+
+# Production WSGI server (waitress) worker threads
+WSGI_THREADS = 8
+
+LAN_IFACE = 'br0'
+WAN_IFACE = 'eth1'
+TAILNET_NET = '100.64.0.0/10'
+
+_db_local = threading.local()
 
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    """Get this thread's pooled database connection
+    
+    Connections are opened once per worker thread in WAL mode, so dashboard
+    readers never block on a writer. Don't close it; use db_transaction()
+    for writes.
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.path != DATABASE:
+        conn = sqlite3.connect(
+            DATABASE,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_CACHED_STATEMENTS,
+            factory=TracedConnection
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _db_local.path = DATABASE
+        _db_local.depth = 0
     return conn
 
-def execute_nft_command(command):
-    """Execute nftables command"""
+@contextmanager
+def db_transaction():
+    """Run a block in one transaction on the pooled connection
+    
+    Commits on success and rolls back on any exception. Nested blocks join
+    the outermost transaction instead of committing early.
+    """
+    conn = get_db()
+    depth = _db_local.depth
+    _db_local.depth = depth + 1
     try:
-        result = subprocess.run(
-            ['nft'] + command.split(),
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return {'success': True, 'output': result.stdout}
-    except subprocess.CalledProcessError as e:
-        return {'success': False, 'error': e.stderr}
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _db_local.depth = depth
+
+# Columns added after the first release, for databases created by older schemas
+SCHEMA_COLUMNS = {
+    'firewall_blacklist': [('expires_at', 'DATETIME')],
+    'custom_rules': [('source_group_id', 'INTEGER'), ('schedule', "TEXT DEFAULT 'Always'")],
+}
+
+SCHEMA_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_firewall_blacklist_expires ON firewall_blacklist(expires_at)',
+    'CREATE INDEX IF NOT EXISTS idx_custom_rules_source_group ON custom_rules(source_group_id)',
+]
+
+def migrate_database():
+    """Add columns and indexes that database.sql cannot add to existing tables"""
+    with db_transaction() as conn:
+        for table, columns in SCHEMA_COLUMNS.items():
+            existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()}
+            for column, definition in columns:
+                if existing and column not in existing:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                    logger.info(f"Added column {table}.{column}")
+        for statement in SCHEMA_INDEXES:
+            conn.execute(statement)
 
 def reload_nftables():
     """Reload nftables configuration"""
     try:
         # Use 'nft -f' with flush table to reload cleanly
         # This flushes and reloads the specific table, not the entire ruleset
-        subprocess.run(['systemctl', 'reload', 'nftables'], check=True)
+        run_command(['systemctl', 'reload', 'nftables'], check=True)
+        forget_rule_handles()
+        forget_custom_rule_elements()
         return True
     except subprocess.CalledProcessError as e:
-        print(f"Error reloading nftables: {e}")
+        logger.error(f"Error reloading nftables: {e}")
         # Fallback to direct reload
-        try:
-            subprocess.run(['nft', '-f', NFTABLES_CONF], check=True)
-            return True
-        except:
+        if not nft_executor().run_file(NFTABLES_CONF)['success']:
             return False
+        forget_rule_handles()
+        forget_custom_rule_elements()
+        return True
 
-def generate_nftables_config():
-    """Generate nftables.conf from database by commenting out disabled rules and adding DROP rules"""
-    conn = get_db()
-    rules = conn.execute('SELECT * FROM policy_rules ORDER BY id').fetchall()
-    conn.close()
-    
-    # Create a mapping of rule policies to their enabled status and track disabled services
-    rule_status = {}
-    disabled_tcp_ports = []
-    disabled_icmp = False
-    nat_enabled = True  # Track NAT/masquerade status
+# ==================== LOGGING AND TRACING ====================
+#
+# Log records are written as one JSON object per line on stdout (journald
+# keeps them). Spans time requests, apply batches, SQL statements, config
+# rewrites and subprocesses into per-name histograms; a request or apply
+# batch slower than TRACE_SLOW_MS is kept with its child spans for
+# GET /api/debug/timings. With TRACING_ENABLED off, span() hands back a
+# shared no-op and the wrappers call straight through.
+
+logger = logging.getLogger('seer.firewall')
+
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with 'extra' fields and the current trace id"""
     
-    for rule in rules:
-        rule_dict = dict(rule)
-        policy = rule_dict['policy']
-        rule_status[policy] = {
-            'enabled': rule_dict['rule_enabled'] == 1,
-            'nat_enabled': rule_dict['nat_enabled'] == 1
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
         }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS)
+        trace = current_trace()
+        if trace:
+            entry['trace_id'] = trace.trace_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+_trace_local = threading.local()
+_timings = {}
+_timings_lock = threading.Lock()
+_slow_traces = deque(maxlen=TRACE_RECENT)
+
+class Span:
+    """A timed block; the outermost span on a thread is the root of a trace"""
+    __slots__ = ('name', 'attrs', 'started', 'depth', 'root', '_trace_id', 'spans', 'dropped')
+    
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+    
+    def __enter__(self):
+        stack = getattr(_trace_local, 'stack', None)
+        if stack is None:
+            stack = _trace_local.stack = []
+        self.depth = len(stack)
+        self.root = stack[0] if stack else self
+        if self.root is self:
+            self._trace_id = None
+            self.spans = []
+            self.dropped = 0
+        stack.append(self)
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        _trace_local.stack.pop()
+        if exc_type:
+            self.attrs['error'] = exc_type.__name__
+        record_timing(self.name, elapsed)
         
-        # Track NAT status for LAN to WAN Forward rule (ID 16)
-        if rule_dict['id'] == 16:
-            nat_enabled = rule_dict['nat_enabled'] == 1
-        
-        # Track disabled services to insert DROP rules before LAN accept
-        if rule_dict['rule_enabled'] == 0:
-            if 'Temporal' in policy:
-                disabled_tcp_ports.append('$TEMPORAL_PORT')
-            elif 'Node-RED' in policy:
-                disabled_tcp_ports.append('$NODERED_PORT')
-            elif 'FastAPI' in policy:
-                disabled_tcp_ports.append('$FASTAPI_PORT')
-            elif 'SSH' in policy:
-                disabled_tcp_ports.append('$SSH_PORT')
-            elif 'DNS' in policy:
-                disabled_tcp_ports.append('$DNS_PORT')
-            elif 'ICMP' in policy:
-                disabled_icmp = True
-    
-    # Read current config
-    try:
-        with open(NFTABLES_CONF, 'r') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
+        root = self.root
+        if root is not self:
+            if len(root.spans) < TRACE_MAX_SPANS:
+                root.spans.append((self.name, self.started - root.started, elapsed, self.depth, self.attrs))
+            else:
+                root.dropped += 1
+        elif elapsed >= TRACE_SLOW_MS:
+            _slow_traces.append({
+                'trace_id': self.trace_id,
+                'name': self.name,
+                'started_at': (datetime.now(timezone.utc) - timedelta(milliseconds=elapsed)).isoformat(),
+                'duration_ms': round(elapsed, 3),
+                'attrs': _span_attrs(self.attrs),
+                'spans': [
+                    dict(_span_attrs(attrs), name=name, depth=depth,
+                         offset_ms=round(offset * 1000, 3), duration_ms=round(ms, 3))
+                    for name, offset, ms, depth, attrs in self.spans
+                ],
+                'dropped_spans': self.dropped,
+            })
         return False
     
-    # Process lines with look-ahead
-    new_lines = []
-    disable_next_rule = False  # Flag to disable the next actual rule line
-    enable_next_rule = False  # Flag to enable the next [DISABLED] rule line
+    @property
+    def trace_id(self):
+        # Only made when something asks - most roots are fast and forgotten
+        root = self.root
+        if root._trace_id is None:
+            root._trace_id = uuid.uuid4().hex[:16]
+        return root._trace_id
+
+_NO_SPAN = nullcontext()
+
+def span(name, **attrs):
+    """Time a block: with span('nft.apply', lines=3): ..."""
+    if not TRACING_ENABLED:
+        return _NO_SPAN
+    return Span(name, attrs)
+
+def traced(name):
+    """Decorator timing every call of a function as a span"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def _span_attrs(attrs):
+    # SQL is kept as passed and only tidied for the report
+    if 'sql' in attrs:
+        return dict(attrs, sql=' '.join(attrs['sql'].split())[:120])
+    return attrs
+
+def current_trace():
+    stack = getattr(_trace_local, 'stack', None)
+    return stack[0] if stack else None
+
+def record_timing(name, elapsed_ms):
+    with _timings_lock:
+        entry = _timings.get(name)
+        if entry is None:
+            entry = _timings[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                      'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)}
+        entry['count'] += 1
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+        entry['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def _bucket_percentile(entry, pct):
+    """Upper bound of the bucket holding the pct-th percentile (the max for the last one)"""
+    wanted = entry['count'] * pct / 100
+    seen = 0
+    for bound, count in zip(TRACE_BUCKETS_MS, entry['buckets']):
+        seen += count
+        if seen >= wanted:
+            return min(bound, round(entry['max_ms'], 3))
+    return round(entry['max_ms'], 3)
+
+def timings_snapshot():
+    with _timings_lock:
+        entries = {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in _timings.items()}
+    labels = [f'le_{bound}' for bound in TRACE_BUCKETS_MS] + ['inf']
+    return {
+        name: {
+            'count': entry['count'],
+            'total_ms': round(entry['total_ms'], 3),
+            'mean_ms': round(entry['total_ms'] / entry['count'], 3),
+            'max_ms': round(entry['max_ms'], 3),
+            'p50_ms': _bucket_percentile(entry, 50),
+            'p95_ms': _bucket_percentile(entry, 95),
+            'p99_ms': _bucket_percentile(entry, 99),
+            'buckets': dict(zip(labels, entry['buckets'])),
+        }
+        for name, entry in sorted(entries.items())
+    }
+
+def run_command(args, **kwargs):
+    """subprocess.run() timed as an 'exec.<binary>' span"""
+    if not TRACING_ENABLED:
+        return subprocess.run(args, **kwargs)
+    with Span(f'exec.{os.path.basename(args[0])}', {'args': ' '.join(args[1:])[:120]}):
+        return subprocess.run(args, **kwargs)
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3 connection timing each statement (up to its first row) as a 'db' span"""
+    
+    def execute(self, sql, parameters=()):
+        if not TRACING_ENABLED:
+            return super().execute(sql, parameters)
+        with Span('db.execute', {'sql': sql}):
+            return super().execute(sql, parameters)
+    
+    def executemany(self, sql, parameters):
+        if not TRACING_ENABLED:
+            return super().executemany(sql, parameters)
+        with Span('db.executemany', {'sql': sql}):
+            return super().executemany(sql, parameters)
+    
+    def executescript(self, script):
+        with span('db.executescript'):
+            return super().executescript(script)
+    
+    def commit(self):
+        if not TRACING_ENABLED:
+            return super().commit()
+        with Span('db.commit', {}):
+            return super().commit()
+
+@app.before_request
+def _start_request_span():
+    if TRACING_ENABLED:
+        rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+        request.environ['seer.span'] = Span(f'{request.method} {rule}', {'path': request.path}).__enter__()
+
+@app.after_request
+def _record_request_status(response):
+    request_span = request.environ.get('seer.span')
+    if request_span:
+        request_span.attrs['status'] = response.status_code
+    return response
+
+@app.teardown_request
+def _finish_request_span(exc=None):
+    request_span = request.environ.pop('seer.span', None)
+    if request_span:
+        request_span.__exit__(type(exc) if exc else None, exc, None)
+
+@app.route('/api/debug/timings', methods=['GET'])
+def get_timings():
+    """Span histograms since start, and the slowest recent requests/apply batches"""
+    return jsonify({
+        'success': True,
+        'enabled': TRACING_ENABLED,
+        'slow_threshold_ms': TRACE_SLOW_MS,
+        'spans': timings_snapshot(),
+        'slow_traces': sorted(list(_slow_traces), key=lambda trace: trace['duration_ms'], reverse=True),
+    })
+
+# ==================== NFT EXECUTOR ====================
+#
+# Every nft command goes through nft_executor(). With NFT_BACKEND 'auto'
+# or 'libnftables', command buffers run in process on one long-lived
+# libnftables context, which skips a fork/exec and a fresh ruleset cache
+# per call. If the library cannot be loaded, the nft binary is run with
+# the buffer on stdin instead. Either way one buffer is one transaction
+# and the result is {'success': True, 'output': ...} or
+# {'success': False, 'error': ...}.
+
+NFT_CTX_DEFAULT = 0
+NFT_CTX_OUTPUT_HANDLE = 1 << 3
+NFT_CTX_OUTPUT_JSON = 1 << 4
+NFT_CTX_OUTPUT_ECHO = 1 << 5
+
+class LibnftablesExecutor:
+    """Runs command buffers in process through libnftables (ctypes)"""
+    name = 'libnftables'
+    
+    def __init__(self):
+        lib = ctypes.CDLL(ctypes.util.find_library('nftables') or 'libnftables.so.1')
+        lib.nft_ctx_new.restype = ctypes.c_void_p
+        lib.nft_ctx_new.argtypes = [ctypes.c_uint32]
+        lib.nft_ctx_output_set_flags.restype = None
+        lib.nft_ctx_output_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        for func in (lib.nft_ctx_buffer_output, lib.nft_ctx_buffer_error):
+            func.restype = ctypes.c_int
+            func.argtypes = [ctypes.c_void_p]
+        for func in (lib.nft_ctx_get_output_buffer, lib.nft_ctx_get_error_buffer):
+            func.restype = ctypes.c_char_p
+            func.argtypes = [ctypes.c_void_p]
+        for func in (lib.nft_run_cmd_from_buffer, lib.nft_run_cmd_from_filename):
+            func.restype = ctypes.c_int
+            func.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        
+        ctx = lib.nft_ctx_new(NFT_CTX_DEFAULT)
+        if not ctx:
+            raise OSError('nft_ctx_new() failed')
+        if lib.nft_ctx_buffer_output(ctx) or lib.nft_ctx_buffer_error(ctx):
+            raise OSError('Could not buffer libnftables output')
+        self._lib = lib
+        self._ctx = ctx
+        self._flags = None
+        # A context is not thread-safe; listings also come from the samplers
+        self._lock = threading.Lock()
+    
+    def _call(self, func, argument, flags):
+        with self._lock, span('nft.libnftables'):
+            if flags != self._flags:
+                self._lib.nft_ctx_output_set_flags(self._ctx, flags)
+                self._flags = flags
+            rc = func(self._ctx, argument.encode())
+            # Reading a buffer also rewinds it for the next command
+            output = (self._lib.nft_ctx_get_output_buffer(self._ctx) or b'').decode(errors='replace')
+            error = (self._lib.nft_ctx_get_error_buffer(self._ctx) or b'').decode(errors='replace')
+        if rc != 0:
+            return {'success': False, 'error': error or f'libnftables returned {rc}'}
+        return {'success': True, 'output': output}
+    
+    def run(self, commands, json_output=False, echo=False):
+        flags = NFT_CTX_OUTPUT_JSON if json_output else 0
+        if echo:
+            flags |= NFT_CTX_OUTPUT_ECHO | NFT_CTX_OUTPUT_HANDLE
+        return self._call(self._lib.nft_run_cmd_from_buffer, commands, flags)
+    
+    def run_file(self, path):
+        return self._call(self._lib.nft_run_cmd_from_filename, path, 0)
+
+class SubprocessExecutor:
+    """Runs command buffers through the nft binary, one process per buffer"""
+    name = 'subprocess'
+    
+    def run(self, commands, json_output=False, echo=False):
+        args = ['nft']
+        if json_output:
+            args.append('-j')
+        if echo:
+            args += ['--echo', '--handle']
+        return self._run(args + ['-f', '-'], input=commands)
+    
+    def run_file(self, path):
+        return self._run(['nft', '-f', path])
     
-    for i, line in enumerate(lines):
+    def _run(self, args, **kwargs):
+        try:
+            result = run_command(args, capture_output=True, text=True, check=True, **kwargs)
+            return {'success': True, 'output': result.stdout}
+        except subprocess.CalledProcessError as e:
+            return {'success': False, 'error': e.stderr}
+
+_nft_executor = None
+_nft_executor_lock = threading.Lock()
+
+def nft_executor():
+    """The executor for NFT_BACKEND, made on first use"""
+    global _nft_executor
+    with _nft_executor_lock:
+        if _nft_executor is None or _nft_executor[0] != NFT_BACKEND:
+            _nft_executor = (NFT_BACKEND, _make_nft_executor(NFT_BACKEND))
+        return _nft_executor[1]
+
+def _make_nft_executor(backend):
+    if backend != 'subprocess':
+        try:
+            executor = LibnftablesExecutor()
+            logger.info("Running nft commands in process through libnftables")
+            return executor
+        except (OSError, AttributeError) as e:
+            log = logger.warning if backend == 'libnftables' else logger.info
+            log(f"libnftables not available ({e}) - running the nft binary instead")
+    return SubprocessExecutor()
+
+def execute_nft_command(command):
+    """Execute one nft command (quoted strings such as comments are kept intact)"""
+    return nft_executor().run(command)
+
+# ==================== NFTABLES CONFIG GENERATOR ====================
+#
+# /etc/nftables.conf is rendered from NFTABLES_TEMPLATE in a single pass.
+# The template is parsed once into a model of tables, chains and tagged
+# rule blocks ("# ... @policy:<id>" comments), so rendering never depends
+# on what the previous render left behind.
+#
+# In live mode (NFT_LIVE_TOGGLE) every tagged block is moved into its own
+# chain, reached through a verdict map "gate" keyed on meta nfproto. A
+# toggle then only rewrites the gate elements in one nft transaction, so
+# dynamic sets, blacklist elements and counters survive. Gates are also
+# keyed on meta day . meta hour, which is how schedules are enforced.
+
+POLICY_TAG = re.compile(r'@policy:(\d+)(?::(nat))?\s*$')
+AUTO_DROP_TAG = re.compile(r'^\s*#\s*@auto-drop\s*$')
+AUTO_BAN_TAG = re.compile(r'^\s*#\s*@auto-ban\s*$')
+FLOWTABLE_TAG = re.compile(r'^\s*#\s*@flowtable\s*$')
+FLOWTABLE_START = re.compile(r'^\s*flowtable\s+\S+\s*\{')
+CUSTOM_RULES_TAG = re.compile(r'^\s*#\s*@custom-rules\s*$')
+# Comment of the no-op rule ending each @custom-rules anchor; linear custom rules are inserted before it
+CUSTOM_RULES_ANCHOR = 'Custom rules anchor'
+TEMPLATE_DEFINE = re.compile(r'^\s*define\s')
+TABLE_START = re.compile(r'^\s*table\s+(\S+)\s+(\S+)\s*\{')
+CHAIN_START = re.compile(r'^\s*chain\s+(\S+)\s*\{')
+
+def _tcp_service_drops(port_var):
+    return (f'Disabled TCP port {port_var}', [
+        f'tcp dport {port_var} ip saddr $TAILNET counter drop',
+        f'iifname $LAN tcp dport {port_var} counter drop',
+    ])
+
+# DROP rules inserted at @auto-drop (before the LAN accept) per disabled policy id
+POLICY_DROP_RULES = {
+    9: _tcp_service_drops('$NODERED_PORT'),
+    10: _tcp_service_drops('$TEMPORAL_PORT'),
+    11: _tcp_service_drops('$FASTAPI_PORT'),
+    13: _tcp_service_drops('$DNS_PORT'),
+    14: ('Disabled ICMP (ping)', [
+        'iifname $LAN ip protocol icmp counter drop',
+        'iifname $LAN ip6 nexthdr icmpv6 counter drop',
+    ]),
+    15: _tcp_service_drops('$SSH_PORT'),
+}
+
+_template_cache = {'key': None, 'model': None}
+
+def parse_nftables_template(text):
+    """Parse template text into a list of literal lines, rule blocks and anchors
+    
+    A rule block is a comment line carrying an @policy tag plus the rule
+    lines that follow it, up to the next blank line, comment or chain end.
+    """
+    model = []
+    table = chain = None
+    depth = 0
+    block = None
+    block_counts = {}
+    flowtable = None
+    
+    for line in text.splitlines(keepends=True):
         stripped = line.strip()
         
-        # Check if this line is a comment that identifies a rule
-        rule_identified = None
-        
-        # Match BOTH Remote and LAN rules for the same service
-        if '# Allowing Node-Red' in line or '# Allow Node-Red' in line:
-            rule_identified = 'Node-RED Access'
-        elif '# Allow Temporal Policy' in line:  # Matches both Remote and LAN
-            rule_identified = 'Temporal Policy'
-        elif '# Allow FastAPI' in line:  # Matches both Remote and LAN
-            rule_identified = 'FastAPI'
-        elif '# SSH with rate limiting' in line:
-            rule_identified = 'SSH Access'
-        elif '# ICMP handling' in line:
-            rule_identified = 'ICMP Rate Limit'
-        elif '# DNS queries to firewall' in line:
-            rule_identified = 'DNS Queries'
-        elif '# LAN access' in line and 'Allow' not in line:
-            rule_identified = 'LAN Access'
-        elif '# LAN → WAN' in line or '# LAN -> WAN' in line:
-            rule_identified = 'LAN to WAN Forward'
-        elif '# Masquerade LAN traffic' in line:
-            rule_identified = 'NAT_MASQUERADE'  # Special handling for NAT
-        
-        # If we identified a rule, check its status and set flags
-        if rule_identified and rule_identified in rule_status:
-            status = rule_status[rule_identified]
-            disable_next_rule = not status['enabled']
-            enable_next_rule = status['enabled']
-        
-        # Special handling for NAT masquerade based on nat_enabled
-        if rule_identified == 'NAT_MASQUERADE':
-            disable_next_rule = not nat_enabled
-            enable_next_rule = nat_enabled
-        
-        # Check if this is an actual firewall rule line
-        is_actual_rule = stripped and not stripped.startswith('#') and (
-            'accept' in stripped or 'drop' in stripped or 'reject' in stripped or 'masquerade' in stripped
-        )
+        # The default flowtable after @flowtable (so the raw template loads) is replaced when rendering
+        if flowtable is not None:
+            if flowtable['default'] or FLOWTABLE_START.match(line):
+                flowtable['default'].append(line)
+                if sum(l.count('{') - l.count('}') for l in flowtable['default']) == 0:
+                    flowtable = None
+                continue
+            flowtable = None
         
-        is_disabled_rule = '[DISABLED]' in line
+        if block is not None:
+            if stripped and not stripped.startswith('#') and not (stripped == '}' and block['depth'] == depth):
+                block['rules'].append(line)
+                depth += line.count('{') - line.count('}')
+                continue
+            block = None
         
-        # Case 1: Active rule that needs to be disabled
-        if disable_next_rule and is_actual_rule:
-            # Comment must be at start of line for nftables to ignore it
-            indent = line[:len(line) - len(line.lstrip())]
-            new_lines.append(f'#{indent}[DISABLED] {stripped}\n')
-            disable_next_rule = False
+        tag = POLICY_TAG.search(stripped) if stripped.startswith('#') else None
+        if tag:
+            prefix = f"policy_{tag.group(1)}{'_nat' if tag.group(2) else ''}"
+            block_counts[prefix] = block_counts.get(prefix, 0) + 1
+            block = {
+                'kind': 'block',
+                'name': f'{prefix}_{block_counts[prefix]}',
+                'policy_id': int(tag.group(1)),
+                'field': 'nat_enabled' if tag.group(2) else 'rule_enabled',
+                'table': table,
+                'chain': chain,
+                'comment': line,
+                'rules': [],
+                'depth': depth,
+            }
+            model.append(block)
             continue
         
-        # Case 2: Disabled rule that needs to be enabled
-        if enable_next_rule and is_disabled_rule:
-            # Line format: #          [DISABLED] tcp dport...
-            # Need to extract the original rule after [DISABLED]
-            if '[DISABLED]' in line:
-                # Get everything after [DISABLED] 
-                parts = line.split('[DISABLED]', 1)
-                if len(parts) == 2:
-                    # Extract the actual rule after [DISABLED]
-                    actual_rule = parts[1].lstrip()
-                    # Get the indentation from the part between # and [DISABLED]
-                    indent = parts[0].replace('#', '', 1)
-                    new_lines.append(f'{indent}{actual_rule}')
-                    enable_next_rule = False
-                    continue
+        if AUTO_DROP_TAG.match(line):
+            model.append({'kind': 'auto-drop', 'line': line, 'table': table,
+                          'indent': line[:len(line) - len(line.lstrip())]})
+            continue
         
-        # Insert DROP rules for disabled services BEFORE the general LAN accept
-        if '# LAN access' in line and 'Allow' not in line and (disabled_tcp_ports or disabled_icmp):
-            indent = '\t\t'
-            
-            # Add TCP port DROP rules for BOTH Tailscale and LAN
-            for port in disabled_tcp_ports:
-                new_lines.append(f'{indent}# [AUTO-DROP] Disabled TCP port {port}\n')
-                new_lines.append(f'{indent}tcp dport {port} ip saddr $TAILNET counter drop\n')
-                new_lines.append(f'{indent}iifname $LAN tcp dport {port} counter drop\n')
-            
-            # Add ICMP DROP rule
-            if disabled_icmp:
-                new_lines.append(f'{indent}# [AUTO-DROP] Disabled ICMP (ping)\n')
-                new_lines.append(f'{indent}iifname $LAN ip protocol icmp counter drop\n')
-                new_lines.append(f'{indent}iifname $LAN ip6 nexthdr icmpv6 counter drop\n')
-            
-            if disabled_tcp_ports or disabled_icmp:
-                new_lines.append('\n')
-        
-        # Case 3: Keep line as-is
-        new_lines.append(line)
-        
-        # Reset flags after processing a non-comment, non-empty line
-        if is_actual_rule or is_disabled_rule:
-            disable_next_rule = False
-            enable_next_rule = False
-    
-    # Remove old AUTO-DROP rules on next pass (clean up before inserting new ones)
-    final_lines = []
-    skip_count = 0
-    for line in new_lines:
-        if '[AUTO-DROP]' in line:
-            # Skip this comment line and determine how many rule lines to skip
-            if 'ICMP' in line:
-                skip_count = 2  # Skip 2 lines (IPv4 and IPv6 ICMP drops)
-            else:
-                skip_count = 2  # Skip 2 lines (Tailscale DROP + LAN DROP)
+        if AUTO_BAN_TAG.match(line):
+            model.append({'kind': 'auto-ban', 'line': line, 'table': table,
+                          'indent': line[:len(line) - len(line.lstrip())]})
+            continue
+        
+        if FLOWTABLE_TAG.match(line):
+            flowtable = {'kind': 'flowtable', 'line': line, 'table': table, 'default': [],
+                         'indent': line[:len(line) - len(line.lstrip())]}
+            model.append(flowtable)
+            continue
+        
+        if CUSTOM_RULES_TAG.match(line):
+            model.append({'kind': 'custom-rules', 'line': line, 'table': table, 'chain': chain,
+                          'indent': line[:len(line) - len(line.lstrip())]})
+            continue
+        
+        if not stripped.startswith('#'):
+            match = TABLE_START.match(line)
+            if match:
+                table = f'{match.group(1)} {match.group(2)}'
+            match = CHAIN_START.match(line)
+            if match:
+                chain = match.group(1)
+            depth += line.count('{') - line.count('}')
+            if depth <= 1:
+                chain = None
+            if depth == 0 and table is not None:
+                model.append({'kind': 'table-end', 'table': table, 'line': line})
+                table = None
+                continue
+        
+        model.append(line)
+    
+    return model
+
+def load_nftables_template():
+    """Return the parsed template, re-parsing only when the file changes"""
+    stat = os.stat(NFTABLES_TEMPLATE)
+    key = (NFTABLES_TEMPLATE, stat.st_mtime_ns, stat.st_size)
+    if _template_cache['key'] != key:
+        with open(NFTABLES_TEMPLATE, 'r') as f:
+            model = parse_nftables_template(f.read())
+        if not any(isinstance(item, dict) and item['kind'] == 'block' for item in model):
+            logger.warning(f"{NFTABLES_TEMPLATE} has no @policy tags - rule toggles will have no effect")
+        _template_cache.update(key=key, model=model)
+    return _template_cache['model']
+
+def _disabled_line(line):
+    # Comment must be at start of line for nftables to ignore it
+    indent = line[:len(line) - len(line.lstrip())]
+    return f'#{indent}[DISABLED] {line.strip()}\n'
+
+def _indent_of(line):
+    return line[:len(line) - len(line.lstrip())]
+
+def policy_gates(model):
+    """List the verdict map gates the live layout declares for a template model
+    
+    A gate is open (its map holds 'jump <chain>') while the policy field is
+    enabled and inside its schedule, or while it is disabled or outside its
+    schedule for the auto-drop gates.
+    """
+    gates = []
+    for item in model:
+        if isinstance(item, str):
             continue
-        if skip_count > 0:
-            skip_count -= 1
+        if item['kind'] == 'block':
+            gates.append({
+                'policy_id': item['policy_id'],
+                'field': item['field'],
+                'table': item['table'],
+                'chain': item['name'],
+                'rules': [line.strip() for line in item['rules']],
+                'open_when': 1,
+            })
+        elif item['kind'] == 'auto-drop':
+            for policy_id, (description, drops) in sorted(POLICY_DROP_RULES.items()):
+                gates.append({
+                    'policy_id': policy_id,
+                    'field': 'rule_enabled',
+                    'table': item['table'],
+                    'chain': f'policy_{policy_id}_drop',
+                    'rules': drops,
+                    'open_when': 0,
+                })
+    return gates
+
+def _gate_families(table):
+    family = table.split()[0]
+    return {'ip': ['ipv4'], 'ip6': ['ipv6']}.get(family, ['ipv4', 'ipv6'])
+
+GATE_KEY = 'meta nfproto . meta day . meta hour'
+
+def _gate_elements(gate, windows):
+    return ', '.join(f"{proto} . {element} : jump {gate['chain']}"
+                     for proto in _gate_families(gate['table']) for element in schedule_elements(windows))
+
+def _gate_is_open(gate, status):
+    rule = status.get(gate['policy_id'])
+    value = 1 if rule is None else rule[gate['field']]
+    return value == gate['open_when']
+
+def _gate_windows(gate, status):
+    """UTC windows the gate is open for (empty = closed)"""
+    rule = status.get(gate['policy_id'])
+    windows = schedule_windows(rule_schedule(rule)) if rule else list(FULL_WEEK)
+    if gate['open_when']:
+        return windows if _gate_is_open(gate, status) else []
+    # Drop gates: all week while disabled, outside the schedule while enabled
+    return list(FULL_WEEK) if _gate_is_open(gate, status) else schedule_complement(windows)
+
+def _render_gate_objects(gates, status, indent):
+    out = []
+    for gate in gates:
+        out.append(f"\n{indent}chain {gate['chain']} {{\n")
+        out.extend(f'{indent}{indent}{rule}\n' for rule in gate['rules'])
+        out.append(f'{indent}}}\n')
+        out.append(f"\n{indent}map {gate['chain']}_gate {{\n")
+        out.append(f'{indent}{indent}typeof {GATE_KEY} : verdict\n')
+        out.append(f'{indent}{indent}flags interval\n')
+        windows = _gate_windows(gate, status)
+        if windows:
+            out.append(f'{indent}{indent}elements = {{ {_gate_elements(gate, windows)} }}\n')
+        out.append(f'{indent}}}\n')
+    return out
+
+def render_nftables_config(model, rules, live=None, autoban=(), flowtable=None, compiled=None, groups=()):
+    """Render the template model for the given policy_rules, autoban_policies, flowtable_config and address group ids"""
+    if live is None:
+        live = NFT_LIVE_TOGGLE
+    if compiled is None:
+        compiled = NFT_COMPILED_RULES
+    if flowtable is None:
+        flowtable = {'devices': [LAN_IFACE, WAN_IFACE], 'hw_offload': 0}
+    status = {rule['id']: rule for rule in rules}
+    gates = policy_gates(model) if live else []
+    autoban_tables = {item['table'] for item in model if isinstance(item, dict) and item['kind'] == 'auto-ban'}
+    custom_tables = {item['table'] for item in model if isinstance(item, dict) and item['kind'] == 'custom-rules'}
+    
+    def enabled(policy_id, field):
+        rule = status.get(policy_id)
+        return rule is None or rule[field] == 1
+    
+    def windows(policy_id):
+        rule = status.get(policy_id)
+        return schedule_windows(rule_schedule(rule)) if rule else list(FULL_WEEK)
+    
+    out = []
+    for item in model:
+        if isinstance(item, str):
+            out.append(item)
+        elif item['kind'] == 'block':
+            out.append(item['comment'])
+            if live:
+                indent = _indent_of(item['rules'][0] if item['rules'] else item['comment'])
+                out.append(f"{indent}{GATE_KEY} vmap @{item['name']}_gate\n")
+            elif enabled(item['policy_id'], item['field']):
+                match = schedule_match(windows(item['policy_id']))
+                out.extend(f'{_indent_of(line)}{match}{line.lstrip()}' for line in item['rules'])
+            else:
+                out.extend(_disabled_line(line) for line in item['rules'])
+        elif item['kind'] == 'auto-drop':
+            out.append(item['line'])
+            indent = item['indent']
+            for policy_id, (description, drops) in sorted(POLICY_DROP_RULES.items()):
+                if live:
+                    out.append(f'{indent}{GATE_KEY} vmap @policy_{policy_id}_drop_gate\n')
+                    continue
+                # Outside its schedule an enabled policy drops like a disabled one
+                match = ''
+                if enabled(policy_id, 'rule_enabled'):
+                    outside = schedule_complement(windows(policy_id))
+                    if not outside:
+                        continue
+                    match = schedule_match(outside)
+                out.append(f'{indent}# [AUTO-DROP] {description}\n')
+                out.extend(f'{indent}{match}{drop}\n' for drop in drops)
+        elif item['kind'] == 'auto-ban':
+            out.append(item['line'])
+            out.append(f"{item['indent']}jump autoban\n")
+        elif item['kind'] == 'flowtable':
+            out.append(item['line'])
+            out.extend(_render_flowtable(flowtable, item['indent']))
+        elif item['kind'] == 'custom-rules':
+            out.append(item['line'])
+            if compiled:
+                out.extend(f"{item['indent']}{rule}\n" for rule in custom_rule_lookups(item['chain']))
+            out.append(f'{item["indent"]}continue comment "{CUSTOM_RULES_ANCHOR}"\n')
+        elif item['kind'] == 'table-end':
+            table_gates = [gate for gate in gates if gate['table'] == item['table']]
+            if table_gates:
+                out.append(f'\n{TEMPLATE_INDENT}# Per-policy chains and gates (live toggle mode)\n')
+                out.extend(_render_gate_objects(table_gates, status, TEMPLATE_INDENT))
+            if item['table'] in autoban_tables:
+                out.append(f'\n{TEMPLATE_INDENT}# Auto-ban meters, ban sets and chain\n')
+                out.extend(_render_autoban_objects(autoban, TEMPLATE_INDENT))
+            if item['table'] in custom_tables:
+                out.append(f'\n{TEMPLATE_INDENT}# Address group sets (filled by the API)\n')
+                out.extend(_render_address_group_sets(groups, TEMPLATE_INDENT))
+            if compiled and item['table'] in custom_tables:
+                out.append(f'\n{TEMPLATE_INDENT}# Custom rule verdict maps (filled by the API)\n')
+                out.extend(_render_custom_rule_maps(groups, TEMPLATE_INDENT))
+            out.append(item['line'])
+    
+    return ''.join(out)
+
+def _template_defines(model):
+    """The template's define lines, so live nft scripts can use $WAN etc."""
+    return [item.strip() for item in model if isinstance(item, str) and TEMPLATE_DEFINE.match(item)]
+
+def _render_flowtable(config, indent):
+    # Declared whether or not policy 18 is on - its gate chain refers to it
+    out = [f'{indent}flowtable {FLOWTABLE_NAME} {{\n',
+           f'{indent}{TEMPLATE_INDENT}hook ingress priority 0\n',
+           f"{indent}{TEMPLATE_INDENT}devices = {{ {', '.join(config['devices'])} }}\n"]
+    if config['hw_offload']:
+        out.append(f'{indent}{TEMPLATE_INDENT}flags offload\n')
+    out.append(f'{indent}}}\n')
+    return out
+
+def _render_address_group_sets(groups, indent):
+    out = []
+    for group_id in groups:
+        for version, addr_type in ((4, 'ipv4_addr'), (6, 'ipv6_addr')):
+            out.append(f'\n{indent}set {address_group_set(group_id, version)} {{\n')
+            out.append(f'{indent}{indent}type {addr_type}\n')
+            out.append(f'{indent}{indent}flags interval\n')
+            out.append(f'{indent}}}\n')
+    return out
+
+def _render_custom_rule_maps(groups, indent):
+    out = []
+    specs = list(CUSTOM_RULE_MAPS.items())
+    specs += [(address_group_map(group_id), GROUP_MAP_SPEC) for group_id in groups]
+    for name, (chain, key) in specs:
+        out.append(f'\n{indent}map {name} {{\n')
+        out.append(f'{indent}{indent}typeof {key} : verdict\n')
+        out.append(f'{indent}{indent}flags interval\n')
+        out.append(f'{indent}{indent}counter\n')
+        out.append(f'{indent}}}\n')
+    out.append(f'\n{indent}chain {CUSTOM_REJECT_CHAIN} {{\n')
+    out.append(f'{indent}{indent}reject\n')
+    out.append(f'{indent}}}\n')
+    out.append(f'\n{indent}chain {CUSTOM_GROUPS_CHAIN} {{\n')
+    out.extend(f'{indent}{indent}{rule}\n' for rule in address_group_lookups(groups))
+    out.append(f'{indent}}}\n')
+    return out
+
+def _render_autoban_objects(policies, indent):
+    out = []
+    for trigger in AUTOBAN_TRIGGERS:
+        for suffix, addr_type, _ in AUTOBAN_FAMILIES:
+            for name in (f'autoban_{trigger}_meter_{suffix}', f'autoban_{trigger}_{suffix}'):
+                out.append(f'\n{indent}set {name} {{\n')
+                out.append(f'{indent}{indent}type {addr_type}\n')
+                out.append(f'{indent}{indent}size {AUTOBAN_SET_SIZE}\n')
+                out.append(f'{indent}{indent}flags dynamic,timeout\n')
+                out.append(f'{indent}}}\n')
+    out.append(f'\n{indent}chain autoban {{\n')
+    out.extend(f'{indent}{indent}{rule}\n' for rule in autoban_rules(policies))
+    out.append(f'{indent}}}\n')
+    return out
+
+def apply_policy_gates(policy_ids=None):
+    """Open/close the live verdict map gates to match policy_rules in one transaction
+    
+    Returns False when the live ruleset does not use the gate layout (e.g. it
+    was loaded from a static config), so callers can fall back to a reload.
+    """
+    conn = get_db()
+    rules = [dict(rule) for rule in conn.execute('SELECT * FROM policy_rules ORDER BY id').fetchall()]
+    status = {rule['id']: rule for rule in rules}
+    
+    lines = []
+    for gate in policy_gates(load_nftables_template()):
+        if policy_ids is not None and gate['policy_id'] not in policy_ids:
             continue
-        final_lines.append(line)
+        map_ref = f"{gate['table']} {gate['chain']}_gate"
+        lines.append(f'flush map {map_ref}')
+        windows = _gate_windows(gate, status)
+        if windows:
+            lines.append(f'add element {map_ref} {{ {_gate_elements(gate, windows)} }}')
+    
+    if not lines:
+        return True
+    result = run_nft_script('\n'.join(lines) + '\n')
+    if not result['success']:
+        logger.debug(f"Live gate update failed: {result['error']}")
+    return result['success']
+
+def write_file_atomic(path, text):
+    """Atomically replace path with text; returns False if it was already identical"""
+    data = text.encode()
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
     
-    # Write updated config
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+def render_current_config():
+    """nftables.conf text for the template and the current policy_rules"""
+    conn = get_db()
+    rules = [dict(rule) for rule in conn.execute('SELECT * FROM policy_rules ORDER BY id').fetchall()]
+    return render_nftables_config(load_nftables_template(), rules, autoban=load_autoban_policies(),
+                                  flowtable=load_flowtable_config(), groups=load_address_group_ids())
+
+def write_nftables_config():
+    """Render nftables.conf from the template and policy_rules; True if the file changed"""
+    changed = write_file_atomic(NFTABLES_CONF, render_current_config())
+    if changed:
+        logger.debug(f"Wrote {NFTABLES_CONF}")
+    else:
+        logger.debug(f"{NFTABLES_CONF} unchanged, skipped write")
+    return changed
+
+@traced('config.generate')
+def generate_nftables_config():
+    """Render nftables.conf from the template and the policy_rules table"""
     try:
-        with open(NFTABLES_CONF, 'w') as f:
-            f.writelines(final_lines)
+        write_nftables_config()
         return True
+    except FileNotFoundError:
+        logger.error(f"Template {NFTABLES_TEMPLATE} not found")
+        return False
     except Exception as e:
-        print(f"Error writing config: {e}")
+        logger.error(f"Error writing config: {e}")
         return False
 
+# ==================== SCHEDULES ====================
+#
+# A schedule is 'Always' or one weekly window, stored as text such as
+# 'Mon-Fri 08:00-18:00 Asia/Manila' (end before start runs overnight).
+# It is compiled to UTC (meta day, meta hour) intervals and matched by
+# the kernel - policy gates are keyed on nfproto . day . hour and hold
+# only the in-window elements, custom rules carry an anonymous set - so
+# nothing in userland wakes up when a window opens or closes.
+#
+# nft reads 'meta hour' values as local time of the nft process and
+# converts them to UTC, while 'meta day' is compared in UTC. Hours are
+# therefore rendered as UTC plus the system's offset. Offsets move with
+# DST, so a watcher re-applies the elements when one changes.
+
+SCHEDULE_ALWAYS = 'Always'
+SCHEDULE_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+NFT_DAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+SCHEDULE_PATTERN = re.compile(r'^(?P<days>\S+) (?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})(?: (?P<tz>\S+))?$')
+DAY_SECONDS = 86400
+WEEK_SECONDS = 7 * DAY_SECONDS
+FULL_WEEK = [(day, 0, DAY_SECONDS) for day in range(7)]
+
+_schedule_offsets = None
+
+def _parse_clock(text, allow_midnight_end=False):
+    hours, _, minutes = text.partition(':')
+    hours, minutes = int(hours), int(minutes)
+    if (hours, minutes) == (24, 0) and allow_midnight_end:
+        return DAY_SECONDS
+    if hours > 23 or minutes > 59:
+        raise ValueError(f'{text!r} is not a time of day')
+    return hours * 3600 + minutes * 60
+
+def _parse_days(text):
+    if text.lower() in ('daily', 'all'):
+        return list(range(7))
+    days = set()
+    for item in text.split(','):
+        first, _, last = item.partition('-')
+        try:
+            first = SCHEDULE_DAYS.index(first.strip().capitalize()[:3])
+            last = SCHEDULE_DAYS.index(last.strip().capitalize()[:3]) if last else first
+        except ValueError:
+            raise ValueError(f'{item!r} is not a day or day range (Mon-Fri)')
+        day = first
+        days.add(day)
+        while day != last:  # Fri-Mon wraps over the weekend
+            day = (day + 1) % 7
+            days.add(day)
+    return sorted(days)
+
+def _schedule_zone(name):
+    if not name:
+        return None
+    if ZoneInfo is None:
+        raise ValueError('time zones need Python 3.9+ - leave the zone out to use the system zone')
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f'unknown time zone {name!r}')
+
+def parse_schedule(value):
+    """None for 'Always', else {'days', 'start', 'end', 'tz'} (seconds since local midnight)
+    
+    Accepts the stored text form or {"days": [...], "start": "08:00",
+    "end": "18:00", "timezone": "Asia/Manila"}.
+    """
+    if isinstance(value, dict):
+        days = value.get('days') or 'Daily'
+        days = ','.join(days) if isinstance(days, list) else str(days)
+        value = f"{days} {value.get('start', '00:00')}-{value.get('end', '24:00')} {value.get('timezone') or ''}".strip()
+    if value is None or str(value).strip().lower() in ('', 'always'):
+        return None
+    match = SCHEDULE_PATTERN.match(str(value).strip())
+    if not match:
+        raise ValueError("expected 'Always' or '<days> HH:MM-HH:MM [time zone]', e.g. 'Mon-Fri 08:00-18:00'")
+    schedule = {
+        'days': _parse_days(match.group('days')),
+        'start': _parse_clock(match.group('start')),
+        'end': _parse_clock(match.group('end'), allow_midnight_end=True),
+        'tz': match.group('tz'),
+    }
+    if schedule['start'] == schedule['end']:
+        raise ValueError('window is empty (start equals end)')
+    _schedule_zone(schedule['tz'])
+    return schedule
+
+def format_schedule(schedule):
+    """Canonical text for the schedule column"""
+    if schedule is None:
+        return SCHEDULE_ALWAYS
+    days = ','.join(SCHEDULE_DAYS[day] for day in schedule['days'])
+    clock = lambda seconds: f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}'
+    text = f"{days} {clock(schedule['start'])}-{clock(schedule['end'])}"
+    return f"{text} {schedule['tz']}" if schedule['tz'] else text
+
+def _utc_offset(zone, now):
+    """Seconds east of UTC for a zone (None = system zone) at now"""
+    local = now.astimezone(zone) if zone else now.astimezone()
+    return int(local.utcoffset().total_seconds())
+
+def _merge_windows(windows):
+    merged = []
+    for day, start, end in sorted(windows):
+        if merged and merged[-1][0] == day and start <= merged[-1][2]:
+            merged[-1] = (day, merged[-1][1], max(merged[-1][2], end))
+        else:
+            merged.append((day, start, end))
+    return merged
+
+def schedule_windows(schedule, now=None):
+    """UTC (day, start, end) windows (end exclusive, Monday = 0) the kernel should match"""
+    if schedule is None:
+        return list(FULL_WEEK)
+    now = now or datetime.now(timezone.utc)
+    offset = _utc_offset(_schedule_zone(schedule['tz']), now)
+    duration = (schedule['end'] - schedule['start']) % DAY_SECONDS or DAY_SECONDS
+    windows = []
+    for day in schedule['days']:
+        # Position in the UTC week, then cut at UTC midnights
+        start = (day * DAY_SECONDS + schedule['start'] - offset) % WEEK_SECONDS
+        remaining = duration
+        while remaining > 0:
+            day_start = start - start % DAY_SECONDS
+            piece = min(remaining, day_start + DAY_SECONDS - start)
+            windows.append((start // DAY_SECONDS, start % DAY_SECONDS, start % DAY_SECONDS + piece))
+            start = (start + piece) % WEEK_SECONDS
+            remaining -= piece
+    return _merge_windows(windows)
+
+def schedule_complement(windows):
+    """The rest of the week"""
+    rest = []
+    for day in range(7):
+        cursor = 0
+        for window_day, start, end in windows:
+            if window_day != day:
+                continue
+            if start > cursor:
+                rest.append((day, cursor, start))
+            cursor = max(cursor, end)
+        if cursor < DAY_SECONDS:
+            rest.append((day, cursor, DAY_SECONDS))
+    return rest
+
+def schedule_state(windows, now=None):
+    """(active now, seconds until that changes or None) for UTC windows"""
+    now = now or datetime.now(timezone.utc)
+    position = now.weekday() * DAY_SECONDS + now.hour * 3600 + now.minute * 60 + now.second
+    edges = sorted({day * DAY_SECONDS + t for day, start, end in windows for t in (start, end)})
+    if not edges or set(windows) == set(FULL_WEEK):
+        return bool(windows), None
+    active = any(day * DAY_SECONDS + start <= position < day * DAY_SECONDS + end for day, start, end in windows)
+    later = [edge - position for edge in edges if edge > position]
+    return active, later[0] if later else edges[0] + WEEK_SECONDS - position
+
+def _nft_hour(seconds):
+    # Undo nft's local -> UTC conversion of 'meta hour' values
+    seconds = (seconds + _utc_offset(None, datetime.now(timezone.utc))) % DAY_SECONDS
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+def schedule_elements(windows):
+    """'meta day . meta hour' element texts for UTC windows"""
+    return [f'"{NFT_DAYS[day]}" . "{_nft_hour(start)}"-"{_nft_hour(end - 1)}"' for day, start, end in windows]
+
+def schedule_match(windows):
+    """Inline match for linear rules ('' when the windows cover the whole week)"""
+    if set(windows) == set(FULL_WEEK):
+        return ''
+    return f"meta day . meta hour {{ {', '.join(schedule_elements(windows))} }} "
+
+def rule_schedule(row):
+    """Parsed schedule of a policy_rules/custom_rules row (None = Always, also for bad text)"""
+    try:
+        return parse_schedule(row.get('schedule'))
+    except ValueError:
+        logger.warning(f"Ignoring invalid schedule {row.get('schedule')!r} on rule {row.get('id')}")
+        return None
+
+def schedule_offsets():
+    """Current UTC offsets of the system zone and every zone a schedule uses"""
+    conn = get_db()
+    zones = set()
+    for table in ('policy_rules', 'custom_rules'):
+        for row in conn.execute(f"SELECT id, schedule FROM {table} WHERE schedule IS NOT NULL AND schedule != 'Always'"):
+            schedule = rule_schedule(dict(row))
+            if schedule:
+                zones.add(schedule['tz'])
+    now = datetime.now(timezone.utc)
+    return {zone: _utc_offset(_schedule_zone(zone), now) for zone in zones | {None}}
+
+def apply_schedule_offsets():
+    """Re-apply every schedule after a time zone offset changed"""
+    write_nftables_config()
+    if not (NFT_LIVE_TOGGLE and apply_policy_gates()):
+        if not reload_nftables():
+            raise RuntimeError('Failed to reload firewall')
+    scheduled = [row['id'] for row in get_db().execute(
+        "SELECT id FROM custom_rules WHERE schedule IS NOT NULL AND schedule != 'Always'").fetchall()]
+    failed = sync_custom_rules(scheduled) if scheduled else set()
+    return {'custom_rules': len(scheduled), 'failed': sorted(failed)}
+
+def start_schedule_watch():
+    """Background thread re-applying schedules when a UTC offset changes (DST)"""
+    def watch():
+        global _schedule_offsets
+        while True:
+            try:
+                offsets = schedule_offsets()
+                if _schedule_offsets is not None and offsets != _schedule_offsets:
+                    logger.info("Time zone offsets changed, re-applying schedules")
+                    submit_job('task', {'run': apply_schedule_offsets}, 'Re-apply schedules (UTC offset changed)')
+                _schedule_offsets = offsets
+            except Exception as e:
+                logger.warning(f"Schedule watch error: {e}")
+            time.sleep(SCHEDULE_CHECK_INTERVAL)
+    
+    thread = threading.Thread(target=watch, name='schedule-watch', daemon=True)
+    thread.start()
+    return thread
+
+def schedule_view(row, now=None):
+    """Effective state of a row with a schedule: active, enabled and active, next change"""
+    windows = schedule_windows(rule_schedule(row), now)
+    active, remaining = schedule_state(windows, now)
+    now = now or datetime.now(timezone.utc)
+    return {
+        'schedule_active': active,
+        'next_change': (now + timedelta(seconds=remaining)).isoformat() if remaining else None,
+    }, remaining
+
+# ==================== APPLY QUEUE ====================
+#
+# Every change to the live ruleset (nft, systemctl, conntrack) runs on one
+# writer thread. Endpoints commit to the database, queue a job and return
+# 202 with its id. Jobs that queue up while the writer is busy are applied
+# together: one regenerate for all policy toggles, one nft transaction for
+# all custom rules and one for consecutive blacklist changes.
+
+_apply_queue = queue.Queue()
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_apply_worker = None
+_apply_worker_lock = threading.Lock()
+
+# These converge on the database state, so order within a batch does not matter
+CONVERGENT_JOBS = ('policy', 'custom')
+
+def submit_job(kind, payload, description=''):
+    """Queue a ruleset change for the writer thread, returns the job"""
+    job = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'description': description,
+        'status': 'queued',
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'started_at': None,
+        'finished_at': None,
+        'batch_size': None,
+        'result': None,
+        'error': None,
+        'payload': payload,
+        'done': threading.Event(),
+        # The request that queued the job, to find it in /api/debug/timings
+        'trace_id': getattr(current_trace(), 'trace_id', None),
+    }
+    with _jobs_lock:
+        _jobs[job['id']] = job
+        while len(_jobs) > JOB_HISTORY and next(iter(_jobs.values()))['done'].is_set():
+            _jobs.popitem(last=False)
+    
+    start_apply_worker()
+    _apply_queue.put(job)
+    return job
+
+def job_view(job):
+    return {key: value for key, value in job.items() if key not in ('payload', 'done')}
+
+def _finish_job(job, result=None, error=None):
+    job['result'] = result
+    job['error'] = error
+    job['status'] = 'failed' if error else 'done'
+    job['finished_at'] = datetime.now(timezone.utc).isoformat()
+    job['done'].set()
+
+def _apply_policy_jobs(jobs):
+    """Regenerate once and update the gates of every toggled policy
+    
+    A job's payload holds 'changes': [{rule_id, field, evict}] - one for a
+    toggle, several for a batch or profile.
+    """
+    changes = [change for job in jobs for change in job['payload']['changes']]
+    policy_ids = {change['rule_id'] for change in changes}
+    logger.debug("Regenerating nftables config", extra={'policies': sorted(policy_ids)})
+    if not generate_nftables_config():
+        raise RuntimeError('Failed to generate config')
+    
+    if NFT_LIVE_TOGGLE and apply_policy_gates(policy_ids):
+        logger.debug("Updated live policy gates", extra={'policies': sorted(policy_ids)})
+    else:
+        logger.debug("Reloading nftables")
+        if not reload_nftables():
+            raise RuntimeError('Failed to reload firewall')
+        
+        # The reload flushed custom rules and blacklist elements - put them back
+        try:
+            reconcile_ruleset()
+        except Exception as e:
+            logger.warning(f"Could not restore runtime rules after reload: {e}")
+    
+    # Drop existing connections for policies that ended up disabled
+    status = {row['id']: dict(row) for row in get_db().execute('SELECT * FROM policy_rules')}
+    disabled = {(change['rule_id'], change['field']) for change in changes
+                if change.get('evict') and not status.get(change['rule_id'], {}).get(change['field'])}
+    tuples = set()
+    for rule_id, field in disabled:
+        tuples.update(policy_conntrack_tuples(rule_id, field))
+    evicted = evict_connections(tuples) if tuples else 0
+    for job in jobs:
+        _finish_job(job, result={'evicted': evicted})
+
+def _apply_custom_jobs(jobs):
+    """Bring every touched custom rule in line with the database in one transaction"""
+    failed = sync_custom_rules({job['payload']['rule_id'] for job in jobs})
+    for job in jobs:
+        if job['payload']['rule_id'] in failed:
+            _finish_job(job, error='Failed to apply firewall rules')
+    
+    # Flows a rule no longer admits (or now blocks) stay established until evicted
+    tuples = set()
+    for job in jobs:
+        if job['payload'].get('evict') and not job['done'].is_set():
+            tuples.update(custom_rule_conntrack_tuples(job['payload']['evict']))
+    evicted = evict_connections(tuples) if tuples else 0
+    for job in jobs:
+        if not job['done'].is_set():
+            _finish_job(job, result={'evicted': evicted})
+
+def _apply_nft_jobs(jobs):
+    """Concatenate nft scripts (blacklist elements) into one transaction"""
+    result = run_nft_script(''.join(job['payload']['script'] for job in jobs))
+    if result['success']:
+        return
+    if len(jobs) == 1:
+        raise NftError(result['error'].strip())
+    
+    # One bad line rejects the whole batch - retry job by job to isolate it
+    for job in jobs:
+        result = run_nft_script(job['payload']['script'])
+        _finish_job(job, error=None if result['success'] else result['error'].strip())
+
+def _run_task_jobs(jobs):
+    for job in jobs:
+        try:
+            _finish_job(job, result=job['payload']['run']())
+        except Exception as e:
+            _finish_job(job, error=str(e))
+
+JOB_HANDLERS = {
+    'policy': _apply_policy_jobs,
+    'custom': _apply_custom_jobs,
+    'nft': _apply_nft_jobs,
+    'task': _run_task_jobs,
+}
+
+def _run_job_group(kind, jobs):
+    try:
+        with span(f'job.{kind}', jobs=len(jobs)):
+            JOB_HANDLERS[kind](jobs)
+    except Exception as e:
+        logger.error(f"Apply job ({kind}) failed: {e}", extra={'kind': kind, 'jobs': [job['id'] for job in jobs]})
+        for job in jobs:
+            if not job['done'].is_set():
+                _finish_job(job, error=str(e))
+    for job in jobs:
+        if not job['done'].is_set():
+            _finish_job(job)
+
+def run_apply_batch(batch):
+    """Apply a batch of queued jobs, coalescing jobs of the same kind"""
+    started = datetime.now(timezone.utc).isoformat()
+    for job in batch:
+        job.update(status='running', started_at=started, batch_size=len(batch))
+    
+    with span('apply.batch', jobs=len(batch), traces=[job['trace_id'] for job in batch if job['trace_id']]):
+        _run_apply_batch(batch)
+        
+        # Remember the state this batch left the ruleset in
+        applied = [job['description'] for job in batch if job['kind'] in SNAPSHOT_JOB_KINDS and not job['error']]
+        if applied:
+            try:
+                record_snapshot('; '.join(applied))
+            except Exception as e:
+                logger.warning(f"Could not record ruleset snapshot: {e}")
+
+def _run_apply_batch(batch):
+    # Blacklist scripts and tasks keep their order; only neighbours are merged
+    ordered = [job for job in batch if job['kind'] not in CONVERGENT_JOBS]
+    for kind, jobs in groupby(ordered, key=lambda job: job['kind']):
+        _run_job_group(kind, list(jobs))
+    for kind in CONVERGENT_JOBS:
+        jobs = [job for job in batch if job['kind'] == kind]
+        if jobs:
+            _run_job_group(kind, jobs)
+
+def _apply_worker_loop():
+    while True:
+        batch = [_apply_queue.get()]
+        # Give a burst of clicks a moment to land in the same apply
+        time.sleep(APPLY_COALESCE_DELAY)
+        while True:
+            try:
+                batch.append(_apply_queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) > 1:
+            logger.debug("Applying queued changes together", extra={'jobs': len(batch)})
+        run_apply_batch(batch)
+
+def start_apply_worker():
+    """Start the single ruleset writer thread (once per process)"""
+    global _apply_worker
+    with _apply_worker_lock:
+        if _apply_worker is None or not _apply_worker.is_alive():
+            _apply_worker = threading.Thread(target=_apply_worker_loop, name='nft-writer', daemon=True)
+            _apply_worker.start()
+    return _apply_worker
+
+def job_response(job, body=None):
+    """202 with the job id, or with ?wait=1 block until the job has finished"""
+    body = dict(body or {}, success=True, job_id=job['id'])
+    wait = request.args.get('wait', '0') in ('1', 'true')
+    
+    if not wait or not job['done'].wait(JOB_WAIT_TIMEOUT):
+        response = jsonify(dict(body, status=job['status']))
+        response.status_code = 202
+        response.headers['Location'] = f"/api/jobs/{job['id']}"
+        return response
+    
+    if job['error']:
+        return jsonify(dict(body, success=False, status=job['status'], error=job['error'])), 500
+    if isinstance(job['result'], dict):
+        body.update(job['result'])
+    return jsonify(dict(body, status=job['status']))
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status of a queued ruleset change"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_view(job))
+
+# ==================== READ CACHE ====================
+#
+# Dashboards poll the read endpoints every few seconds while the data
+# changes a few times a day. Serialized responses are cached per table
+# generation; triggers in database.sql bump state_generation on every
+# write, so writes from other processes invalidate the cache too.
+
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+
+def state_generations(tables):
+    """Current write generation of each table, in the order given"""
+    rows = get_db().execute('SELECT name, generation FROM state_generation').fetchall()
+    generations = {row['name']: row['generation'] for row in rows}
+    return tuple(generations.get(table) for table in tables)
+
+def cached_json(name, tables, build, extra=()):
+    """Serve build() as JSON, rebuilt only when the tables change; answers If-None-Match with 304
+    
+    build() returns (payload, max_age): max_age is None, or the number of
+    seconds a payload with time-dependent fields stays accurate.
+    """
+    # Read the generation before the data - a write in between only costs a rebuild
+    key = (state_generations(tables), tuple(extra))
+    now = time.monotonic()
+    with _read_cache_lock:
+        entry = _read_cache.get(name)
+    
+    if entry is None or entry['key'] != key or (entry['expires'] is not None and entry['expires'] <= now):
+        payload, max_age = build()
+        body = jsonify(payload).get_data()
+        entry = {
+            'key': key,
+            'body': body,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'expires': now + max_age if max_age else None,
+        }
+        with _read_cache_lock:
+            _read_cache[name] = entry
+    
+    response = app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
 # API Endpoints
 
 @app.route('/api/rules', methods=['GET'])
 def get_rules():
-    """Get all policy rules"""
-    conn = get_db()
-    rules = conn.execute('SELECT * FROM policy_rules ORDER BY id').fetchall()
-    conn.close()
+    """Get all policy rules, with whether each is in effect right now"""
+    def build():
+        rules = get_db().execute('SELECT * FROM policy_rules ORDER BY id').fetchall()
+        rules, max_age = with_schedule_state([dict(rule) for rule in rules], 'rule_enabled')
+        return {
+            'success': True,
+            'rules': rules
+        }, max_age
     
-    return jsonify({
-        'success': True,
-        'rules': [dict(rule) for rule in rules]
-    })
+    return cached_json('rules', ('policy_rules',), build)
+
+def with_schedule_state(rows, enabled_field):
+    """Add schedule_active/next_change/effective to rows; max_age until the next change"""
+    max_age = None
+    for row in rows:
+        view, remaining = schedule_view(row)
+        row.update(view, effective=bool(row[enabled_field]) and view['schedule_active'])
+        if remaining and (max_age is None or remaining < max_age):
+            max_age = remaining
+    return rows, max_age
+
+@app.route('/api/rules/<int:rule_id>/schedule', methods=['POST'])
+def set_rule_schedule(rule_id):
+    """Set when a policy is in effect ('Always' or e.g. 'Mon-Fri 08:00-18:00 Asia/Manila')"""
+    data = request.get_json(silent=True) or {}
+    try:
+        schedule = format_schedule(parse_schedule(data.get('schedule')))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid schedule: {e}'}), 400
+    
+    # Same guard as the toggle - outside the window the API port would close
+    if rule_id == 11 and schedule != SCHEDULE_ALWAYS:
+        return jsonify({'error': 'Cannot schedule API access - you would lock yourself out!'}), 400
+    
+    with db_transaction() as conn:
+        cursor = conn.execute(
+            'UPDATE policy_rules SET schedule = ?, updated_at = ? WHERE id = ?',
+            (schedule, datetime.now().isoformat(), rule_id)
+        )
+        if not cursor.rowcount:
+            return jsonify({'error': 'Rule not found'}), 404
+    
+    record_audit('Changed schedule', {'schedule': schedule}, rule_id=rule_id)
+    
+    # Only the gate elements change - the kernel opens and closes the window itself
+    job = submit_job(
+        'policy',
+        {'changes': [{'rule_id': rule_id, 'field': 'rule_enabled', 'evict': False}]},
+        f'Rule {rule_id}: schedule={schedule}'
+    )
+    return job_response(job, {'rule_id': rule_id, 'schedule': schedule})
 
 @app.route('/api/rules/<int:rule_id>/toggle', methods=['POST'])
 def toggle_rule(rule_id):
@@ -251,187 +1585,750 @@ def toggle_rule(rule_id):
     if rule_id == 11 and field == 'rule_enabled' and value == 0:
         return jsonify({'error': 'Cannot disable API access - you would lock yourself out!'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Update database
-    cursor.execute(
-        f'UPDATE policy_rules SET {field} = ?, updated_at = ? WHERE id = ?',
-        (value, datetime.now().isoformat(), rule_id)
-    )
+    with db_transaction() as conn:
+        # Update database
+        conn.execute(
+            f'UPDATE policy_rules SET {field} = ?, updated_at = ? WHERE id = ?',
+            (value, datetime.now().isoformat(), rule_id)
+        )
     
     # Log the change
     action = f"{'Enabled' if value else 'Disabled'} {field.replace('_', ' ')}"
-    cursor.execute(
-        'INSERT INTO firewall_audit_log (action, rule_id, details) VALUES (?, ?, ?)',
-        (action, rule_id, json.dumps(data))
-    )
-    
-    conn.commit()
-    conn.close()
-    
-    # Regenerate and reload nftables config
-    print(f"[DEBUG] Regenerating nftables config for rule {rule_id}, {field}={value}")
-    config_success = generate_nftables_config()
-    if not config_success:
-        return jsonify({'error': 'Failed to generate config'}), 500
-    
-    print(f"[DEBUG] Reloading nftables...")
-    reload_success = reload_nftables()
-    if not reload_success:
-        return jsonify({'error': 'Failed to reload firewall'}), 500
+    record_audit(action, data, rule_id=rule_id)
     
-    # If disabling a rule, also drop existing connections for that port
-    if field == 'rule_enabled' and value == 0:
-        print(f"[DEBUG] Dropping existing connections for disabled rule {rule_id}")
-        try:
-            # Get rule details to find the port
-            conn = get_db()
-            rule = conn.execute('SELECT * FROM policy_rules WHERE id = ?', (rule_id,)).fetchone()
-            conn.close()
-            
-            if rule:
-                rule_dict = dict(rule)
-                policy = rule_dict.get('policy', '')
-                
-                # Drop connections based on policy type
-                if 'Temporal' in policy:
-                    subprocess.run(['conntrack', '-D', '-p', 'tcp', '--dport', '1889'], 
-                                 capture_output=True, check=False)
-                elif 'Node-RED' in policy:
-                    subprocess.run(['conntrack', '-D', '-p', 'tcp', '--dport', '1880'], 
-                                 capture_output=True, check=False)
-                elif 'FastAPI' in policy:
-                    subprocess.run(['conntrack', '-D', '-p', 'tcp', '--dport', '8000'], 
-                                 capture_output=True, check=False)
-        except Exception as e:
-            print(f"[WARNING] Could not drop connections: {e}")
+    # Regenerate and apply on the writer thread; disabling also drops existing connections
+    job = submit_job(
+        'policy',
+        {'changes': [{'rule_id': rule_id, 'field': field, 'evict': not value}]},
+        f'Rule {rule_id}: {field}={value}'
+    )
     
-    return jsonify({
-        'success': True,
+    return job_response(job, {
         'rule_id': rule_id,
         'field': field,
         'value': value
     })
 
-@app.route('/api/blacklist', methods=['GET'])
-def get_blacklist():
-    """Get blacklisted IPs"""
-    conn = get_db()
-    ips = conn.execute('SELECT * FROM firewall_blacklist ORDER BY added_at DESC').fetchall()
-    conn.close()
-    
-    return jsonify([dict(ip) for ip in ips])
+POLICY_FIELDS = ('rule_enabled', 'nat_enabled')
 
-@app.route('/api/blacklist', methods=['POST'])
-def add_blacklist():
-    """Add IP to blacklist"""
-    data = request.json
-    ip_address = data.get('ip_address')
-    reason = data.get('reason', 'Manual block')
+def validate_policy_changes(conn, changes):
+    """Check a list of {rule_id, field, value} changes, returns (changes, errors)
+    
+    Every change is checked before any is applied; errors carry the index of
+    the offending change so a client can point at it.
+    """
+    if not isinstance(changes, list) or not changes:
+        return [], [{'error': "'changes' must be a non-empty list"}]
+    
+    existing = {row['id'] for row in conn.execute('SELECT id FROM policy_rules')}
+    valid = []
+    errors = []
+    seen = set()
+    for index, change in enumerate(changes):
+        if not isinstance(change, dict):
+            errors.append({'index': index, 'error': 'Change must be an object'})
+            continue
+        rule_id, field, value = change.get('rule_id'), change.get('field'), change.get('value')
+        if field not in POLICY_FIELDS:
+            error = 'Invalid field'
+        elif value not in (0, 1):
+            error = 'Value must be 0 or 1'
+        elif not isinstance(rule_id, int) or rule_id not in existing:
+            error = 'Rule not found'
+        elif rule_id == 11 and field == 'rule_enabled' and value == 0:
+            # Same guard as the toggle (rule_id 11 = FastAPI)
+            error = 'Cannot disable API access - you would lock yourself out!'
+        elif (rule_id, field) in seen:
+            error = 'Duplicate change for this rule and field'
+        else:
+            seen.add((rule_id, field))
+            valid.append({'rule_id': rule_id, 'field': field, 'value': int(value)})
+            continue
+        errors.append({'index': index, 'rule_id': rule_id, 'field': field, 'error': error})
+    return valid, errors
+
+def apply_policy_changes(changes, source):
+    """Commit validated changes in one transaction and queue one regenerate for all of them"""
+    now = datetime.now().isoformat()
+    with db_transaction() as conn:
+        for field in POLICY_FIELDS:
+            conn.executemany(
+                f'UPDATE policy_rules SET {field} = ?, updated_at = ? WHERE id = ?',
+                [(change['value'], now, change['rule_id']) for change in changes if change['field'] == field]
+            )
+    
+    for change in changes:
+        action = f"{'Enabled' if change['value'] else 'Disabled'} {change['field'].replace('_', ' ')}"
+        record_audit(action, dict(change, source=source), rule_id=change['rule_id'])
+    
+    # One job: one regenerate/reload, one gate update and one conntrack eviction
+    return submit_job(
+        'policy',
+        {'changes': [{'rule_id': change['rule_id'], 'field': change['field'], 'evict': not change['value']}
+                     for change in changes]},
+        f'{source}: {len(changes)} policy changes'
+    )
+
+@app.route('/api/rules/batch', methods=['POST'])
+def batch_rules():
+    """Apply several rule_enabled/nat_enabled changes with a single reload"""
+    data = request.get_json(silent=True) or {}
+    changes, errors = validate_policy_changes(get_db(), data.get('changes'))
+    if errors:
+        return jsonify({'success': False, 'error': 'Invalid changes - nothing was applied', 'errors': errors}), 400
+    
+    job = apply_policy_changes(changes, 'Batch')
+    return job_response(job, {'changes': changes})
+
+# ==================== POLICY PROFILES ====================
+#
+# A profile is a named list of policy changes (e.g. "maintenance" turning
+# SSH and Node-RED on). Applying one goes through the batch path above.
+
+PROFILE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9 _.-]{0,63}$')
+
+def profile_view(row):
+    return dict(row, changes=json.loads(row['changes']))
+
+@app.route('/api/profiles', methods=['GET'])
+def get_profiles():
+    """List saved policy profiles"""
+    rows = get_db().execute('SELECT * FROM policy_profiles ORDER BY name').fetchall()
+    return jsonify({'success': True, 'profiles': [profile_view(row) for row in rows]})
+
+@app.route('/api/profiles', methods=['POST'])
+def save_profile():
+    """Create or replace a profile; without 'changes' the current rule states are captured"""
+    data = request.get_json(silent=True) or {}
+    name = str(data.get('name') or '').strip()
+    if not PROFILE_NAME.match(name):
+        return jsonify({'success': False, 'error': 'Invalid profile name'}), 400
+    
+    with db_transaction() as conn:
+        changes = data.get('changes')
+        if changes is None:
+            changes = [
+                {'rule_id': row['id'], 'field': field, 'value': row[field]}
+                for row in conn.execute('SELECT * FROM policy_rules ORDER BY id')
+                for field in POLICY_FIELDS
+                if not (row['id'] == 11 and field == 'rule_enabled')
+            ]
+        changes, errors = validate_policy_changes(conn, changes)
+        if errors:
+            return jsonify({'success': False, 'error': 'Invalid changes', 'errors': errors}), 400
+        conn.execute('''
+            INSERT INTO policy_profiles (name, description, changes) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET description = excluded.description,
+                changes = excluded.changes, updated_at = CURRENT_TIMESTAMP
+        ''', (name, data.get('description', ''), json.dumps(changes)))
+    
+    record_audit('Save profile', {'name': name, 'changes': len(changes)})
+    return jsonify({'success': True, 'name': name, 'changes': changes})
+
+@app.route('/api/profiles/<name>', methods=['DELETE'])
+def delete_profile(name):
+    """Delete a saved profile (the rules keep their current state)"""
+    with db_transaction() as conn:
+        cursor = conn.execute('DELETE FROM policy_profiles WHERE name = ?', (name,))
+        if not cursor.rowcount:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
     
+    record_audit('Delete profile', {'name': name})
+    return jsonify({'success': True})
+
+@app.route('/api/profiles/<name>/apply', methods=['POST'])
+def apply_profile(name):
+    """Apply a saved profile's changes with a single reload"""
     conn = get_db()
-    cursor = conn.cursor()
+    row = conn.execute('SELECT * FROM policy_profiles WHERE name = ?', (name,)).fetchone()
+    if not row:
+        return jsonify({'success': False, 'error': 'Profile not found'}), 404
     
-    try:
-        cursor.execute(
-            'INSERT INTO firewall_blacklist (ip_address, reason) VALUES (?, ?)',
-            (ip_address, reason)
-        )
-        
-        # Add to nftables blacklist set
-        ip_version = 'blacklist_v6' if ':' in ip_address else 'blacklist_v4'
-        execute_nft_command(f'add element inet filter {ip_version} {{ {ip_address} }}')
-        
-        cursor.execute(
-            'INSERT INTO firewall_audit_log (action, details) VALUES (?, ?)',
-            ('Blacklist IP', json.dumps({'ip': ip_address, 'reason': reason}))
-        )
+    # Re-check - rules may have been removed since the profile was saved
+    changes, errors = validate_policy_changes(conn, json.loads(row['changes']))
+    if errors:
+        return jsonify({'success': False, 'error': 'Profile no longer applies - nothing was applied', 'errors': errors}), 409
+    
+    job = apply_policy_changes(changes, f'Profile {name}')
+    return job_response(job, {'profile': name, 'changes': changes})
+
+@app.route('/api/blacklist', methods=['GET'])
+def get_blacklist():
+    """Get blacklisted IPs with the time each entry has left"""
+    def build():
+        ips = get_db().execute('SELECT * FROM firewall_blacklist ORDER BY added_at DESC').fetchall()
         
-        conn.commit()
-        conn.close()
+        expiring = any(ip['expires_at'] for ip in ips)
+        remaining = blacklist_kernel_timeouts() if expiring else {}
+        now = datetime.now(timezone.utc)
+        entries = []
+        for ip in ips:
+            entry = dict(ip)
+            entry['expires_in'] = remaining.get(entry['ip_address'])
+            if entry['expires_in'] is None and entry['expires_at']:
+                # Not (or no longer) in the kernel set - fall back to the stored expiry
+                expires = datetime.strptime(entry['expires_at'], SQLITE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+                entry['expires_in'] = max(int((expires - now).total_seconds()), 0)
+            entries.append(entry)
         
-        return jsonify({'success': True, 'ip_address': ip_address})
-    except sqlite3.IntegrityError:
-        return jsonify({'error': 'IP already blacklisted'}), 400
+        # Countdowns go stale - rebuild every few seconds while any entry expires
+        return entries, BLACKLIST_EXPIRY_RESOLUTION if expiring else None
+    
+    return cached_json('blacklist', ('firewall_blacklist',), build)
+
+@app.route('/api/blacklist', methods=['POST'])
+def add_blacklist():
+    """Add IP to blacklist, optionally expiring after 'ttl' seconds or at 'expires_at'"""
+    data = request.json
+    reason = data.get('reason', 'Manual block')
+    
+    try:
+        network = ipaddress.ip_network(str(data.get('ip_address', '')).strip(), strict=False)
+        ttl = parse_blacklist_ttl(data)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    ip_address = _blacklist_entry(network)
+    
+    # Checked here for a 400; the writer checks again before it inserts
+    with db_transaction() as conn:
+        error = _blacklist_add_error(*split_blacklist_entry(network, load_blacklist_networks(conn)))
+    if error:
+        return jsonify({'error': error}), 400
+    
+    # Rows and set elements change together on the writer thread; nft errors roll back
+    job = submit_job('task', {'run': lambda: add_blacklist_entry(network, reason, ttl)}, f'Blacklist {ip_address}')
+    
+    # Offloaded flows never reach the forward chain's blacklist drop
+    if flowtable_enabled():
+        submit_job('task', {'run': lambda: evict_address_flows(network)}, f'Evict flows of {ip_address}')
+    return job_response(job, {'ip_address': ip_address, 'ttl': ttl})
 
 @app.route('/api/blacklist/<int:ip_id>', methods=['DELETE'])
 def remove_blacklist(ip_id):
     """Remove IP from blacklist"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get IP address
-    ip_row = cursor.execute('SELECT ip_address FROM firewall_blacklist WHERE id = ?', (ip_id,)).fetchone()
-    
+    ip_row = get_db().execute('SELECT ip_address FROM firewall_blacklist WHERE id = ?', (ip_id,)).fetchone()
     if not ip_row:
         return jsonify({'error': 'IP not found'}), 404
     
     ip_address = ip_row['ip_address']
+    job = submit_job('task', {'run': lambda: remove_blacklist_entry(ip_id)}, f'Unblacklist {ip_address}')
+    return job_response(job, {'ip_address': ip_address})
+
+def split_blacklist_entry(network, existing):
+    """(covering network or None, pieces to insert) for a single blacklist add
+    
+    Existing rows are never merged or rewritten: an entry inside a row is
+    covered, and rows inside the entry are cut out of it so no two set
+    elements overlap.
+    """
+    current = [net for net in existing if net.version == network.version]
+    covering = next((old for old in current if network.subnet_of(old)), None)
+    if covering is not None:
+        return covering, []
+    return None, _exclude_networks(network, [old for old in current if old.subnet_of(network)])
+
+def _blacklist_add_error(covering, pieces):
+    if covering is not None:
+        return f'IP already blacklisted (covered by {_blacklist_entry(covering)})'
+    if not pieces:
+        return 'IP already blacklisted (covered by existing entries)'
+    return None
+
+def add_blacklist_entry(network, reason, ttl):
+    """Writer task: insert a blacklist entry's rows and set elements in one transaction"""
+    expires_at = blacklist_expiry(ttl)
+    with db_transaction() as conn:
+        covering, pieces = split_blacklist_entry(network, load_blacklist_networks(conn))
+        error = _blacklist_add_error(covering, pieces)
+        if error:
+            raise ValueError(error)
+        
+        ids = [conn.execute(
+            'INSERT INTO firewall_blacklist (ip_address, reason, expires_at) VALUES (?, ?, ?)',
+            (_blacklist_entry(net), reason, expires_at)
+        ).lastrowid for net in pieces]
+        
+        # Add to nftables blacklist set - the kernel expires timed elements itself
+        result = run_nft_script(''.join(line + '\n' for line in blacklist_update_script([], pieces, ttl)))
+        if not result['success']:
+            raise NftError(f"Failed to update firewall sets: {result['error'].strip()}")
     
-    # Remove from database
-    cursor.execute('DELETE FROM firewall_blacklist WHERE id = ?', (ip_id,))
+    entries = [_blacklist_entry(net) for net in pieces]
+    record_audit('Blacklist IP', {'ip': _blacklist_entry(network), 'reason': reason, 'ttl': ttl, 'entries': entries})
+    return {'ids': ids, 'entries': entries}
+
+def remove_blacklist_entry(ip_id):
+    """Writer task: delete a blacklist row and its set element in one transaction"""
+    with db_transaction() as conn:
+        ip_row = conn.execute('SELECT ip_address, reason FROM firewall_blacklist WHERE id = ?', (ip_id,)).fetchone()
+        if not ip_row:
+            raise ValueError('IP not found')
+        
+        ip_address = ip_row['ip_address']
+        network = ipaddress.ip_network(ip_address, strict=False)
+        conn.execute('DELETE FROM firewall_blacklist WHERE id = ?', (ip_id,))
+        
+        # Add before delete so an element the kernel already expired still deletes cleanly
+        set_name = _blacklist_set(network)
+        result = run_nft_script(f'add element inet filter {set_name} {{ {ip_address} }}\n'
+                                f'delete element inet filter {set_name} {{ {ip_address} }}\n')
+        if not result['success']:
+            raise NftError(f"Failed to update firewall sets: {result['error'].strip()}")
     
-    # Remove from nftables
-    ip_version = 'blacklist_v6' if ':' in ip_address else 'blacklist_v4'
-    execute_nft_command(f'delete element inet filter {ip_version} {{ {ip_address} }}')
+    record_audit('Remove from blacklist', {'ip': ip_address})
     
-    cursor.execute(
-        'INSERT INTO firewall_audit_log (action, details) VALUES (?, ?)',
-        ('Remove from blacklist', json.dumps({'ip': ip_address}))
-    )
+    # Lift the kernel ban too, or the next auto-ban sync would add it back
+    reason = ip_row['reason'] or ''
+    trigger = reason[len(AUTOBAN_REASON):] if reason.startswith(AUTOBAN_REASON) else None
+    if trigger not in AUTOBAN_TRIGGERS or not _autoban_table():
+        return {}
+    try:
+        return lift_autobans(trigger, network)
+    except NftError as e:
+        logger.warning(f"Removed {ip_address} but could not lift its auto-ban: {e}")
+        return {'lifted': 0}
+
+def _blacklist_set(network):
+    return 'blacklist_v6' if network.version == 6 else 'blacklist_v4'
+
+def _blacklist_entry(network):
+    """Canonical text form - single hosts stay plain addresses"""
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return network.with_prefixlen
+
+def _blacklist_element(entry, ttl):
+    return f'{entry} timeout {ttl}s' if ttl else entry
+
+def parse_blacklist_ttl(data):
+    """Element timeout in seconds from 'ttl' or 'expires_at' (None = permanent)"""
+    if data.get('ttl') is not None:
+        ttl = int(data['ttl'])
+    elif data.get('expires_at'):
+        expires = datetime.fromisoformat(str(data['expires_at']).replace('Z', '+00:00'))
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        ttl = int((expires - datetime.now(timezone.utc)).total_seconds())
+    else:
+        return None
+    if ttl <= 0:
+        raise ValueError('expiry must be in the future')
+    return ttl
+
+def blacklist_expiry(ttl):
+    """expires_at column value (UTC, same format as CURRENT_TIMESTAMP)"""
+    if not ttl:
+        return None
+    return (datetime.now(timezone.utc) + timedelta(seconds=ttl)).strftime(SQLITE_TIME_FORMAT)
+
+def _json_element_text(value):
+    if isinstance(value, dict) and 'prefix' in value:
+        return f"{value['prefix']['addr']}/{value['prefix']['len']}"
+    return value if isinstance(value, str) else None
+
+def blacklist_kernel_timeouts():
+    """Map blacklist entry -> seconds until the kernel expires it"""
+    remaining = {}
+    for set_name in ('blacklist_v4', 'blacklist_v6'):
+        result = nft_executor().run(f'list set inet filter {set_name}', json_output=True)
+        if not result['success']:
+            continue
+        for item in json.loads(result['output']).get('nftables', []):
+            for elem in item.get('set', {}).get('elem', []):
+                if not isinstance(elem, dict) or 'expires' not in elem.get('elem', {}):
+                    continue
+                text = _json_element_text(elem['elem']['val'])
+                if text:
+                    remaining[text] = elem['elem']['expires']
+    return remaining
+
+def reap_expired_blacklist():
+    """Delete expired blacklist rows in batches, returns number of rows removed"""
+    removed = 0
+    while True:
+        with db_transaction() as conn:
+            cursor = conn.execute(
+                '''DELETE FROM firewall_blacklist WHERE id IN (
+                       SELECT id FROM firewall_blacklist
+                       WHERE expires_at IS NOT NULL AND expires_at <= CURRENT_TIMESTAMP
+                       LIMIT ?)''',
+                (BLACKLIST_REAP_BATCH,)
+            )
+        removed += cursor.rowcount
+        if cursor.rowcount < BLACKLIST_REAP_BATCH:
+            break
+    if removed:
+        record_audit('Blacklist expiry', {'removed': removed})
+    return removed
+
+def start_blacklist_reaper():
+    """Background thread removing expired blacklist rows every BLACKLIST_REAP_INTERVAL seconds"""
+    def reaper():
+        while True:
+            time.sleep(BLACKLIST_REAP_INTERVAL)
+            try:
+                removed = reap_expired_blacklist()
+                if removed:
+                    logger.info("Removed expired blacklist entries", extra={'removed': removed})
+            except Exception as e:
+                logger.warning(f"Blacklist reaper error: {e}")
+    
+    thread = threading.Thread(target=reaper, name='blacklist-reaper', daemon=True)
+    thread.start()
+    return thread
+
+def parse_blacklist_entries(values):
+    """Parse IPs/CIDRs, returning (networks, rejected)"""
+    networks = set()
+    rejected = []
+    for value in values:
+        value = str(value).strip()
+        if not value or value.startswith('#'):
+            continue
+        try:
+            networks.add(ipaddress.ip_network(value, strict=False))
+        except ValueError:
+            rejected.append(value)
+    return networks, rejected
+
+def _exclude_networks(network, holes):
+    """Prefixes covering network minus the holes (holes inside it)"""
+    parts = [network]
+    for hole in holes:
+        remaining = []
+        for part in parts:
+            if hole.subnet_of(part):
+                remaining.extend(part.address_exclude(hole))
+            elif not part.subnet_of(hole):
+                remaining.append(part)
+        parts = remaining
+    return parts
+
+def load_blacklist_networks(conn):
+    """{network: row} for unexpired blacklist rows; expired rows are deleted first
     
-    conn.commit()
-    conn.close()
+    The kernel has already dropped expired elements, so a row the reaper has
+    not reached yet must not cover or split a new entry.
+    """
+    conn.execute('DELETE FROM firewall_blacklist WHERE expires_at IS NOT NULL AND expires_at <= CURRENT_TIMESTAMP')
+    existing = {}
+    for row in conn.execute('SELECT id, ip_address, reason, expires_at FROM firewall_blacklist').fetchall():
+        try:
+            existing[ipaddress.ip_network(row['ip_address'], strict=False)] = row
+        except ValueError:
+            continue
+    return existing
+
+def aggregate_blacklist(new_networks, existing, reason, expires_at):
+    """Merge new networks into the existing blacklist as minimal prefixes
     
-    return jsonify({'success': True})
+    existing maps network -> row (id, reason, expires_at). New networks only
+    merge with rows of the same reason and expiry; other rows are never
+    rewritten - new networks inside them are skipped and new networks
+    around them are split, so no two set elements overlap. Returns
+    (additions, replaced_ids, counts).
+    """
+    additions = []
+    replaced_ids = []
+    counts = {'merged': 0, 'covered': 0, 'split': 0}
+    for version in (4, 6):
+        incoming = [net for net in new_networks if net.version == version]
+        if not incoming:
+            continue
+        current = [net for net in existing if net.version == version]
+        same = {net: existing[net]['id'] for net in current
+                if (existing[net]['reason'], existing[net]['expires_at']) == (reason, expires_at)}
+        other = [net for net in current if net not in same]
+        
+        pieces = set()
+        for net in incoming:
+            if any(net.subnet_of(old) for old in current):
+                counts['covered'] += 1
+                continue
+            parts = _exclude_networks(net, [old for old in other if old.subnet_of(net)])
+            if parts != [net]:
+                counts['split'] += 1
+            pieces.update(parts)
+        
+        for net in ipaddress.collapse_addresses(list(same) + list(pieces)):
+            if net in same:
+                continue
+            additions.append(net)
+            replaced_ids.extend(row_id for old, row_id in same.items() if old.subnet_of(net))
+        # Pieces that did not become a row of their own
+        counts['merged'] += len(pieces - set(additions))
+    return additions, replaced_ids, counts
+
+@app.route('/api/blacklist/bulk', methods=['POST'])
+def add_blacklist_bulk():
+    """Import many IPs/CIDRs at once (JSON array or newline-delimited body)"""
+    data = request.get_json(silent=True)
+    reason = request.args.get('reason', 'Bulk import')
+    options = {'ttl': request.args.get('ttl')}
+    if isinstance(data, dict):
+        reason = data.get('reason', reason)
+        options = data
+        data = data.get('ips') or data.get('entries') or []
+    if data is None:
+        data = request.get_data(as_text=True).splitlines()
+    if not isinstance(data, list):
+        return jsonify({'error': 'Expected a JSON array or newline-delimited list'}), 400
+    
+    try:
+        ttl = parse_blacklist_ttl(options)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid expiry: {e}'}), 400
+    
+    values = [item.get('ip_address') if isinstance(item, dict) else item for item in data]
+    networks, rejected = parse_blacklist_entries(values)
+    if len(networks) > BLACKLIST_BULK_MAX:
+        return jsonify({'error': f'At most {BLACKLIST_BULK_MAX} entries per request'}), 400
+    
+    # The import and its nft transaction run on the writer thread; nft errors roll back
+    job = submit_job(
+        'task',
+        {'run': lambda: import_blacklist(networks, rejected, reason, ttl)},
+        f'Bulk blacklist import ({len(networks)} entries)'
+    )
+    return job_response(job, {'accepted': len(networks), 'rejected': len(rejected)})
+
+def blacklist_update_script(removed, additions, ttl):
+    """nft lines deleting replaced elements, then adding the new prefixes in chunks"""
+    lines = [f'delete element inet filter {_blacklist_set(net)} {{ {_blacklist_entry(net)} }}' for net in removed]
+    for set_name in ('blacklist_v4', 'blacklist_v6'):
+        entries = [_blacklist_element(_blacklist_entry(net), ttl) for net in additions if _blacklist_set(net) == set_name]
+        for i in range(0, len(entries), BLACKLIST_CHUNK_SIZE):
+            lines.append(f"add element inet filter {set_name} {{ {', '.join(entries[i:i + BLACKLIST_CHUNK_SIZE])} }}")
+    return lines
+
+def import_blacklist(networks, rejected, reason, ttl, action='Bulk blacklist import'):
+    """Merge parsed networks into the blacklist table and sets in one transaction"""
+    expires_at = blacklist_expiry(ttl)
+    with db_transaction() as conn:
+        existing = load_blacklist_networks(conn)
+        existing_entries = {row['id']: net for net, row in existing.items()}
+        
+        additions, replaced_ids, counts = aggregate_blacklist(networks, existing, reason, expires_at)
+        
+        # One nft transaction: drop covered elements, then add the new prefixes in chunks
+        lines = blacklist_update_script([existing_entries[row_id] for row_id in replaced_ids], additions, ttl)
+        
+        conn.executemany('DELETE FROM firewall_blacklist WHERE id = ?', [(row_id,) for row_id in replaced_ids])
+        conn.executemany(
+            'INSERT INTO firewall_blacklist (ip_address, reason, expires_at) VALUES (?, ?, ?)',
+            [(_blacklist_entry(net), reason, expires_at) for net in additions]
+        )
+        summary = dict(
+            counts,
+            accepted=len(networks),
+            rejected=len(rejected),
+            added=len(additions),
+            replaced=len(replaced_ids),
+        )
+        
+        if lines:
+            result = run_nft_script('\n'.join(lines) + '\n')
+            if not result['success']:
+                raise NftError(f"Failed to update firewall sets: {result['error'].strip()}")
+    
+    record_audit(action, dict(summary, reason=reason, ttl=ttl))
+    return dict(summary, rejected_entries=rejected[:100])
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get firewall status"""
-    conn = get_db()
+    pending_jobs = _apply_queue.qsize()
+    # Unknown until the metrics sampler has listed the ruleset once
+    firewall_active = metrics_snapshot().get('firewall_active', True)
+    
+    def build():
+        conn = get_db()
+        enabled_rules = conn.execute('SELECT COUNT(*) as count FROM policy_rules WHERE rule_enabled = 1').fetchone()['count']
+        blacklist_count = conn.execute('SELECT COUNT(*) as count FROM firewall_blacklist').fetchone()['count']
+        
+        return {
+            'enabled_rules': enabled_rules,
+            'blacklist_count': blacklist_count,
+            'pending_jobs': pending_jobs,
+            'firewall_active': firewall_active
+        }, None
+    
+    return cached_json('status', ('policy_rules', 'firewall_blacklist'), build, extra=(pending_jobs, firewall_active))
+
+# ==================== AUDIT LOG ====================
+#
+# Mutations queue audit entries in memory; a flusher thread writes them in
+# one transaction per batch. Reads page by id (?before=<id>) instead of
+# sorting the table, and a retention job rolls rows older than
+# AUDIT_RETENTION_DAYS into per-day counts in firewall_audit_daily.
+
+_audit_buffer = []
+_audit_lock = threading.Lock()
+_audit_flush_lock = threading.Lock()
+_audit_wakeup = threading.Event()
+_audit_writer = None
+
+def record_audit(action, details=None, rule_id=None):
+    """Queue an audit log entry (written within AUDIT_FLUSH_INTERVAL seconds)"""
+    timestamp = datetime.now(timezone.utc).strftime(SQLITE_TIME_FORMAT)
+    entry = (action, rule_id, json.dumps(details) if details is not None else None, timestamp)
+    with _audit_lock:
+        _audit_buffer.append(entry)
+        full = len(_audit_buffer) >= AUDIT_BATCH_SIZE
+    start_audit_writer()
+    if full:
+        _audit_wakeup.set()
+
+def flush_audit_log():
+    """Write buffered audit entries in one transaction, returns the number written"""
+    with _audit_flush_lock:
+        with _audit_lock:
+            entries = _audit_buffer[:]
+            del _audit_buffer[:]
+        if not entries:
+            return 0
+        try:
+            with db_transaction() as conn:
+                conn.executemany(
+                    'INSERT INTO firewall_audit_log (action, rule_id, details, timestamp) VALUES (?, ?, ?, ?)',
+                    entries
+                )
+        except sqlite3.Error:
+            # Keep the entries (in order) for the next attempt
+            with _audit_lock:
+                _audit_buffer[:0] = entries
+            raise
+        return len(entries)
+
+def start_audit_writer():
+    """Background thread flushing the audit buffer (once per process)"""
+    global _audit_writer
     
-    enabled_rules = conn.execute('SELECT COUNT(*) as count FROM policy_rules WHERE rule_enabled = 1').fetchone()['count']
-    blacklist_count = conn.execute('SELECT COUNT(*) as count FROM firewall_blacklist').fetchone()['count']
+    def writer():
+        while True:
+            _audit_wakeup.wait(AUDIT_FLUSH_INTERVAL)
+            _audit_wakeup.clear()
+            try:
+                flush_audit_log()
+            except Exception as e:
+                logger.warning(f"Audit log flush error: {e}")
     
-    conn.close()
+    with _audit_lock:
+        if _audit_writer is None or not _audit_writer.is_alive():
+            _audit_writer = threading.Thread(target=writer, name='audit-writer', daemon=True)
+            _audit_writer.start()
+            atexit.register(flush_audit_log)
+    return _audit_writer
+
+def rollup_audit_log(now=None):
+    """Fold audit rows older than AUDIT_RETENTION_DAYS into daily counts, returns rows removed"""
+    now = now or datetime.now(timezone.utc)
+    cutoff = (now - timedelta(days=AUDIT_RETENTION_DAYS)).strftime(SQLITE_TIME_FORMAT)
+    last_id = get_db().execute(
+        'SELECT MAX(id) AS id FROM firewall_audit_log WHERE timestamp < ?', (cutoff,)
+    ).fetchone()['id']
+    if last_id is None:
+        return 0
     
-    return jsonify({
-        'enabled_rules': enabled_rules,
-        'blacklist_count': blacklist_count,
-        'firewall_active': True
-    })
+    removed = 0
+    first_id = get_db().execute('SELECT MIN(id) AS id FROM firewall_audit_log').fetchone()['id']
+    # Short transactions so request writes are never blocked for long
+    for start in range(first_id, last_id + 1, AUDIT_ROLLUP_BATCH):
+        end = min(start + AUDIT_ROLLUP_BATCH - 1, last_id)
+        with db_transaction() as conn:
+            conn.execute(
+                '''INSERT INTO firewall_audit_daily (day, action, rule_id, count)
+                   SELECT date(timestamp), action, COALESCE(rule_id, 0), COUNT(*)
+                   FROM firewall_audit_log WHERE id BETWEEN ? AND ? AND timestamp < ?
+                   GROUP BY 1, 2, 3
+                   ON CONFLICT (day, action, rule_id) DO UPDATE SET count = count + excluded.count''',
+                (start, end, cutoff)
+            )
+            removed += conn.execute(
+                'DELETE FROM firewall_audit_log WHERE id BETWEEN ? AND ? AND timestamp < ?',
+                (start, end, cutoff)
+            ).rowcount
+    return removed
+
+def start_audit_retention():
+    """Background thread running rollup_audit_log() every AUDIT_ROLLUP_INTERVAL seconds"""
+    def retention():
+        while True:
+            try:
+                removed = rollup_audit_log()
+                if removed:
+                    logger.info("Rolled audit log rows into daily summaries", extra={'removed': removed})
+            except Exception as e:
+                logger.warning(f"Audit log retention error: {e}")
+            time.sleep(AUDIT_ROLLUP_INTERVAL)
+    
+    thread = threading.Thread(target=retention, name='audit-retention', daemon=True)
+    thread.start()
+    return thread
 
 @app.route('/api/audit', methods=['GET'])
 def get_audit_log():
-    """Get audit log"""
-    limit = request.args.get('limit', 100, type=int)
+    """Get audit log, newest first (?limit, ?before=<id>, ?rule_id, ?action)"""
+    limit = min(max(request.args.get('limit', 100, type=int), 1), AUDIT_PAGE_MAX)
+    before = request.args.get('before', type=int)
+    rule_id = request.args.get('rule_id', type=int)
+    action = request.args.get('action')
     
-    conn = get_db()
-    logs = conn.execute(
-        'SELECT * FROM firewall_audit_log ORDER BY timestamp DESC LIMIT ?',
-        (limit,)
+    # Entries made by this process should be visible straight away
+    flush_audit_log()
+    
+    clauses = []
+    params = []
+    if before is not None:
+        clauses.append('id < ?')
+        params.append(before)
+    if rule_id is not None:
+        clauses.append('rule_id = ?')
+        params.append(rule_id)
+    if action:
+        clauses.append('action = ?')
+        params.append(action)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    
+    logs = get_db().execute(
+        f'SELECT * FROM firewall_audit_log {where} ORDER BY id DESC LIMIT ?',
+        params + [limit]
     ).fetchall()
-    conn.close()
     
-    return jsonify([dict(log) for log in logs])
+    response = jsonify([dict(log) for log in logs])
+    if len(logs) == limit:
+        # Cursor for the next (older) page
+        response.headers['X-Next-Before'] = str(logs[-1]['id'])
+    return response
+
+@app.route('/api/audit/daily', methods=['GET'])
+def get_audit_daily():
+    """Daily counts of rolled-up audit entries from the last ?days days"""
+    days = min(max(request.args.get('days', 365, type=int), 1), 3650)
+    rows = get_db().execute(
+        'SELECT * FROM firewall_audit_daily WHERE day >= date(\'now\', ?) ORDER BY day DESC, action',
+        (f'-{days} days',)
+    ).fetchall()
+    return jsonify([dict(row) for row in rows])
 
 # ==================== CUSTOM RULES API ====================
 
 @app.route('/api/custom-rules', methods=['GET'])
 def get_custom_rules():
-    """Get all custom rules"""
-    try:
-        conn = get_db()
-        rules = conn.execute(
+    """Get all custom rules, with whether each is in effect right now"""
+    def build():
+        rules = get_db().execute(
             'SELECT * FROM custom_rules ORDER BY id ASC'
         ).fetchall()
-        conn.close()
+        rules, max_age = with_schedule_state([dict(rule) for rule in rules], 'enabled')
         
-        return jsonify({
+        return {
             'success': True,
-            'rules': [dict(rule) for rule in rules]
-        })
+            'rules': rules
+        }, max_age
+    
+    try:
+        return cached_json('custom-rules', ('custom_rules',), build)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -445,39 +2342,57 @@ def add_custom_rule():
         if not data.get('name') or not data.get('port'):
             return jsonify({'success': False, 'error': 'Name and port are required'}), 400
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Insert new rule
-        cursor.execute('''
-            INSERT INTO custom_rules (
-                name, description, port, protocol, usage, action,
-                access_from, access_lan, access_tailnet, access_wan, enabled
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['name'],
-            data.get('description', ''),
-            int(data['port']),
-            data.get('protocol', 'TCP'),
-            data.get('usage', 'Custom'),
-            data.get('action', 'ACCEPT'),
-            data.get('accessFrom', 'LAN'),
-            1 if data.get('accessLan') else 0,
-            1 if data.get('accessTailnet') else 0,
-            1 if data.get('accessWan') else 0,
-            1  # Enabled by default
-        ))
-        
-        rule_id = cursor.lastrowid
-        conn.commit()
-        
-        # Apply nftables rules
-        apply_custom_rule(cursor.lastrowid, data)
-        
-        conn.close()
-        
-        return jsonify({
-            'success': True,
+        try:
+            port = custom_rule_port(data['port'])
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid port: {e}'}), 400
+        try:
+            schedule = format_schedule(parse_schedule(data.get('schedule')))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid schedule: {e}'}), 400
+        
+        source_group = data.get('sourceGroupId')
+        with db_transaction() as conn:
+            if source_group is not None and not conn.execute(
+                    'SELECT 1 FROM address_groups WHERE id = ?', (source_group,)).fetchone():
+                return jsonify({'success': False, 'error': 'Address group not found'}), 400
+            
+            conflicts = custom_rule_conflicts(conn, dict(data, port=port))
+            if conflicts:
+                return jsonify({
+                    'success': False,
+                    'error': 'Ports overlap enabled custom rules with the same protocol and source',
+                    'conflicts': conflicts,
+                }), 409
+            
+            # Insert new rule
+            cursor = conn.execute('''
+                INSERT INTO custom_rules (
+                    name, description, port, protocol, usage, action,
+                    access_from, access_lan, access_tailnet, access_wan, source_group_id, schedule, enabled
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                data['name'],
+                data.get('description', ''),
+                port,
+                data.get('protocol', 'TCP'),
+                data.get('usage', 'Custom'),
+                data.get('action', 'ACCEPT'),
+                data.get('accessFrom', 'LAN'),
+                1 if data.get('accessLan') else 0,
+                1 if data.get('accessTailnet') else 0,
+                1 if data.get('accessWan') else 0,
+                source_group,
+                schedule,
+                1  # Enabled by default
+            ))
+            rule_id = cursor.lastrowid
+        
+        # Apply nftables rules; a new blocking rule also cuts existing flows
+        evict = dict(data) if (data.get('action') or 'ACCEPT').lower() != 'accept' else None
+        job = submit_job('custom', {'rule_id': rule_id, 'evict': evict}, f'Add custom rule {rule_id}')
+        
+        return job_response(job, {
             'message': 'Custom rule added',
             'rule_id': rule_id
         })
@@ -488,33 +2403,50 @@ def add_custom_rule():
 def delete_custom_rule(rule_id):
     """Delete a custom rule"""
     try:
-        conn = get_db()
-        
-        # Get rule details before deleting
-        rule = conn.execute(
-            'SELECT * FROM custom_rules WHERE id = ?', (rule_id,)
-        ).fetchone()
-        
-        if not rule:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Rule not found'}), 404
-        
-        # Delete from database
-        conn.execute('DELETE FROM custom_rules WHERE id = ?', (rule_id,))
-        conn.commit()
-        
-        # Remove nftables rules
-        remove_custom_rule(dict(rule))
+        with db_transaction() as conn:
+            # Get rule details before deleting
+            rule = conn.execute(
+                'SELECT * FROM custom_rules WHERE id = ?', (rule_id,)
+            ).fetchone()
+            
+            if not rule:
+                return jsonify({'success': False, 'error': 'Rule not found'}), 404
+            
+            # Delete from database
+            conn.execute('DELETE FROM custom_rules WHERE id = ?', (rule_id,))
         
-        conn.close()
+        # Remove nftables rules and the flows an accept rule let in
+        evict = dict(rule) if rule['enabled'] and (rule['action'] or 'ACCEPT').lower() == 'accept' else None
+        job = submit_job('custom', {'rule_id': rule_id, 'evict': evict}, f'Delete custom rule {rule_id}')
         
-        return jsonify({
-            'success': True,
-            'message': 'Custom rule deleted'
+        return job_response(job, {
+            'message': 'Custom rule deleted',
+            'rule_id': rule_id
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/custom-rules/<int:rule_id>/schedule', methods=['POST'])
+def set_custom_rule_schedule(rule_id):
+    """Set when a custom rule is in effect"""
+    data = request.get_json(silent=True) or {}
+    try:
+        schedule = format_schedule(parse_schedule(data.get('schedule')))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Invalid schedule: {e}'}), 400
+    
+    with db_transaction() as conn:
+        cursor = conn.execute(
+            'UPDATE custom_rules SET schedule = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (schedule, rule_id)
+        )
+        if not cursor.rowcount:
+            return jsonify({'success': False, 'error': 'Rule not found'}), 404
+    
+    record_audit('Changed custom rule schedule', {'schedule': schedule}, rule_id=rule_id)
+    job = submit_job('custom', {'rule_id': rule_id, 'evict': None}, f'Schedule custom rule {rule_id}')
+    return job_response(job, {'rule_id': rule_id, 'schedule': schedule})
+
 @app.route('/api/custom-rules/<int:rule_id>/toggle', methods=['POST'])
 def toggle_custom_rule(rule_id):
     """Toggle a custom rule on/off"""
@@ -522,279 +2454,2491 @@ def toggle_custom_rule(rule_id):
         data = request.json
         enabled = data.get('enabled', True)
         
-        conn = get_db()
-        
-        # Get rule details
-        rule = conn.execute(
-            'SELECT * FROM custom_rules WHERE id = ?', (rule_id,)
-        ).fetchone()
-        
-        if not rule:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Rule not found'}), 404
-        
-        # Update enabled state
-        conn.execute(
-            'UPDATE custom_rules SET enabled = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-            (1 if enabled else 0, rule_id)
-        )
-        conn.commit()
+        with db_transaction() as conn:
+            # Get rule details
+            rule = conn.execute(
+                'SELECT * FROM custom_rules WHERE id = ?', (rule_id,)
+            ).fetchone()
+            
+            if not rule:
+                return jsonify({'success': False, 'error': 'Rule not found'}), 404
+            
+            conflicts = custom_rule_conflicts(conn, dict(rule), rule_id) if enabled else []
+            if conflicts:
+                return jsonify({
+                    'success': False,
+                    'error': 'Ports overlap enabled custom rules with the same protocol and source',
+                    'conflicts': conflicts,
+                }), 409
+            
+            # Update enabled state
+            conn.execute(
+                'UPDATE custom_rules SET enabled = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                (1 if enabled else 0, rule_id)
+            )
         
         # Apply or remove nftables rules based on state
-        rule_dict = dict(rule)
-        print(f"Toggle rule {rule_id}: enabled={enabled}, rule_dict={rule_dict}")
+        logger.debug(f"Toggle custom rule {rule_id}: enabled={enabled}", extra={'rule': dict(rule)})
+        # Evict flows a disabled accept rule let in, or an enabled blocking rule now refuses
+        accepts = (rule['action'] or 'ACCEPT').lower() == 'accept'
+        evict = dict(rule) if bool(enabled) != accepts else None
+        job = submit_job('custom', {'rule_id': rule_id, 'evict': evict}, f'Toggle custom rule {rule_id}')
         
-        success = True
-        if enabled:
-            success = apply_custom_rule(rule_id, rule_dict)
+        return job_response(job, {
+            'message': f'Custom rule {"enabled" if enabled else "disabled"}',
+            'rule_id': rule_id
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def parse_port_spec(value):
+    """Sorted, merged (low, high) port ranges from 22, '10000-20000' or '80,443,8443'"""
+    ranges = []
+    items = [item.strip() for item in str(value).split(',')]
+    if len(items) > CUSTOM_RULE_MAX_PORTS:
+        raise ValueError(f'at most {CUSTOM_RULE_MAX_PORTS} ports or ranges')
+    for item in items:
+        low, _, high = item.partition('-')
+        if not low.strip().isdigit() or (high and not high.strip().isdigit()):
+            raise ValueError(f'{item!r} is not a port or range')
+        low, high = int(low), int(high or low)
+        if not 1 <= low <= high <= 65535:
+            raise ValueError(f'{item!r} is outside 1-65535')
+        ranges.append((low, high))
+    return _merge_ranges(ranges)
+
+def _merge_ranges(ranges):
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
         else:
-            success = remove_custom_rule(rule_dict)
+            merged.append((low, high))
+    return merged
+
+def _intersect_ranges(a, b):
+    return [(max(low, b_low), min(high, b_high)) for low, high in a for b_low, b_high in b
+            if max(low, b_low) <= min(high, b_high)]
+
+def _subtract_ranges(ranges, taken):
+    """Parts of ranges outside taken (a merged list)"""
+    free = []
+    for low, high in ranges:
+        for taken_low, taken_high in taken:
+            if taken_high < low or taken_low > high:
+                continue
+            if taken_low > low:
+                free.append((low, taken_low - 1))
+            low = taken_high + 1
+        if low <= high:
+            free.append((low, high))
+    return free
+
+def _port_text(port_range):
+    low, high = port_range
+    return str(low) if low == high else f'{low}-{high}'
+
+def format_port_spec(ranges):
+    return ','.join(_port_text(port_range) for port_range in ranges)
+
+def custom_rule_port(value):
+    """port column value - single ports stay integers, ranges and lists are canonical text"""
+    ranges = parse_port_spec(value)
+    return ranges[0][0] if len(ranges) == 1 and ranges[0][0] == ranges[0][1] else format_port_spec(ranges)
+
+def custom_rule_conflicts(conn, rule_data, rule_id=None):
+    """Ids of enabled custom rules with the same match path and overlapping ports"""
+    paths = {}
+    for chain, interface, proto, ports, source, _, _ in custom_rule_matches(rule_id, rule_data):
+        paths[(chain, interface, proto, source)] = ports
+    
+    conflicts = []
+    rows = conn.execute('SELECT * FROM custom_rules WHERE enabled = 1 AND id != ? ORDER BY id', (rule_id or 0,)).fetchall()
+    for row in rows:
+        for chain, interface, proto, ports, source, _, _ in custom_rule_matches(row['id'], dict(row)):
+            if _intersect_ranges(paths.get((chain, interface, proto, source), []), ports):
+                conflicts.append(row['id'])
+                break
+    return conflicts
+
+def custom_rule_matches(rule_id, rule_data):
+    """The matches a custom rule needs, as (chain, interface, proto, ports, source, action, suffix)
+    
+    ports is a list of (low, high) ranges.
+    
+    Empty list if the rule is invalid. compile_custom_rule() renders these as
+    linear rules, compile_custom_rule_elements() as verdict map elements.
+    """
+    port = rule_data.get('port')
+    protocol = (rule_data.get('protocol') or 'TCP').lower()
+    action = (rule_data.get('action') or 'ACCEPT').lower()
+    
+    # Get access flags (support both camelCase and snake_case)
+    access_lan = rule_data.get('accessLan') or rule_data.get('access_lan') or 0
+    access_tailnet = rule_data.get('accessTailnet') or rule_data.get('access_tailnet') or 0
+    access_wan = rule_data.get('accessWan') or rule_data.get('access_wan') or 0
+    source_group = rule_data.get('sourceGroupId') or rule_data.get('source_group_id')
+    
+    # Validate required fields - values end up in an nft script, so be strict
+    if not port:
+        logger.error(f"Rule {rule_id}: Missing port")
+        return []
+    
+    try:
+        port = parse_port_spec(port)
+    except ValueError:
+        logger.error(f"Rule {rule_id}: Invalid port {port!r}")
+        return []
+    
+    if protocol not in ('tcp', 'udp', 'both') or action not in ('accept', 'drop', 'reject'):
+        logger.error(f"Rule {rule_id}: Invalid protocol/action {protocol}/{action}")
+        return []
+    
+    if not access_lan and not access_tailnet and not access_wan and not source_group:
+        logger.error(f"Rule {rule_id}: No access sources selected")
+        return []
+    
+    try:
+        source_group = int(source_group) if source_group else None
+    except (TypeError, ValueError):
+        logger.error(f"Rule {rule_id}: Invalid source group {source_group!r}")
+        return []
+    
+    # Determine protocol(s)
+    if protocol == 'both':
+        protocols = ['tcp', 'udp']
+    else:
+        protocols = [protocol]
+    
+    matches = []
+    for proto in protocols:
+        if access_lan:
+            # LAN access - INPUT chain (traffic TO firewall)
+            matches.append(('input', LAN_IFACE, proto, port, None, action, ''))
+            
+            # If blocking, also block LAN -> Internet and the firewall itself
+            if action == 'drop':
+                matches.append(('forward', LAN_IFACE, proto, port, None, 'drop', ' Forward'))
+                matches.append(('output', WAN_IFACE, proto, port, None, 'drop', ' Output'))
         
-        conn.close()
+        if access_tailnet:
+            # Tailscale access - INPUT chain
+            matches.append(('input', None, proto, port, TAILNET_NET, action, ''))
         
-        if not success:
-            return jsonify({
-                'success': False,
-                'error': 'Failed to apply firewall rules'
-            }), 500
+        if access_wan:
+            # WAN access - INPUT chain (incoming from internet)
+            matches.append(('input', WAN_IFACE, proto, port, None, action, ''))
         
-        return jsonify({
-            'success': True,
-            'message': f'Custom rule {"enabled" if enabled else "disabled"}'
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        if source_group:
+            # Address group - INPUT chain, any interface, one set lookup per family
+            for version in (4, 6):
+                matches.append(('input', None, proto, port, f'@{address_group_set(source_group, version)}', action, ''))
+    
+    return matches
+
+def compile_custom_rule(rule_id, rule_data):
+    """Compile a custom rule into nft script lines (empty list if invalid)"""
+    lines = []
+    schedule = schedule_match(schedule_windows(rule_schedule(rule_data)))
+    for chain, interface, proto, ports, source, action, suffix in custom_rule_matches(rule_id, rule_data):
+        # Ranges and lists become one anonymous interval set, not a rule per port
+        if len(ports) == 1 and ports[0][0] == ports[0][1]:
+            match = f'{proto} dport {ports[0][0]}'
+        else:
+            match = f"{proto} dport {{ {', '.join(_port_text(port_range) for port_range in ports)} }}"
+        if interface:
+            match = f'{"oifname" if chain == "output" else "iifname"} "{interface}" {match}'
+        if source:
+            match = f'{match} {"ip6" if source.endswith("_v6") else "ip"} saddr {source}'
+        lines.append(f'add rule inet filter {chain} {match} {schedule}counter {action} comment "Custom Rule {rule_id}{suffix}"')
+    return lines
+
+def compile_custom_rules(rules):
+    """Compile custom rule rows into a single nft script"""
+    lines = []
+    for rule in rules:
+        lines.extend(compile_custom_rule(rule['id'], rule))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+class NftError(Exception):
+    """nft rejected a script - raised inside db_transaction() to roll it back"""
+
+def run_nft_script(script, echo=False):
+    """Apply an nft script as one transaction - every line applies or none do
+    
+    With echo=True nft prints every added object back with its handle.
+    """
+    return nft_executor().run(script, echo=echo)
 
 def apply_custom_rule(rule_id, rule_data):
     """Apply custom rule to nftables"""
     try:
-        port = rule_data.get('port')
-        protocol = (rule_data.get('protocol') or 'TCP').lower()
-        action = (rule_data.get('action') or 'ACCEPT').lower()
-        
-        # Get access flags (support both camelCase and snake_case)
-        access_lan = rule_data.get('accessLan') or rule_data.get('access_lan') or 0
-        access_tailnet = rule_data.get('accessTailnet') or rule_data.get('access_tailnet') or 0
-        access_wan = rule_data.get('accessWan') or rule_data.get('access_wan') or 0
-        
-        # Debug logging
-        print(f"Applying rule {rule_id}: port={port}, proto={protocol}, action={action}")
-        print(f"  Access: LAN={access_lan}, Tailnet={access_tailnet}, WAN={access_wan}")
+        logger.debug(f"Applying rule {rule_id}", extra={'port': rule_data.get('port'), 'protocol': rule_data.get('protocol'), 'action': rule_data.get('action')})
         
-        # Validate required fields
-        if not port:
-            print(f"✗ Rule {rule_id}: Missing port")
+        lines = compile_custom_rule(rule_id, rule_data)
+        if not lines:
             return False
-            
-        if not access_lan and not access_tailnet and not access_wan:
-            print(f"✗ Rule {rule_id}: No access sources selected")
+        
+        result = run_nft_script('\n'.join(anchor_custom_rules(lines)) + '\n', echo=True)
+        if not result['success']:
+            logger.error(f"Failed to apply rule {rule_id}: {result['error']}")
             return False
         
-        # Determine protocol(s)
-        protocols = []
-        if protocol == 'both':
-            protocols = ['tcp', 'udp']
-        else:
-            protocols = [protocol]
-        
-        # Add rules for each access point
-        for proto in protocols:
-            if access_lan:
-                # LAN access - INPUT chain (traffic TO firewall)
-                result = subprocess.run([
-                    'nft', 'add', 'rule', 'inet', 'filter', 'input',
-                    'iifname', 'br0', proto, 'dport', str(port),
-                    'counter', action,
-                    'comment', f'"Custom Rule {rule_id}"'
-                ], capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    print(f"✗ Failed to add INPUT rule: {result.stderr}")
-                else:
-                    print(f"✓ Added INPUT rule for port {port}/{proto}")
-                
-                # If blocking, also add FORWARD rule (LAN -> Internet)
-                if action == 'drop':
-                    subprocess.run([
-                        'nft', 'add', 'rule', 'inet', 'filter', 'forward',
-                        'iifname', 'br0', proto, 'dport', str(port),
-                        'counter', 'drop',
-                        'comment', f'"Custom Rule {rule_id} Forward"'
-                    ], check=False)
-                    
-                    # Also block in OUTPUT chain (firewall itself)
-                    result = subprocess.run([
-                        'nft', 'add', 'rule', 'inet', 'filter', 'output',
-                        'oifname', 'eth1', proto, 'dport', str(port),
-                        'counter', 'drop',
-                        'comment', f'"Custom Rule {rule_id} Output"'
-                    ], capture_output=True, text=True)
-                    
-                    if result.returncode != 0:
-                        print(f"✗ Failed to add OUTPUT rule: {result.stderr}")
-            
-            if access_tailnet:
-                # Tailscale access - INPUT chain
-                result = subprocess.run([
-                    'nft', 'add', 'rule', 'inet', 'filter', 'input',
-                    proto, 'dport', str(port), 'ip', 'saddr', '100.64.0.0/10',
-                    'counter', action,
-                    'comment', f'"Custom Rule {rule_id}"'
-                ], capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    print(f"✗ Failed to add Tailnet rule: {result.stderr}")
-                else:
-                    print(f"✓ Added Tailnet rule for port {port}/{proto}")
-            
-            if access_wan:
-                # WAN access - INPUT chain (incoming from internet)
-                result = subprocess.run([
-                    'nft', 'add', 'rule', 'inet', 'filter', 'input',
-                    'iifname', 'eth1', proto, 'dport', str(port),
-                    'counter', action,
-                    'comment', f'"Custom Rule {rule_id}"'
-                ], capture_output=True, text=True)
-                
-                if result.returncode != 0:
-                    print(f"✗ Failed to add WAN rule: {result.stderr}")
-                else:
-                    print(f"✓ Added WAN rule for port {port}/{proto}")
-        
-        print(f"✓ Successfully applied rule {rule_id}")
+        record_rule_handles(parse_echoed_handles(result['output']))
+        
+        logger.info(f"Applied rule {rule_id}", extra={'nft_rules': len(lines)})
         return True
     except Exception as e:
-        print(f"✗ Error applying custom rule: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error applying custom rule: {e}")
         return False
 
-def remove_custom_rule(rule_data):
-    """Remove custom rule from nftables"""
-    try:
-        rule_id = rule_data.get('id')
-        print(f"Removing rule {rule_id} from nftables")
-        
-        removed_count = 0
-        
-        # Delete rules from INPUT chain
-        result = subprocess.run([
-            'nft', '-a', 'list', 'chain', 'inet', 'filter', 'input'
-        ], capture_output=True, text=True)
-        
-        for line in result.stdout.split('\n'):
-            if f'Custom Rule {rule_id}' in line:
-                if '# handle' in line:
-                    handle = line.split('# handle')[-1].strip()
-                    result = subprocess.run([
-                        'nft', 'delete', 'rule', 'inet', 'filter', 'input',
-                        'handle', handle
-                    ], capture_output=True, text=True)
-                    if result.returncode == 0:
-                        removed_count += 1
-                        print(f"  ✓ Removed INPUT rule (handle {handle})")
-        
-        # Delete rules from FORWARD chain
-        result = subprocess.run([
-            'nft', '-a', 'list', 'chain', 'inet', 'filter', 'forward'
-        ], capture_output=True, text=True)
-        
-        for line in result.stdout.split('\n'):
-            if f'Custom Rule {rule_id}' in line:
-                if '# handle' in line:
-                    handle = line.split('# handle')[-1].strip()
-                    result = subprocess.run([
-                        'nft', 'delete', 'rule', 'inet', 'filter', 'forward',
-                        'handle', handle
-                    ], capture_output=True, text=True)
-                    if result.returncode == 0:
-                        removed_count += 1
-                        print(f"  ✓ Removed FORWARD rule (handle {handle})")
-        
-        # Delete rules from OUTPUT chain
-        result = subprocess.run([
-            'nft', '-a', 'list', 'chain', 'inet', 'filter', 'output'
-        ], capture_output=True, text=True)
-        
-        for line in result.stdout.split('\n'):
-            if f'Custom Rule {rule_id}' in line:
-                if '# handle' in line:
-                    handle = line.split('# handle')[-1].strip()
-                    result = subprocess.run([
-                        'nft', 'delete', 'rule', 'inet', 'filter', 'output',
-                        'handle', handle
-                    ], capture_output=True, text=True)
-                    if result.returncode == 0:
-                        removed_count += 1
-                        print(f"  ✓ Removed OUTPUT rule (handle {handle})")
-        
-        print(f"✓ Removed {removed_count} nftables rules for rule {rule_id}")
-        return True
-    except Exception as e:
-        print(f"✗ Error removing custom rule: {e}")
-        import traceback
-        traceback.print_exc()
+def apply_custom_rules(rules):
+    """Apply several custom rules in one nft transaction, returns number applied"""
+    valid = [rule for rule in rules if compile_custom_rule(rule['id'], rule)]
+    if not valid:
+        return 0
+    
+    linear = valid
+    applied = len(valid)
+    if NFT_COMPILED_RULES:
+        applied -= len(sync_custom_rule_elements({rule['id'] for rule in valid}))
+        # Scheduled rules are not map elements - they stay linear rules
+        linear = [rule for rule in valid if rule_schedule(rule)]
+        if not linear:
+            return applied
+    
+    script = ''.join(line + '\n' for line in anchor_custom_rules(compile_custom_rules(linear).splitlines()))
+    result = run_nft_script(script, echo=True)
+    if result['success']:
+        record_rule_handles(parse_echoed_handles(result['output']))
+        return applied
+    
+    # One bad rule rejects the whole batch - retry individually to isolate it
+    logger.warning(f"Batch apply failed, retrying rules one by one: {result['error']}")
+    return applied - len(linear) + sum(1 for rule in linear if apply_custom_rule(rule['id'], rule))
+
+# ==================== CUSTOM RULE HANDLE INDEX ====================
+#
+# rule_id -> [(chain, handle)] for every nft rule a custom rule installed.
+# Kept in memory and mirrored to the custom_rule_handles table so removal is
+# a single batched 'delete rule ... handle N' instead of listing chains.
+
+CUSTOM_RULE_CHAINS = ('input', 'forward', 'output')
+CUSTOM_RULE_COMMENT = re.compile(r'^Custom Rule (\d+)(?: Forward| Output)?$')
+COMPILED_RULE_CHAIN = re.compile(r'^add rule inet filter (\S+) ')
+ECHOED_RULE = re.compile(r'^(?:add|insert) rule inet filter (\S+) .*comment "([^"]*)" # handle (\d+)$')
+
+_rule_handles = None
+_rule_handles_lock = threading.Lock()
+_custom_rule_anchors = None
+
+def _load_rule_handles():
+    """Load the handle index from the database (caller holds the lock)"""
+    global _rule_handles
+    if _rule_handles is None:
+        _rule_handles = {}
+        rows = get_db().execute('SELECT rule_id, chain, handle FROM custom_rule_handles').fetchall()
+        for row in rows:
+            _rule_handles.setdefault(row['rule_id'], []).append((row['chain'], row['handle']))
+    return _rule_handles
+
+def parse_echoed_handles(output):
+    """Extract {rule_id: [(chain, handle)]} from 'nft --echo --handle' output"""
+    handles = {}
+    for line in output.splitlines():
+        match = ECHOED_RULE.match(line.strip())
+        if not match:
+            continue
+        comment = CUSTOM_RULE_COMMENT.match(match.group(2))
+        if comment:
+            handles.setdefault(int(comment.group(1)), []).append((match.group(1), int(match.group(3))))
+    return handles
+
+def record_rule_handles(handles):
+    """Add newly installed rule handles to the index"""
+    if not handles:
+        return
+    with _rule_handles_lock:
+        index = _load_rule_handles()
+        with db_transaction() as conn:
+            for rule_id, entries in handles.items():
+                index.setdefault(rule_id, []).extend(entries)
+                conn.executemany(
+                    'INSERT OR REPLACE INTO custom_rule_handles (rule_id, chain, handle) VALUES (?, ?, ?)',
+                    [(rule_id, chain, handle) for chain, handle in entries]
+                )
+
+def forget_rule_handles(rule_id=None):
+    """Drop index entries for one rule, or all of them (e.g. after a ruleset reload)"""
+    global _custom_rule_anchors
+    with _rule_handles_lock:
+        index = _load_rule_handles()
+        with db_transaction() as conn:
+            if rule_id is None:
+                index.clear()
+                _custom_rule_anchors = None
+                conn.execute('DELETE FROM custom_rule_handles')
+            else:
+                index.pop(rule_id, None)
+                conn.execute('DELETE FROM custom_rule_handles WHERE rule_id = ?', (rule_id,))
+
+def sync_rule_handles():
+    """Rebuild the handle index from the live ruleset (one JSON listing)"""
+    result = nft_executor().run('list table inet filter', json_output=True)
+    if not result['success']:
+        logger.error(f"Could not list ruleset for handle resync: {result['error']}")
         return False
+    
+    handles = {}
+    for item in json.loads(result['output']).get('nftables', []):
+        rule = item.get('rule')
+        if not rule or rule.get('chain') not in CUSTOM_RULE_CHAINS:
+            continue
+        comment = CUSTOM_RULE_COMMENT.match(rule.get('comment', ''))
+        if comment:
+            handles.setdefault(int(comment.group(1)), []).append((rule['chain'], rule['handle']))
+    
+    forget_rule_handles()
+    record_rule_handles(handles)
+    remember_custom_rule_anchors(json.loads(result['output']).get('nftables', []))
+    logger.info("Resynced handle index", extra={'rules': sum(len(v) for v in handles.values())})
+    return True
+
+def custom_rule_anchors(ruleset):
+    """{chain: handle} of the anchor rules the template renders at @custom-rules"""
+    return {rule['chain']: rule['handle'] for rule in _live_objects(ruleset, 'rule')
+            if rule.get('comment') == CUSTOM_RULES_ANCHOR and rule.get('chain') in CUSTOM_RULE_CHAINS}
+
+def remember_custom_rule_anchors(ruleset):
+    global _custom_rule_anchors
+    with _rule_handles_lock:
+        _custom_rule_anchors = custom_rule_anchors(ruleset)
+
+def live_custom_rule_anchors():
+    """Cached anchor handles, listed once after each reload"""
+    with _rule_handles_lock:
+        anchors = _custom_rule_anchors
+    if anchors is None:
+        ruleset = list_live_ruleset()
+        if ruleset is None:
+            return {}
+        remember_custom_rule_anchors(ruleset)
+        anchors = custom_rule_anchors(ruleset)
+    return anchors
+
+def anchor_custom_rules(lines, anchors=None):
+    """Turn compiled 'add rule' lines into inserts before their chain's anchor rule
+    
+    Appended rules would land after the chains' final verdicts (input's
+    log_drop jump, forward's LAN -> WAN accept) and never match. Inserting
+    before the anchor keeps rule id order. Chains without an anchor (an
+    older template) still append.
+    """
+    if anchors is None:
+        anchors = live_custom_rule_anchors()
+    out = []
+    for line in lines:
+        match = COMPILED_RULE_CHAIN.match(line)
+        if match and match.group(1) in anchors:
+            line = f'insert rule inet filter {match.group(1)} position {anchors[match.group(1)]} {line[match.end():]}'
+        out.append(line)
+    return out
+
+def _delete_handles_script(entries):
+    return ''.join(f'delete rule inet filter {chain} handle {handle}\n' for chain, handle in entries)
+
+def sync_custom_rules(rule_ids):
+    """Replace the live rules of the given custom rules with their database state
+    
+    Deleted and disabled rules are only removed. All deletes and adds go in
+    one nft transaction. Returns the set of rule ids that could not be applied.
+    """
+    rule_ids = set(rule_ids)
+    placeholders = ', '.join('?' * len(rule_ids))
+    rules = get_db().execute(
+        f'SELECT * FROM custom_rules WHERE enabled = 1 AND id IN ({placeholders})',
+        tuple(rule_ids)
+    ).fetchall()
+    
+    failed = set()
+    if NFT_COMPILED_RULES:
+        # Maps for unscheduled rules; scheduled ones stay linear (and may have moved either way)
+        failed = sync_custom_rule_elements(rule_ids)
+        rules = [rule for rule in rules if rule_schedule(dict(rule))]
+    
+    adds = []
+    for rule in rules:
+        lines = compile_custom_rule(rule['id'], dict(rule))
+        if not lines:
+            failed.add(rule['id'])
+        adds.extend(lines)
+    
+    for attempt in range(2):
+        with _rule_handles_lock:
+            index = _load_rule_handles()
+            entries = [entry for rule_id in rule_ids for entry in index.get(rule_id, [])]
+        script = _delete_handles_script(entries) + ''.join(line + '\n' for line in anchor_custom_rules(adds))
+        if not script:
+            return failed
+        
+        result = run_nft_script(script, echo=True)
+        if result['success']:
+            break
+        
+        # Index is stale (ruleset reloaded, rules removed by hand) - resync and retry once
+        logger.error(f"Custom rule sync failed: {result['error'].strip()}", extra={'rule_ids': sorted(rule_ids)})
+        if attempt or not sync_rule_handles():
+            return rule_ids
+    
+    for rule_id in rule_ids:
+        forget_rule_handles(rule_id)
+    record_rule_handles(parse_echoed_handles(result['output']))
+    logger.info("Synced custom rules", extra={'rule_ids': sorted(rule_ids), 'deleted': len(entries), 'added': len(adds)})
+    return failed
 
 def restore_custom_rules():
     """Restore all enabled custom rules from database on startup"""
     try:
-        print("=" * 60)
-        print("RESTORING CUSTOM RULES FROM DATABASE")
-        print("=" * 60)
+        logger.info("Restoring custom rules from database")
         
         conn = get_db()
         rules = conn.execute(
             'SELECT * FROM custom_rules WHERE enabled = 1'
         ).fetchall()
         
-        print(f"Found {len(rules)} enabled custom rules in database")
+        logger.debug("Found enabled custom rules in database", extra={'rules': len(rules)})
         
-        count = 0
-        for rule in rules:
-            rule_dict = dict(rule)
-            print(f"\nRestoring rule {rule['id']}: {rule_dict['name']}")
-            if apply_custom_rule(rule['id'], rule_dict):
-                count += 1
-            else:
-                print(f"  ✗ Failed to restore rule {rule['id']}")
+        count = apply_custom_rules([dict(rule) for rule in rules])
         
-        conn.close()
-        print("=" * 60)
-        print(f"✓ Successfully restored {count}/{len(rules)} custom firewall rules")
-        print("=" * 60)
+        logger.info(f"Restored {count}/{len(rules)} custom firewall rules")
         return count
     except Exception as e:
-        print(f"✗ Error restoring custom rules: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"⚠ Error restoring custom rules: {e}")
+        logger.exception(f"Error restoring custom rules: {e}")
         return 0
 
-if __name__ == '__main__':
-    print("=" * 50)
-    print("SEER Firewall API Starting...")
-    print("=" * 50)
+# ==================== COMPILED CUSTOM RULES ====================
+#
+# In compiled mode (NFT_COMPILED_RULES) custom rules are elements of
+# concatenated-set verdict maps looked up at the template's @custom-rules
+# anchors, so a packet costs the same few lookups however many rules
+# exist, and adding or removing a rule is an element add/delete.
+#
+# The linear form is first-match-wins in rule id order. Within a map the
+# lowest rule id claims a key. A packet can only hit both input maps when
+# it arrives on LAN/WAN from a source in a rule's network; where the two
+# verdicts differ and the source rule came first, the overlap map (looked
+# up first) carries the linear verdict for exactly that intersection.
+#
+# Scheduled rules stay linear rules (with an anonymous day/hour set),
+# inserted before the anchor rule that ends each @custom-rules section, so
+# after the maps; overlapping ports on one path are refused, so order is moot.
+#
+# Rules sourced from an address group are keyed on proto/port in the
+# group's own map, reached from the custom_groups chain after a single
+# set lookup on the group; that chain is jumped to before the other maps.
+
+# name -> (chain, typeof key); lookups run in this order. Every map is an
+# interval map - port ranges are single elements
+CUSTOM_RULE_MAPS = OrderedDict([
+    ('custom_input_overlap', ('input', 'iifname . meta l4proto . th dport . ip saddr')),
+    ('custom_input_ports', ('input', 'iifname . meta l4proto . th dport')),
+    ('custom_input_sources', ('input', 'meta l4proto . th dport . ip saddr')),
+    ('custom_forward', ('forward', 'iifname . meta l4proto . th dport')),
+    ('custom_output', ('output', 'oifname . meta l4proto . th dport')),
+])
+CUSTOM_REJECT_CHAIN = 'custom_reject'
+CUSTOM_GROUPS_CHAIN = 'custom_groups'
+GROUP_MAP_SPEC = ('input', 'meta l4proto . th dport')
+
+_custom_rule_elements = None
+_custom_rule_elements_lock = threading.Lock()
+
+def custom_rule_lookups(chain):
+    """The vmap rules rendered at a chain's @custom-rules anchor"""
+    lookups = [f'jump {CUSTOM_GROUPS_CHAIN}'] if chain == 'input' else []
+    return lookups + [f'{key} vmap @{name}' for name, (map_chain, key) in CUSTOM_RULE_MAPS.items() if map_chain == chain]
+
+def _map_spec(name):
+    """(chain, typeof key) of a static map or an address group's port map"""
+    return CUSTOM_RULE_MAPS.get(name, GROUP_MAP_SPEC)
+
+def _element_key(name, *values):
+    """Element key text for a map - interface names are quoted, everything else as is"""
+    fields = _map_spec(name)[1].split(' . ')
+    return ' . '.join(f'"{value}"' if field.endswith('ifname') else str(value) for field, value in zip(fields, values))
+
+def compile_custom_rule_elements(rules):
+    """{map: {key: (verdict, rule_id)}} for enabled custom rules, first rule id wins a port"""
+    elements = {name: {} for name in CUSTOM_RULE_MAPS}
+    claimed = {}
+    sources = {}
+    ports = []
+    for rule in sorted(rules, key=lambda rule: rule['id']):
+        if rule_schedule(rule):
+            continue  # installed as a linear rule carrying its schedule
+        for chain, interface, proto, port_ranges, source, action, _ in custom_rule_matches(rule['id'], rule):
+            verdict = f'jump {CUSTOM_REJECT_CHAIN}' if action == 'reject' else action
+            if chain != 'input':
+                name, values = f'custom_{chain}', lambda port: (interface, proto, port)
+            elif source and source.startswith('@'):
+                name, values = address_group_map(source), lambda port: (proto, port)
+            elif source:
+                source = ipaddress.ip_network(source, strict=False).with_prefixlen
+                name, values = 'custom_input_sources', lambda port: (proto, port, source)
+            else:
+                name, values = 'custom_input_ports', lambda port: (interface, proto, port)
+            
+            # Interval map elements must not overlap - ports an earlier rule claimed stay with it
+            taken = claimed.setdefault((name, values(None)), [])
+            free = _subtract_ranges(port_ranges, taken)
+            if not free:
+                continue
+            taken[:] = _merge_ranges(taken + free)
+            for port_range in free:
+                key = _element_key(name, *values(_port_text(port_range)))
+                elements.setdefault(name, {})[key] = (verdict, rule['id'])
+            if name == 'custom_input_sources':
+                sources.setdefault(proto, []).append((source, free, verdict, rule['id']))
+            elif name == 'custom_input_ports':
+                ports.append((interface, proto, free, verdict, rule['id']))
+    
+    # Interface rules that the linear form only reaches after an earlier source rule
+    for interface, proto, port_ranges, verdict, rule_id in ports:
+        for source, source_ranges, source_verdict, source_rule in sources.get(proto, ()):
+            if source_rule < rule_id and source_verdict != verdict:
+                for port_range in _intersect_ranges(port_ranges, source_ranges):
+                    key = _element_key('custom_input_overlap', interface, proto, _port_text(port_range), source)
+                    elements['custom_input_overlap'].setdefault(key, (source_verdict, source_rule))
+    return elements
+
+def _enabled_custom_rules():
+    return [dict(row) for row in get_db().execute('SELECT * FROM custom_rules WHERE enabled = 1').fetchall()]
+
+def _json_key_text(name, value):
+    """Element key text for a map from its nft JSON form (same text as _element_key)"""
+    values = value['concat'] if isinstance(value, dict) and 'concat' in value else [value]
+    fields = _map_spec(name)[1].split(' . ')
+    text = []
+    for field, value in zip(fields, values):
+        if isinstance(value, dict) and 'range' in value:
+            value = _port_text(tuple(value['range']))
+        elif field.endswith('saddr'):
+            value = _json_element_text(value)
+            value = ipaddress.ip_network(value, strict=False).with_prefixlen if value else None
+        text.append(f'"{value}"' if field.endswith('ifname') else str(value))
+    return ' . '.join(text)
+
+def _json_verdict_text(verdict):
+    if isinstance(verdict, dict) and len(verdict) == 1:
+        name, target = next(iter(verdict.items()))
+        return f"{name} {target['target']}" if isinstance(target, dict) else name
+    return None
+
+def live_custom_rule_elements(ruleset):
+    """{map: {key: (verdict, packets, bytes)}} from a live ruleset listing, None if a map is missing"""
+    live = {}
+    for live_map in _live_objects(ruleset, 'map'):
+        if live_map['name'] not in CUSTOM_RULE_MAPS and not ADDRESS_GROUP_MAP.match(live_map['name']):
+            continue
+        entries = live[live_map['name']] = {}
+        for key, verdict in live_map.get('elem', []):
+            counter = {}
+            if isinstance(key, dict) and 'elem' in key:
+                counter = key['elem'].get('counter', {})
+                key = key['elem']['val']
+            entries[_json_key_text(live_map['name'], key)] = (_json_verdict_text(verdict), counter.get('packets', 0), counter.get('bytes', 0))
+    return live if all(name in live for name in CUSTOM_RULE_MAPS) else None
+
+def remember_custom_rule_elements(elements):
+    """Cache the live {map: {key: verdict}} state (None = unknown, list it next time)"""
+    global _custom_rule_elements
+    with _custom_rule_elements_lock:
+        _custom_rule_elements = elements
+
+def forget_custom_rule_elements():
+    """Drop the cached live elements (the ruleset was reloaded)"""
+    remember_custom_rule_elements(None)
+
+def custom_rule_element_script(current, wanted):
+    """nft lines turning the current {map: {key: verdict}} into wanted"""
+    lines = []
+    group_maps = sorted((set(current) | set(wanted)) - set(CUSTOM_RULE_MAPS))
+    for name in list(CUSTOM_RULE_MAPS) + group_maps:
+        have, want = current.get(name, {}), wanted.get(name, {})
+        stale = [key for key, verdict in have.items() if want.get(key) != verdict]
+        added = [f'{key} : {verdict}' for key, verdict in want.items() if have.get(key) != verdict]
+        if stale:
+            lines.append(f"delete element inet filter {name} {{ {', '.join(stale)} }}")
+        if added:
+            lines.append(f"add element inet filter {name} {{ {', '.join(added)} }}")
+    return lines
+
+def sync_custom_rule_elements(rule_ids):
+    """Bring the verdict maps in line with custom_rules using only element adds/deletes
+    
+    Every enabled rule is compiled (a removed rule can uncover another
+    rule's key), but only changed elements reach nft. Returns the set of
+    rule ids that could not be applied.
+    """
+    rules = _enabled_custom_rules()
+    failed = {rule['id'] for rule in rules if rule['id'] in rule_ids and not custom_rule_matches(rule['id'], rule)}
+    wanted = {name: {key: verdict for key, (verdict, _) in entries.items()}
+              for name, entries in compile_custom_rule_elements(rules).items()}
+    
+    for attempt in range(2):
+        with _custom_rule_elements_lock:
+            current = _custom_rule_elements
+        if current is None:
+            live = live_custom_rule_elements(list_live_ruleset() or [])
+            if live is None:
+                logger.error("Live ruleset has no custom rule maps - reconcile to reload it")
+                return set(rule_ids)
+            current = {name: {key: entry[0] for key, entry in entries.items()} for name, entries in live.items()}
+        
+        lines = custom_rule_element_script(current, wanted)
+        if not lines:
+            break
+        result = run_nft_script('\n'.join(lines) + '\n')
+        if result['success']:
+            break
+        
+        # Cache is stale (elements changed by hand) - re-list and retry once
+        logger.error(f"Custom rule element sync failed: {result['error'].strip()}", extra={'rule_ids': sorted(rule_ids)})
+        forget_custom_rule_elements()
+        if attempt:
+            return set(rule_ids)
+    
+    remember_custom_rule_elements(wanted)
+    logger.info("Synced custom rules", extra={'rule_ids': sorted(rule_ids), 'element_updates': sum(len(line.split(', ')) for line in lines)})
+    return failed
+
+def _diff_custom_rule_elements(ruleset, conn, report, lines):
+    """Queue element updates so the verdict maps match custom_rules; returns the wanted elements"""
+    rules = [dict(row) for row in conn.execute('SELECT * FROM custom_rules WHERE enabled = 1').fetchall()]
+    compiled = compile_custom_rule_elements(rules)
+    wanted = {name: {key: verdict for key, (verdict, _) in entries.items()} for name, entries in compiled.items()}
+    live = live_custom_rule_elements(ruleset) or {}
+    current = {name: {key: entry[0] for key, entry in entries.items()} for name, entries in live.items()}
+    
+    for name, entries in compiled.items():
+        for key, (verdict, rule_id) in entries.items():
+            if current.get(name, {}).get(key) != verdict and rule_id not in report['custom_rules']['missing']:
+                report['custom_rules']['missing'].append(rule_id)
+    report['custom_rules']['extra_elements'] = sum(
+        1 for name, entries in current.items() for key in entries if key not in wanted.get(name, {}))
+    lines.extend(custom_rule_element_script(current, wanted))
+    return wanted
+
+def custom_rule_element_counters(ruleset, rules):
+    """Sum verdict map element counters per (custom rule id, chain)"""
+    totals = {}
+    live = live_custom_rule_elements(ruleset)
+    if live is None:
+        return totals
+    for name, entries in compile_custom_rule_elements(rules).items():
+        chain = _map_spec(name)[0]
+        for key, (verdict, rule_id) in entries.items():
+            if key in live.get(name, {}):
+                _, packets, nbytes = live[name][key]
+                total = totals.get((rule_id, chain), (0, 0))
+                totals[(rule_id, chain)] = (total[0] + packets, total[1] + nbytes)
+    return totals
+
+# ==================== ADDRESS GROUPS ====================
+#
+# A group is a pair of interval sets (group_<id>_v4/_v6) kept in line with
+# address_group_members. Rules match a group with one set lookup, so
+# membership changes are element adds/deletes that never touch the rules
+# using it. Members are collapsed before they reach nft - interval sets
+# reject overlapping elements.
+
+ADDRESS_GROUP_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+ADDRESS_GROUP_SET = re.compile(r'^@?group_(\d+)_v[46]$')
+ADDRESS_GROUP_MAP = re.compile(r'^group_(\d+)_ports$')
+
+def address_group_set(group_id, version):
+    return f'group_{group_id}_v{version}'
+
+def address_group_map(group):
+    """Port verdict map of a group, by id or by one of its set references"""
+    if isinstance(group, str):
+        group = ADDRESS_GROUP_SET.match(group).group(1)
+    return f'group_{group}_ports'
+
+def address_group_lookups(groups):
+    """custom_groups chain: one set lookup per group and family, then the group's port map"""
+    lookups = []
+    for group_id in groups:
+        for version, family in ((4, 'ip'), (6, 'ip6')):
+            lookups.append(f'{family} saddr @{address_group_set(group_id, version)} '
+                           f'{GROUP_MAP_SPEC[1]} vmap @{address_group_map(group_id)}')
+    return lookups
+
+def load_address_group_ids(conn=None):
+    return [row['id'] for row in (conn or get_db()).execute('SELECT id FROM address_groups ORDER BY id').fetchall()]
+
+def load_address_group_members(conn, group_id=None):
+    """{group id: set of member networks}, for one group or all of them"""
+    query = 'SELECT group_id, address FROM address_group_members'
+    rows = conn.execute(query + ' WHERE group_id = ?', (group_id,)) if group_id is not None else conn.execute(query)
+    members = {}
+    for row in rows.fetchall():
+        networks, _ = parse_blacklist_entries([row['address']])
+        members.setdefault(row['group_id'], set()).update(networks)
+    return members
+
+def address_group_elements(group_id, networks):
+    """{set name: element texts} - members collapsed so the interval sets accept them"""
+    elements = {}
+    for version in (4, 6):
+        collapsed = ipaddress.collapse_addresses(net for net in networks if net.version == version)
+        elements[address_group_set(group_id, version)] = {_blacklist_entry(net) for net in collapsed}
+    return elements
+
+def address_group_element_script(current, wanted):
+    """nft lines turning the current {set: elements} into wanted, chunked like bulk imports"""
+    lines = []
+    for set_name in sorted(set(current) | set(wanted)):
+        have, want = current.get(set_name, set()), wanted.get(set_name, set())
+        for op, entries in (('delete', sorted(have - want)), ('add', sorted(want - have))):
+            for i in range(0, len(entries), BLACKLIST_CHUNK_SIZE):
+                lines.append(f"{op} element inet filter {set_name} {{ {', '.join(entries[i:i + BLACKLIST_CHUNK_SIZE])} }}")
+    return lines
+
+def address_group_layout_script(live, groups, rewrite_chain):
+    """(before, after) nft lines creating and removing group sets, maps and lookups
+    
+    Creation has to precede the element updates that fill a new group and
+    removal has to follow the ones that empty an old group's port map.
+    """
+    before, after = [], []
+    for group_id in groups:
+        if group_id in live:
+            continue
+        for version, addr_type in ((4, 'ipv4_addr'), (6, 'ipv6_addr')):
+            before.append(f'add set inet filter {address_group_set(group_id, version)} {{ type {addr_type}; flags interval; }}')
+        if NFT_COMPILED_RULES:
+            before.append(f'add map inet filter {address_group_map(group_id)} '
+                          f'{{ typeof {GROUP_MAP_SPEC[1]} : verdict; flags interval; counter; }}')
+    if NFT_COMPILED_RULES and rewrite_chain:
+        before.append(f'flush chain inet filter {CUSTOM_GROUPS_CHAIN}')
+        before.extend(f'add rule inet filter {CUSTOM_GROUPS_CHAIN} {rule}' for rule in address_group_lookups(groups))
+    for group_id in sorted(set(live) - set(groups)):
+        if NFT_COMPILED_RULES:
+            after.append(f'delete map inet filter {address_group_map(group_id)}')
+        after.extend(f'delete set inet filter {address_group_set(group_id, version)}' for version in (4, 6))
+    return before, after
+
+def _diff_address_groups(ruleset, conn, report, lines):
+    """Queue layout changes and element updates so the group sets match address_groups"""
+    groups = load_address_group_ids(conn)
+    live = {}
+    for live_set in _live_objects(ruleset, 'set'):
+        group = ADDRESS_GROUP_SET.match(live_set['name'])
+        if not group:
+            continue
+        entries = live.setdefault(int(group.group(1)), {}).setdefault(live_set['name'], set())
+        for elem in live_set.get('elem', []):
+            text = _json_element_text(elem['elem']['val'] if isinstance(elem, dict) and 'elem' in elem else elem)
+            if text:
+                entries.add(text)
+    lookups = [rule for rule in _live_objects(ruleset, 'rule') if rule.get('chain') == CUSTOM_GROUPS_CHAIN]
+    
+    before, after = address_group_layout_script(
+        live, groups, sorted(live) != groups or len(lookups) != len(address_group_lookups(groups)))
+    members = load_address_group_members(conn)
+    elements = []
+    missing = extra = 0
+    for group_id in groups:
+        current = live.get(group_id, {})
+        wanted = address_group_elements(group_id, members.get(group_id, set()))
+        missing += sum(len(entries - current.get(name, set())) for name, entries in wanted.items())
+        extra += sum(len(entries - wanted.get(name, set())) for name, entries in current.items())
+        elements.extend(address_group_element_script(current, wanted))
+    
+    report['address_groups'] = {
+        'created': [group_id for group_id in groups if group_id not in live],
+        'removed': sorted(set(live) - set(groups)),
+        'missing': missing,
+        'extra': extra,
+    }
+    lines[:0] = before + elements
+    lines.extend(after)
+
+def update_address_group_members(group_id, add=(), remove=(), replace=None, action='Update address group members'):
+    """Change a group's members and its set elements in one transaction (nft errors roll back)"""
+    with db_transaction() as conn:
+        if not conn.execute('SELECT 1 FROM address_groups WHERE id = ?', (group_id,)).fetchone():
+            raise ValueError(f'Address group {group_id} not found')
+        current = load_address_group_members(conn, group_id).get(group_id, set())
+        members = set(replace) if replace is not None else (current - set(remove)) | set(add)
+        if len(members) > ADDRESS_GROUP_MAX_MEMBERS:
+            raise ValueError(f'An address group holds at most {ADDRESS_GROUP_MAX_MEMBERS} members')
+        
+        lines = address_group_element_script(address_group_elements(group_id, current),
+                                             address_group_elements(group_id, members))
+        conn.executemany('DELETE FROM address_group_members WHERE group_id = ? AND address = ?',
+                         [(group_id, _blacklist_entry(net)) for net in current - members])
+        conn.executemany('INSERT INTO address_group_members (group_id, address) VALUES (?, ?)',
+                         [(group_id, _blacklist_entry(net)) for net in members - current])
+        conn.execute('UPDATE address_groups SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (group_id,))
+        summary = {
+            'group_id': group_id,
+            'members': len(members),
+            'added': len(members - current),
+            'removed': len(current - members),
+            'element_updates': sum(len(line.split(', ')) for line in lines),
+        }
+        
+        if lines:
+            result = run_nft_script('\n'.join(lines) + '\n')
+            if not result['success']:
+                raise NftError(f"Failed to update address group sets: {result['error'].strip()}")
+    
+    record_audit(action, summary)
+    return summary
+
+def parse_address_group(data, conn, group_id=None):
+    """Validated (name, description, members or None) from a request body"""
+    name = str(data.get('name', '')).strip()
+    if not ADDRESS_GROUP_NAME.match(name):
+        raise ValueError('name must be 1-64 letters, digits, dots, dashes or underscores')
+    clash = conn.execute('SELECT id FROM address_groups WHERE name = ?', (name,)).fetchone()
+    if clash and clash['id'] != group_id:
+        raise ValueError(f'An address group named {name} already exists')
+    
+    members = None
+    if 'members' in data:
+        if not isinstance(data['members'], list):
+            raise ValueError('members must be a list of IPs/CIDRs')
+        members, rejected = parse_blacklist_entries(data['members'])
+        if rejected:
+            raise ValueError(f"Invalid members: {', '.join(rejected[:10])}")
+        if len(members) > ADDRESS_GROUP_MAX_MEMBERS:
+            raise ValueError(f'An address group holds at most {ADDRESS_GROUP_MAX_MEMBERS} members')
+    return name, str(data.get('description', '')), members
+
+@app.route('/api/address-groups', methods=['GET'])
+def get_address_groups():
+    """List address groups with member and rule counts"""
+    rows = get_db().execute('''
+        SELECT g.*,
+               (SELECT COUNT(*) FROM address_group_members m WHERE m.group_id = g.id) AS member_count,
+               (SELECT COUNT(*) FROM custom_rules r WHERE r.source_group_id = g.id) AS rule_count
+        FROM address_groups g ORDER BY g.id
+    ''').fetchall()
+    return jsonify({'success': True, 'groups': [dict(row) for row in rows]})
+
+@app.route('/api/address-groups', methods=['POST'])
+def add_address_group():
+    """Create an address group; its sets and lookups are added to the live ruleset"""
+    data = request.get_json(silent=True) or {}
+    with db_transaction() as conn:
+        try:
+            name, description, members = parse_address_group(data, conn)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        cursor = conn.execute('INSERT INTO address_groups (name, description) VALUES (?, ?)', (name, description))
+        group_id = cursor.lastrowid
+        conn.executemany('INSERT INTO address_group_members (group_id, address) VALUES (?, ?)',
+                         [(group_id, _blacklist_entry(net)) for net in members or ()])
+    
+    record_audit('Add address group', {'group_id': group_id, 'name': name, 'members': len(members or ())})
+    # New sets are created in place and filled by the reconciler - no reload
+    job = submit_job('task', {'run': reconcile_ruleset}, f'Create address group {group_id}')
+    return job_response(job, {'group_id': group_id, 'members': len(members or ())})
+
+@app.route('/api/address-groups/<int:group_id>', methods=['GET'])
+def get_address_group(group_id):
+    """An address group with its members"""
+    conn = get_db()
+    row = conn.execute('SELECT * FROM address_groups WHERE id = ?', (group_id,)).fetchone()
+    if not row:
+        return jsonify({'success': False, 'error': 'Address group not found'}), 404
+    members = load_address_group_members(conn, group_id).get(group_id, set())
+    rules = conn.execute('SELECT id FROM custom_rules WHERE source_group_id = ? ORDER BY id', (group_id,)).fetchall()
+    return jsonify({
+        'success': True,
+        'group': dict(row,
+                      members=[_blacklist_entry(net) for net in sorted(members, key=lambda net: (net.version, net))],
+                      rule_ids=[rule['id'] for rule in rules]),
+    })
+
+@app.route('/api/address-groups/<int:group_id>', methods=['POST'])
+def update_address_group(group_id):
+    """Rename an address group, and replace its members if 'members' is given"""
+    data = request.get_json(silent=True) or {}
+    with db_transaction() as conn:
+        if not conn.execute('SELECT 1 FROM address_groups WHERE id = ?', (group_id,)).fetchone():
+            return jsonify({'success': False, 'error': 'Address group not found'}), 404
+        try:
+            name, description, members = parse_address_group(data, conn, group_id)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        conn.execute(
+            'UPDATE address_groups SET name = ?, description = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (name, description, group_id)
+        )
+    
+    record_audit('Update address group', {'group_id': group_id, 'name': name})
+    if members is None:
+        return jsonify({'success': True, 'group_id': group_id})
+    job = submit_job(
+        'task',
+        {'run': lambda: update_address_group_members(group_id, replace=members, action='Replace address group members')},
+        f'Replace members of address group {group_id}'
+    )
+    return job_response(job, {'group_id': group_id})
+
+@app.route('/api/address-groups/<int:group_id>/members', methods=['POST'])
+def change_address_group_members(group_id):
+    """Add and/or remove members; only the changed set elements reach nft"""
+    data = request.get_json(silent=True) or {}
+    add, rejected = parse_blacklist_entries(data.get('add') or [])
+    remove, rejected_remove = parse_blacklist_entries(data.get('remove') or [])
+    rejected += rejected_remove
+    if rejected:
+        return jsonify({'success': False, 'error': f"Invalid members: {', '.join(rejected[:10])}"}), 400
+    if not get_db().execute('SELECT 1 FROM address_groups WHERE id = ?', (group_id,)).fetchone():
+        return jsonify({'success': False, 'error': 'Address group not found'}), 404
+    
+    job = submit_job(
+        'task',
+        {'run': lambda: update_address_group_members(group_id, add=add, remove=remove)},
+        f'Update members of address group {group_id} (+{len(add)} -{len(remove)})'
+    )
+    return job_response(job, {'group_id': group_id})
+
+@app.route('/api/address-groups/<int:group_id>', methods=['DELETE'])
+def delete_address_group(group_id):
+    """Delete an address group that no custom rule uses"""
+    with db_transaction() as conn:
+        row = conn.execute('SELECT name FROM address_groups WHERE id = ?', (group_id,)).fetchone()
+        if not row:
+            return jsonify({'success': False, 'error': 'Address group not found'}), 404
+        rules = conn.execute('SELECT id FROM custom_rules WHERE source_group_id = ? ORDER BY id', (group_id,)).fetchall()
+        if rules:
+            return jsonify({
+                'success': False,
+                'error': 'Address group is used by custom rules',
+                'rule_ids': [rule['id'] for rule in rules],
+            }), 409
+        conn.execute('DELETE FROM address_group_members WHERE group_id = ?', (group_id,))
+        conn.execute('DELETE FROM address_groups WHERE id = ?', (group_id,))
+    
+    record_audit('Delete address group', {'group_id': group_id, 'name': row['name']})
+    job = submit_job('task', {'run': reconcile_ruleset}, f'Delete address group {group_id}')
+    return job_response(job, {'group_id': group_id})
+
+# ==================== CONNTRACK EVICTION ====================
+#
+# 'ct state established accept' runs before the policy and custom rules,
+# so flows they admitted keep going after they are disabled. Eviction
+# derives (family, proto, dport, source network) tuples from the rule
+# text - the template block of a policy, or the fields of a custom rule -
+# and deletes matching entries with one filtered '-D' per distinct tuple,
+# all read from stdin by a single 'conntrack -R -' process. conntrack
+# entries carry no interface, so an ingress interface becomes its network
+# (LAN -> $LAN_NET) or, for WAN, any source.
+
+RULE_PORT = re.compile(r'\b(tcp|udp) dport (\{[^}]*\}|\S+)')
+RULE_SADDR = re.compile(r'\bip6? saddr (\S+)')
+RULE_IIFNAME = re.compile(r'\biifname (\S+)')
+RULE_ADMITS = re.compile(r'\b(?:accept|masquerade)\b')
+RULE_SET_UPDATE = re.compile(r'\b(?:add|update) @\S+ \{[^}]*\}')
+CONNTRACK_DELETED = re.compile(r'(\d+) flow entr')
+CONNTRACK_FAMILIES = ('ipv4', 'ipv6')
+
+def _template_define_values(model):
+    values = {}
+    for line in _template_defines(model):
+        name, _, value = line[len('define'):].partition('=')
+        values[name.strip()] = value.strip().strip('"')
+    return values
+
+def _resolve(value, defines):
+    return defines.get(value[1:], value) if value.startswith('$') else value
+
+def _network_families(src):
+    if src is None:
+        return CONNTRACK_FAMILIES
+    return ('ipv6',) if ipaddress.ip_network(src, strict=False).version == 6 else ('ipv4',)
+
+def rule_conntrack_tuples(rule, defines):
+    """Conntrack tuples (family, proto, dport, src) a single nft rule admits"""
+    if not RULE_ADMITS.search(rule):
+        return []
+    rule = RULE_SET_UPDATE.sub('', rule)
+    src = None
+    saddr = RULE_SADDR.search(rule)
+    iifname = RULE_IIFNAME.search(rule)
+    if saddr and saddr.group(1) != '!=':
+        src = _resolve(saddr.group(1), defines)
+    elif iifname and iifname.group(1) != '!=' and _resolve(iifname.group(1), defines) == LAN_IFACE:
+        src = defines.get('LAN_NET')
+    group = ADDRESS_GROUP_SET.match(src or '')
+    if group:
+        # Address group members can be thousands of networks - the port alone narrows it
+        families, src = (('ipv6',) if src.endswith('_v6') else ('ipv4',)), None
+    else:
+        try:
+            src = str(ipaddress.ip_network(src, strict=False)) if src else None
+        except ValueError:
+            return []  # a named set (@blacklist_v4) or something else conntrack can't filter on
+        families = _network_families(src)
+    
+    port = RULE_PORT.search(rule)
+    if port:
+        try:
+            port_ranges = parse_port_spec(_resolve(port.group(2), defines).strip('{} '))
+        except ValueError:
+            return []  # a named service or a variable we can't resolve
+        dports = [dport for low, high in port_ranges for dport in range(low, high + 1)]
+        if len(dports) > CONNTRACK_MAX_PORTS:
+            # A wide range: one delete for the protocol from that source, never for every source
+            if src is None:
+                return []
+            dports = [None]
+        return [(family, port.group(1), dport, src) for family in families for dport in dports]
+    if group:
+        return []
+    if 'ip protocol icmp' in rule:
+        return [('ipv4', 'icmp', None, src)] if src is None or ':' not in src else []
+    if 'ip6 nexthdr icmpv6' in rule:
+        return [('ipv6', 'icmpv6', None, src)] if src is None or ':' in src else []
+    if src is None:
+        # Nothing narrower than 'everything' - never evict the whole table
+        return []
+    return [(family, None, None, src) for family in _network_families(src)]
+
+def policy_conntrack_tuples(policy_id, field='rule_enabled'):
+    """Tuples admitted by the template blocks of a policy"""
+    model = load_nftables_template()
+    defines = _template_define_values(model)
+    tuples = set()
+    for item in model:
+        if isinstance(item, dict) and item['kind'] == 'block' and item['policy_id'] == policy_id and item['field'] == field:
+            for rule in item['rules']:
+                tuples.update(rule_conntrack_tuples(rule.strip(), defines))
+    return tuples
+
+def custom_rule_conntrack_tuples(rule_data):
+    """Tuples matched by a custom rule (same sources as compile_custom_rule)"""
+    defines = _template_define_values(load_nftables_template())
+    tuples = set()
+    # Matches do not depend on the action; compile as an accept so drop/reject rules count too
+    for line in compile_custom_rule(rule_data.get('id'), dict(rule_data, action='ACCEPT')):
+        # 'add rule inet filter <chain> <rule>' - output rules match the firewall's own flows
+        chain = COMPILED_RULE_CHAIN.match(line)
+        if chain and chain.group(1) != 'output':
+            tuples.update(rule_conntrack_tuples(line[chain.end():].replace(f'"{LAN_IFACE}"', LAN_IFACE), defines))
+    return tuples
+
+def _narrowest_tuples(tuples):
+    """Drop tuples already covered by an any-source tuple for the same family/proto/port"""
+    return {t for t in tuples if t[3] is None or (t[0], t[1], t[2], None) not in tuples}
+
+def conntrack_delete_args(entry):
+    """'conntrack -D' options for a tuple"""
+    family, proto, dport, src = entry
+    args = ['-D', '-f', family]
+    if proto:
+        args += ['-p', proto]
+    if dport is not None:
+        args += ['--dport', str(dport)]
+    if src:
+        args += ['-s', src]
+    return args
+
+def conntrack_delete(args):
+    """Run one 'conntrack -D', returns the number of flows it deleted (None without conntrack)"""
+    try:
+        result = run_command(args, capture_output=True, text=True)
+    except FileNotFoundError:
+        logger.warning("conntrack not installed - existing connections were not dropped")
+        return None
+    # 'conntrack v1.4.7 (conntrack-tools): 3 flow entries have been deleted.'
+    match = CONNTRACK_DELETED.search(result.stderr)
+    return int(match.group(1)) if match else 0
+
+def conntrack_delete_batch(commands):
+    """Run '-D' option lists in one 'conntrack -R -' process, returns flows deleted (None without conntrack)"""
+    script = ''.join(' '.join(command) + '\n' for command in commands)
+    try:
+        result = run_command(['conntrack', '-R', '-'], input=script, capture_output=True, text=True)
+    except FileNotFoundError:
+        logger.warning("conntrack not installed - existing connections were not dropped")
+        return None
+    counts = CONNTRACK_DELETED.findall(result.stderr)
+    if result.returncode != 0 and not counts and 'option' in result.stderr:
+        # conntrack-tools before 1.4.6 has no --load-file - one process per command
+        return sum(conntrack_delete(['conntrack'] + command) or 0 for command in commands)
+    return sum(int(count) for count in counts)
+
+def evict_connections(tuples):
+    """Delete conntrack entries matching any tuple in one batch, returns the number of flows removed"""
+    commands = [conntrack_delete_args(entry) for entry in sorted(_narrowest_tuples(set(tuples)), key=str)]
+    removed = conntrack_delete_batch(commands) if commands else 0
+    if removed is None:
+        return 0
+    logger.debug("Evicted conntrack flows", extra={'removed': removed, 'tuples': len(commands)})
+    return removed
+
+def parse_conntrack_line(line):
+    """Original-direction fields of a 'conntrack -L' line (plain or -o extended)"""
+    tokens = line.split()
+    if len(tokens) < 3:
+        return None
+    flow = {'family': None, 'proto': tokens[0]}
+    if tokens[0] in CONNTRACK_FAMILIES:
+        flow.update(family=tokens[0], proto=tokens[2])
+    for token in tokens:
+        key, sep, value = token.partition('=')
+        if sep and key in ('src', 'dst', 'sport', 'dport') and key not in flow:
+            flow[key] = value
+    if 'src' not in flow:
+        return None
+    if flow['family'] is None:
+        flow['family'] = 'ipv6' if ':' in flow['src'] else 'ipv4'
+    return flow
+
+def conntrack_flow_matches(flow, entry):
+    """Whether 'conntrack -D' for a tuple would delete this flow"""
+    family, proto, dport, src = entry
+    if flow['family'] != family or (proto and flow['proto'] != proto):
+        return False
+    if dport is not None and flow.get('dport') != str(dport):
+        return False
+    if src and ipaddress.ip_address(flow['src']) not in ipaddress.ip_network(src, strict=False):
+        return False
+    return True
+
+def evictable_flows(listing, tuples):
+    """Lines of a recorded 'conntrack -L' listing that evict_connections(tuples) would delete"""
+    tuples = _narrowest_tuples(set(tuples))
+    matched = []
+    for line in listing.splitlines():
+        flow = parse_conntrack_line(line)
+        if flow and any(conntrack_flow_matches(flow, entry) for entry in tuples):
+            matched.append(line)
+    return matched
+
+def count_evictable_flows(listing, tuples):
+    """Number of flows in a recorded 'conntrack -L' listing that eviction would remove"""
+    return len(evictable_flows(listing, tuples))
+
+def evictable_address_flows(listing, network):
+    """Lines that evict_address_flows(network) would delete - original source or destination inside it"""
+    family = 'ipv6' if network.version == 6 else 'ipv4'
+    matched = []
+    for line in listing.splitlines():
+        flow = parse_conntrack_line(line)
+        if flow and flow['family'] == family and any(
+                ipaddress.ip_address(flow[key]) in network for key in ('src', 'dst') if key in flow):
+            matched.append(line)
+    return matched
+
+# ==================== FLOW OFFLOAD ====================
+#
+# Policy 18 gates a 'flow add @fastpath' rule at the top of the forward
+# chain. Once a LAN <-> WAN flow is established its packets skip the
+# forward chain entirely, which is also why a new blacklist entry has to
+# evict the offloaded flows of that address. flowtable_config holds the
+# devices and the hardware offload flag; changing them reloads the ruleset
+# since a live flowtable cannot change its flags.
+
+FLOWTABLE_DEVICE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.:-]{0,14}$')
+
+def load_flowtable_config():
+    """flowtable_config as {'devices': [...], 'hw_offload': 0|1}, defaults before migration"""
+    try:
+        row = get_db().execute('SELECT devices, hw_offload FROM flowtable_config WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is None:
+        return {'devices': [LAN_IFACE, WAN_IFACE], 'hw_offload': 0}
+    return {'devices': [device for device in row['devices'].split(',') if device], 'hw_offload': row['hw_offload']}
+
+def flowtable_enabled():
+    row = get_db().execute('SELECT rule_enabled FROM policy_rules WHERE id = ?', (FLOWTABLE_POLICY_ID,)).fetchone()
+    return bool(row and row['rule_enabled'])
+
+def parse_flowtable_config(data, current):
+    """Validated flowtable_config values from request data, ValueError if invalid"""
+    devices = data.get('devices', current['devices'])
+    if isinstance(devices, str):
+        devices = [device.strip() for device in devices.split(',') if device.strip()]
+    if not isinstance(devices, list) or not devices:
+        raise ValueError('devices must be a non-empty list of interface names')
+    if len(devices) > FLOWTABLE_MAX_DEVICES:
+        raise ValueError(f'At most {FLOWTABLE_MAX_DEVICES} devices')
+    for device in devices:
+        if not isinstance(device, str) or not FLOWTABLE_DEVICE.match(device):
+            raise ValueError(f'Invalid interface name {device!r}')
+    if len(set(devices)) != len(devices):
+        raise ValueError('devices must not repeat')
+    return {'devices': devices, 'hw_offload': 1 if data.get('hw_offload', current['hw_offload']) else 0}
+
+def count_offloaded_flows(lines):
+    """Flow counts from /proc/net/nf_conntrack or 'conntrack -L' lines"""
+    counts = {'total': 0, 'offloaded': 0, 'hw_offloaded': 0, 'by_protocol': {}}
+    for line in lines:
+        flow = parse_conntrack_line(line)
+        if flow is None:
+            continue
+        counts['total'] += 1
+        if '[HW_OFFLOAD]' in line:
+            counts['hw_offloaded'] += 1
+        elif '[OFFLOAD]' not in line:
+            continue
+        counts['offloaded'] += 1
+        counts['by_protocol'][flow['proto']] = counts['by_protocol'].get(flow['proto'], 0) + 1
+    return counts
+
+def offloaded_flows():
+    """Count offloaded flows, streaming the proc file so large tables are not held in memory"""
+    try:
+        with open(CONNTRACK_PROC) as f:
+            return count_offloaded_flows(f)
+    except OSError:
+        pass
+    # Kernels built without CONFIG_NF_CONNTRACK_PROCFS
+    try:
+        result = run_command(['conntrack', '-L'], capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    return count_offloaded_flows(result.stdout.splitlines())
+
+def evict_address_flows(network):
+    """Delete flows to or from a network, returns the number removed"""
+    family = 'ipv6' if network.version == 6 else 'ipv4'
+    return conntrack_delete_batch([['-D', '-f', family, direction, _blacklist_entry(network)]
+                                   for direction in ('-s', '-d')]) or 0
+
+def apply_flowtable_config():
+    """Writer task: re-render and reload, a flowtable's devices and flags are fixed once loaded"""
+    if not generate_nftables_config():
+        raise RuntimeError('Failed to generate config')
+    logger.debug("Reloading nftables")
+    if not reload_nftables():
+        raise RuntimeError('Failed to reload firewall')
+    return reconcile_ruleset()
+
+@app.route('/api/flowtable', methods=['GET'])
+def get_flowtable():
+    """Flowtable config, whether policy 18 offloads flows and how many are offloaded now"""
+    config = load_flowtable_config()
+    return jsonify({
+        'success': True,
+        'enabled': flowtable_enabled(),
+        'policy_id': FLOWTABLE_POLICY_ID,
+        'devices': config['devices'],
+        'hw_offload': bool(config['hw_offload']),
+        'flows': offloaded_flows(),
+    })
+
+@app.route('/api/flowtable', methods=['POST'])
+def update_flowtable():
+    """Set the flowtable devices and hardware offload flag (toggle via policy 18)"""
+    data = request.json or {}
+    try:
+        values = parse_flowtable_config(data, load_flowtable_config())
+    except ValueError as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    
+    with db_transaction() as conn:
+        conn.execute(
+            'UPDATE flowtable_config SET devices = ?, hw_offload = ?, updated_at = CURRENT_TIMESTAMP WHERE id = 1',
+            (','.join(values['devices']), values['hw_offload'])
+        )
+    
+    record_audit('Update flowtable', values)
+    
+    job = submit_job('task', {'run': apply_flowtable_config}, 'Flowtable config')
+    return job_response(job, values)
+
+# ==================== RULESET RECONCILER ====================
+#
+# Reads the live ruleset once and diffs it against custom_rules,
+# policy_rules and firewall_blacklist, then applies only the missing or
+# stale pieces in a single nft transaction. Safe to run repeatedly.
+# Address groups are diffed against address_groups the same way, so
+# creating or deleting one adds or removes its objects without a reload.
+
+def list_live_ruleset():
+    """Return the live ruleset as a list of nft JSON objects (None on error)"""
+    result = nft_executor().run('list ruleset', json_output=True)
+    if not result['success']:
+        logger.error(f"Could not list ruleset: {result['error']}")
+        return None
+    return json.loads(result['output']).get('nftables', [])
+
+def _live_objects(ruleset, kind, family='inet', table='filter'):
+    return [item[kind] for item in ruleset
+            if kind in item and item[kind].get('family') == family and item[kind].get('table') == table]
+
+def _diff_custom_rules(ruleset, conn, report, lines):
+    """Queue deletes/adds for custom rules; returns handles of rules left in place"""
+    anchors = custom_rule_anchors(ruleset)
+    live = {}
+    misplaced = set()
+    past_anchor = set()
+    for rule in _live_objects(ruleset, 'rule'):
+        if rule.get('comment') == CUSTOM_RULES_ANCHOR:
+            past_anchor.add(rule.get('chain'))
+        comment = CUSTOM_RULE_COMMENT.match(rule.get('comment', ''))
+        if comment and rule.get('chain') in CUSTOM_RULE_CHAINS:
+            live.setdefault(int(comment.group(1)), []).append((rule['chain'], rule['handle']))
+            # Appended after the anchor (before rules were anchored) - never reached
+            if rule['chain'] in past_anchor:
+                misplaced.add(int(comment.group(1)))
+    
+    kept = {}
+    rows = conn.execute('SELECT * FROM custom_rules WHERE enabled = 1').fetchall()
+    for row in rows:
+        rule = dict(row)
+        if NFT_COMPILED_RULES and not rule_schedule(rule):
+            continue  # a verdict map element - any linear rule left for it is orphaned
+        compiled = compile_custom_rule(rule['id'], rule)
+        expected = sorted(COMPILED_RULE_CHAIN.match(line).group(1) for line in compiled)
+        installed = live.pop(rule['id'], [])
+        if sorted(chain for chain, handle in installed) == expected and rule['id'] not in misplaced:
+            kept[rule['id']] = installed
+            continue
+        report['custom_rules']['stale' if installed else 'missing'].append(rule['id'])
+        lines.extend(_delete_handles_script(installed).splitlines())
+        lines.extend(anchor_custom_rules(compiled, anchors))
+    
+    # Rules still live but disabled or deleted in the database
+    for rule_id, installed in sorted(live.items()):
+        report['custom_rules']['orphaned'].append(rule_id)
+        lines.extend(_delete_handles_script(installed).splitlines())
+    return kept
+
+def _diff_policy_gates(ruleset, conn, report, lines):
+    """Queue gate updates; returns False if the live ruleset lacks the gate layout"""
+    status = {row['id']: dict(row) for row in conn.execute('SELECT * FROM policy_rules').fetchall()}
+    maps = {}
+    for item in ruleset:
+        if 'map' in item:
+            live_map = item['map']
+            if live_map['name'].endswith('_gate') and not isinstance(live_map.get('type', []), list):
+                return False  # gate keyed on nfproto alone - predates schedules
+            maps[(f"{live_map['family']} {live_map['table']}", live_map['name'])] = len(live_map.get('elem', []))
+    
+    for gate in policy_gates(load_nftables_template()):
+        key = (gate['table'], f"{gate['chain']}_gate")
+        if key not in maps:
+            return False
+        # Compared by element count - nft lists hours converted back to local time
+        windows = _gate_windows(gate, status)
+        wanted = len(windows) * len(_gate_families(gate['table']))
+        if maps[key] != wanted:
+            report['policies']['gates'].append(gate['chain'])
+            map_ref = f"{gate['table']} {gate['chain']}_gate"
+            lines.append(f'flush map {map_ref}')
+            if windows:
+                lines.append(f'add element {map_ref} {{ {_gate_elements(gate, windows)} }}')
+    return True
+
+def _diff_blacklist(ruleset, conn, report, lines):
+    """Queue element adds/deletes so blacklist_v4/v6 match firewall_blacklist"""
+    live = {}
+    for live_set in _live_objects(ruleset, 'set'):
+        if live_set['name'] not in ('blacklist_v4', 'blacklist_v6'):
+            continue
+        for elem in live_set.get('elem', []):
+            value = elem['elem']['val'] if isinstance(elem, dict) and 'elem' in elem else elem
+            text = _json_element_text(value)
+            if text:
+                live[text] = live_set['name']
+    
+    now = datetime.now(timezone.utc)
+    missing = {'blacklist_v4': [], 'blacklist_v6': []}
+    rows = conn.execute(
+        'SELECT ip_address, expires_at FROM firewall_blacklist '
+        'WHERE expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP'
+    ).fetchall()
+    networks = []
+    for row in rows:
+        try:
+            networks.append((ipaddress.ip_network(row['ip_address'], strict=False), row))
+        except ValueError:
+            continue
+    
+    # Rows inside a broader row (written before overlaps were checked) would
+    # make the interval set reject the whole batch; the broader row blocks them
+    overlapping = 0
+    end = {4: None, 6: None}
+    for network, row in sorted(networks, key=lambda item: (item[0].version, item[0].network_address, item[0].prefixlen)):
+        if end[network.version] is not None and network.network_address <= end[network.version]:
+            overlapping += 1
+            continue
+        end[network.version] = network.broadcast_address
+        entry = _blacklist_entry(network)
+        if live.pop(entry, None):
+            continue
+        ttl = None
+        if row['expires_at']:
+            expires = datetime.strptime(row['expires_at'], SQLITE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+            ttl = max(int((expires - now).total_seconds()), 1)
+        missing[_blacklist_set(network)].append(_blacklist_element(entry, ttl))
+    
+    report['blacklist']['missing'] = sum(len(entries) for entries in missing.values())
+    report['blacklist']['extra'] = len(live)
+    report['blacklist']['overlapping'] = overlapping
+    
+    for entry, set_name in live.items():
+        lines.append(f'delete element inet filter {set_name} {{ {entry} }}')
+    for set_name, entries in missing.items():
+        for i in range(0, len(entries), BLACKLIST_CHUNK_SIZE):
+            lines.append(f"add element inet filter {set_name} {{ {', '.join(entries[i:i + BLACKLIST_CHUNK_SIZE])} }}")
+
+def reconcile_ruleset(dry_run=False):
+    """Bring the live ruleset in line with the database, returning a drift report"""
+    report = {
+        'custom_rules': {'missing': [], 'stale': [], 'orphaned': []},
+        'policies': {'gates': [], 'reloaded': False},
+        'blacklist': {'missing': 0, 'extra': 0, 'overlapping': 0},
+        'address_groups': {'created': [], 'removed': [], 'missing': 0, 'extra': 0},
+        'applied': 0,
+        'dry_run': dry_run,
+    }
+    
+    config_changed = False if dry_run else write_nftables_config()
+    ruleset = list_live_ruleset()
+    if ruleset is None:
+        raise RuntimeError('could not list live ruleset')
+    
+    conn = get_db()
+    lines = []
+    layout_ok = _diff_policy_gates(ruleset, conn, report, lines) if NFT_LIVE_TOGGLE else not config_changed
+    if NFT_COMPILED_RULES and live_custom_rule_elements(ruleset) is None:
+        layout_ok = False
+    anchored = {item['chain'] for item in load_nftables_template() if isinstance(item, dict) and item['kind'] == 'custom-rules'}
+    if anchored - set(custom_rule_anchors(ruleset)):
+        layout_ok = False
+    if not layout_ok and not dry_run:
+        # Live ruleset predates the current config - reload it, then diff again
+        if not reload_nftables():
+            raise RuntimeError('failed to reload nftables')
+        report['policies']['reloaded'] = True
+        ruleset = list_live_ruleset() or []
+        lines = []
+        if NFT_LIVE_TOGGLE:
+            _diff_policy_gates(ruleset, conn, report, lines)
+    
+    kept = _diff_custom_rules(ruleset, conn, report, lines)
+    elements = _diff_custom_rule_elements(ruleset, conn, report, lines) if NFT_COMPILED_RULES else None
+    _diff_blacklist(ruleset, conn, report, lines)
+    _diff_address_groups(ruleset, conn, report, lines)
+    
+    report['applied'] = len(lines)
+    if dry_run:
+        return report
+    
+    if lines:
+        result = run_nft_script('\n'.join(lines) + '\n', echo=True)
+        if not result['success']:
+            raise RuntimeError(f"reconcile batch failed: {result['error']}")
+    
+    # The listing is authoritative for every handle we left in place
+    forget_rule_handles()
+    record_rule_handles(kept)
+    remember_custom_rule_anchors(ruleset)
+    if lines:
+        record_rule_handles(parse_echoed_handles(result['output']))
+    if elements is not None:
+        remember_custom_rule_elements(elements)
+    return report
+
+@app.route('/api/reconcile', methods=['POST'])
+def reconcile():
+    """Diff the live ruleset against the database and repair any drift"""
+    dry_run = request.args.get('dry_run', '0') in ('1', 'true')
+    if not dry_run:
+        # Repairs change the ruleset, so they go through the writer thread
+        return job_response(submit_job('task', {'run': reconcile_ruleset}, 'Reconcile ruleset'))
+    
+    try:
+        report = reconcile_ruleset(dry_run=True)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify(dict(report, success=True))
+
+# ==================== SNAPSHOTS ====================
+#
+# After every apply batch the ruleset-defining tables are hashed together
+# with the template; a state not seen before is stored with its compiled
+# artifact (the rendered nftables.conf and an nft script filling the
+# verdict maps and address group sets). Applying a snapshot restores the
+# rows, loads the stored artifact and lets the reconciler put back what
+# snapshots do not carry (blacklist, policy gates). The blacklist is left
+# as it is - rolling back a policy change should not unban anyone.
+#
+# A dead-man timer can be armed when applying a snapshot, or before making
+# changes by hand: unless POST /api/snapshots/confirm arrives before the
+# deadline, the state from when it was armed is applied again. The
+# deadline is stored, so a restart (or a reboot after a lockout) resumes it.
+
+# Table -> ORDER BY; timestamps are left out so a toggle and back hashes the same
+SNAPSHOT_TABLES = {
+    'policy_rules': 'id',
+    'custom_rules': 'id',
+    'address_groups': 'id',
+    'address_group_members': 'group_id, address',
+    'autoban_policies': 'name',
+    'flowtable_config': 'id',
+}
+SNAPSHOT_VOLATILE = ('created_at', 'updated_at')
+SNAPSHOT_JOB_KINDS = ('policy', 'custom', 'task')
+SNAPSHOT_HASH = re.compile(r'^[0-9a-f]{8,64}$')
+
+_rollback_timer = None
+_rollback_lock = threading.Lock()
+
+def snapshot_state(conn):
+    """{table: [rows]} for the tables that define the ruleset"""
+    state = {}
+    for table, order in SNAPSHOT_TABLES.items():
+        rows = conn.execute(f'SELECT * FROM {table} ORDER BY {order}').fetchall()
+        state[table] = [{key: row[key] for key in row.keys() if key not in SNAPSHOT_VOLATILE} for row in rows]
+    return state
+
+def template_digest():
+    with open(NFTABLES_TEMPLATE, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def snapshot_hash(state, template_hash):
+    digest = hashlib.sha256(template_hash.encode())
+    digest.update(json.dumps(state, sort_keys=True, separators=(',', ':')).encode())
+    return digest.hexdigest()
+
+def snapshot_elements(conn):
+    """nft script filling the verdict maps and address group sets from the current rows"""
+    lines = []
+    if NFT_COMPILED_RULES:
+        rules = [dict(row) for row in conn.execute('SELECT * FROM custom_rules WHERE enabled = 1').fetchall()]
+        compiled = compile_custom_rule_elements(rules)
+        lines += custom_rule_element_script(
+            {}, {name: {key: verdict for key, (verdict, _) in entries.items()} for name, entries in compiled.items()}
+        )
+    groups = {}
+    for group_id, networks in load_address_group_members(conn).items():
+        groups.update(address_group_elements(group_id, networks))
+    lines += address_group_element_script({}, groups)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def record_snapshot(description=''):
+    """Store the current state if it is new (else mark it applied again), returns its hash"""
+    conn = get_db()
+    state = snapshot_state(conn)
+    template_hash = template_digest()
+    key = snapshot_hash(state, template_hash)
+    
+    with db_transaction() as conn:
+        cursor = conn.execute('UPDATE ruleset_snapshots SET applied_at = CURRENT_TIMESTAMP WHERE hash = ?', (key,))
+        if cursor.rowcount:
+            return key
+        
+        # Compiled once, when the state is first seen
+        conn.execute('''
+            INSERT INTO ruleset_snapshots (hash, description, state, config, elements, template_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, description[:200], json.dumps(state), render_current_config(), snapshot_elements(conn), template_hash))
+        
+        # Keep the most recently applied ones, and always the rollback target
+        conn.execute('''
+            DELETE FROM ruleset_snapshots WHERE hash NOT IN (
+                SELECT hash FROM ruleset_snapshots ORDER BY applied_at DESC, created_at DESC LIMIT ?
+            ) AND hash NOT IN (SELECT snapshot_hash FROM snapshot_rollback)
+        ''', (SNAPSHOT_KEEP,))
+    return key
+
+def find_snapshot(conn, prefix):
+    """The snapshot whose hash starts with prefix (8+ hex digits), None if missing or ambiguous"""
+    if not SNAPSHOT_HASH.match(prefix or ''):
+        return None
+    rows = conn.execute('SELECT * FROM ruleset_snapshots WHERE hash LIKE ? LIMIT 2', (prefix + '%',)).fetchall()
+    return rows[0] if len(rows) == 1 else None
+
+def restore_snapshot_state(conn, state):
+    """Replace the snapshot tables' rows (columns added since the snapshot keep their defaults)"""
+    for table in SNAPSHOT_TABLES:
+        columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        conn.execute(f'DELETE FROM {table}')
+        rows = state.get(table, [])
+        if not rows:
+            continue
+        keys = [key for key in rows[0] if key in columns]
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(keys)}) VALUES ({', '.join('?' * len(keys))})",
+            [tuple(row.get(key) for key in keys) for row in rows]
+        )
+
+def _snapshot_evictions(before, after):
+    """Tuples for flows that policies or accept rules let in before and no longer do"""
+    tuples = set()
+    policies = {row['id']: row for row in after.get('policy_rules', [])}
+    for row in before.get('policy_rules', []):
+        for field in ('rule_enabled', 'nat_enabled'):
+            if row.get(field) and not policies.get(row['id'], {}).get(field):
+                tuples.update(policy_conntrack_tuples(row['id'], field))
+    rules = {row['id']: row for row in after.get('custom_rules', [])}
+    for row in before.get('custom_rules', []):
+        if row.get('enabled') and (row.get('action') or 'ACCEPT').lower() == 'accept' and rules.get(row['id']) != row:
+            tuples.update(custom_rule_conntrack_tuples(row))
+    return tuples
+
+def load_snapshot(snapshot):
+    """Restore a snapshot's rows and load its artifact, True if the stored one was used
+    
+    The rows are committed before the reload so the database write lock is
+    not held while systemctl runs. Raises NftError if nft rejects the result.
+    """
+    with db_transaction() as conn:
+        restore_snapshot_state(conn, json.loads(snapshot['state']))
+    
+    # An artifact compiled from another template is rebuilt from the rows
+    cached = snapshot['template_hash'] == template_digest()
+    if cached:
+        write_file_atomic(NFTABLES_CONF, snapshot['config'])
+    else:
+        write_nftables_config()
+    if not reload_nftables():
+        raise NftError('Failed to reload firewall')
+    if cached and snapshot['elements']:
+        result = run_nft_script(snapshot['elements'])
+        if not result['success']:
+            raise NftError(result['error'])
+    return cached
+
+def apply_snapshot(key, confirm_within=None):
+    """Restore a snapshot's rows and load its stored artifact; runs on the writer thread"""
+    conn = get_db()
+    snapshot = conn.execute('SELECT * FROM ruleset_snapshots WHERE hash = ?', (key,)).fetchone()
+    if not snapshot:
+        raise ValueError(f'Snapshot {key} not found')
+    
+    previous = record_snapshot('Before applying snapshot ' + key[:12])
+    before = snapshot_state(conn)
+    state = json.loads(snapshot['state'])
+    try:
+        cached = load_snapshot(snapshot)
+    except Exception as e:
+        # Go back to the state from before, the way the dead-man timer would
+        logger.error(f"Snapshot apply failed ({e}), rolling back to {previous[:12]}")
+        try:
+            load_snapshot(get_db().execute('SELECT * FROM ruleset_snapshots WHERE hash = ?', (previous,)).fetchone())
+            reconcile_ruleset()
+        except Exception as restore_error:
+            logger.error(f"Could not restore the ruleset after a failed snapshot apply: {restore_error}")
+        raise
+    
+    report = reconcile_ruleset()
+    tuples = _snapshot_evictions(before, state)
+    evicted = evict_connections(tuples) if tuples else 0
+    record_audit('Apply snapshot', {'snapshot': key, 'previous': previous, 'cached': cached})
+    if confirm_within:
+        arm_rollback(previous, confirm_within)
+    return {'snapshot': key, 'previous': previous, 'cached_artifact': cached, 'evicted': evicted,
+            'reconcile': report, 'rollback': rollback_view()}
+
+def arm_rollback(key, seconds):
+    """Apply snapshot key again unless confirm_rollback() is called within seconds"""
+    deadline = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    with db_transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO snapshot_rollback (id, snapshot_hash, deadline) VALUES (1, ?, ?)',
+                     (key, deadline.strftime(SQLITE_TIME_FORMAT)))
+    record_audit('Arm rollback timer', {'snapshot': key, 'seconds': seconds})
+    _schedule_rollback(seconds)
+
+def confirm_rollback():
+    """Disarm the dead-man timer, returns False if it was not armed"""
+    with db_transaction() as conn:
+        confirmed = conn.execute('DELETE FROM snapshot_rollback').rowcount > 0
+    with _rollback_lock:
+        if _rollback_timer:
+            _rollback_timer.cancel()
+    if confirmed:
+        record_audit('Confirm change', {})
+    return confirmed
+
+def rollback_view():
+    row = get_db().execute('SELECT * FROM snapshot_rollback WHERE id = 1').fetchone()
+    if not row:
+        return None
+    deadline = datetime.strptime(row['deadline'], SQLITE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    return {
+        'snapshot': row['snapshot_hash'],
+        'deadline': deadline.isoformat(),
+        'remaining': max(0, int((deadline - datetime.now(timezone.utc)).total_seconds())),
+    }
+
+def _schedule_rollback(delay):
+    global _rollback_timer
+    with _rollback_lock:
+        if _rollback_timer:
+            _rollback_timer.cancel()
+        _rollback_timer = threading.Timer(max(delay, 0), _rollback_due)
+        _rollback_timer.daemon = True
+        _rollback_timer.start()
+
+def _rollback_due():
+    pending = rollback_view()
+    if pending is None:
+        return  # confirmed
+    if pending['remaining'] > 0:
+        _schedule_rollback(pending['remaining'])  # re-armed meanwhile
+        return
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM snapshot_rollback')
+    key = pending['snapshot']
+    logger.warning("Change not confirmed in time - rolling back", extra={'snapshot': key})
+    record_audit('Automatic rollback', {'snapshot': key})
+    submit_job('task', {'run': lambda: apply_snapshot(key)}, f'Roll back to snapshot {key[:12]}')
+
+def start_rollback_timer():
+    """Resume a dead-man timer armed before a restart"""
+    pending = rollback_view()
+    if pending:
+        logger.warning("Unconfirmed change from before the restart",
+                       extra={'snapshot': pending['snapshot'], 'remaining': pending['remaining']})
+        _schedule_rollback(pending['remaining'])
+
+def parse_confirm_within(data):
+    """Seconds from 'confirm_within' (None if absent); ValueError when out of range"""
+    value = data.get('confirm_within')
+    if value in (None, '', 0):
+        return None
+    seconds = int(value)
+    if not SNAPSHOT_MIN_CONFIRM <= seconds <= SNAPSHOT_MAX_CONFIRM:
+        raise ValueError(f'confirm_within must be {SNAPSHOT_MIN_CONFIRM}-{SNAPSHOT_MAX_CONFIRM} seconds')
+    return seconds
+
+@app.route('/api/snapshots', methods=['GET'])
+def get_snapshots():
+    """Stored ruleset snapshots, newest applied first, and which one is live"""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT hash, description, template_hash, created_at, applied_at, length(config) AS config_size,
+               json_array_length(state, '$.policy_rules') AS policy_rules,
+               json_array_length(state, '$.custom_rules') AS custom_rules
+        FROM ruleset_snapshots ORDER BY applied_at DESC, created_at DESC
+    ''').fetchall()
+    current = snapshot_hash(snapshot_state(conn), template_digest())
+    return jsonify({
+        'success': True,
+        'current': current,
+        'rollback': rollback_view(),
+        'snapshots': [dict(row, current=row['hash'] == current) for row in rows],
+    })
+
+@app.route('/api/snapshots/<key>', methods=['GET'])
+def get_snapshot(key):
+    """One snapshot with its rows and compiled artifact"""
+    snapshot = find_snapshot(get_db(), key)
+    if not snapshot:
+        return jsonify({'success': False, 'error': 'Snapshot not found'}), 404
+    return jsonify({'success': True, 'snapshot': dict(snapshot, state=json.loads(snapshot['state']))})
+
+@app.route('/api/snapshots/<key>/apply', methods=['POST'])
+def apply_snapshot_endpoint(key):
+    """Go back (or forward) to a stored state; 'confirm_within' arms the dead-man timer"""
+    data = request.get_json(silent=True) or {}
+    try:
+        confirm_within = parse_confirm_within(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    snapshot = find_snapshot(get_db(), key)
+    if not snapshot:
+        return jsonify({'success': False, 'error': 'Snapshot not found'}), 404
+    
+    full_key = snapshot['hash']
+    job = submit_job(
+        'task',
+        {'run': lambda: apply_snapshot(full_key, confirm_within)},
+        f'Apply snapshot {full_key[:12]}'
+    )
+    return job_response(job, {'snapshot': full_key, 'confirm_within': confirm_within})
+
+@app.route('/api/snapshots/deadman', methods=['POST'])
+def arm_deadman():
+    """Snapshot the current state and roll back to it unless confirmed within 'confirm_within' seconds"""
+    data = request.get_json(silent=True) or {}
+    try:
+        confirm_within = parse_confirm_within(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not confirm_within:
+        return jsonify({'success': False, 'error': 'confirm_within is required'}), 400
+    
+    # Behind queued changes, so the rollback point is the state they started from
+    def arm():
+        key = record_snapshot('Dead-man timer armed')
+        arm_rollback(key, confirm_within)
+        return {'rollback': rollback_view()}
+    return job_response(submit_job('task', {'run': arm}, 'Arm dead-man timer'), {'confirm_within': confirm_within})
+
+@app.route('/api/snapshots/confirm', methods=['POST'])
+def confirm_snapshot():
+    """Keep the current state: disarm the dead-man timer"""
+    if not confirm_rollback():
+        return jsonify({'success': False, 'error': 'No change is waiting for confirmation'}), 404
+    return jsonify({'success': True})
+
+# ==================== AUTO-BAN ====================
+#
+# Each trigger meters matching traffic per source address in a dynamic
+# set; a source going over threshold packets per window is added to the
+# trigger's ban set with the ban TTL, all in the kernel. The blacklist
+# sets are interval sets, which the packet path cannot add to, so the bans
+# live in their own dynamic sets. A low-frequency sync job copies them into
+# firewall_blacklist and the blacklist sets.
+
+# Traffic each trigger meters, as (ipv4 match, ipv6 match)
+AUTOBAN_TRIGGERS = {
+    'ssh': ('iifname $WAN tcp dport $SSH_PORT ct state new', 'iifname $WAN tcp dport $SSH_PORT ct state new'),
+    'icmp': ('iifname $WAN ip protocol icmp', 'iifname $WAN ip6 nexthdr icmpv6'),
+    'scan': ('iifname $WAN ct state new', 'iifname $WAN ct state new'),
+}
+AUTOBAN_FAMILIES = (('v4', 'ipv4_addr', 'ip saddr'), ('v6', 'ipv6_addr', 'ip6 saddr'))
+LIMIT_UNITS = ((86400, 'day'), (3600, 'hour'), (60, 'minute'), (1, 'second'))
+AUTOBAN_REASON = 'Auto-ban: '
+
+_autoban_syncer = None
+
+def load_autoban_policies():
+    """autoban_policies rows, empty if the table does not exist yet"""
+    try:
+        return [dict(row) for row in get_db().execute('SELECT * FROM autoban_policies ORDER BY name').fetchall()]
+    except sqlite3.OperationalError:
+        return []
+
+def autoban_limit(threshold, window):
+    """nft limit matching more than threshold packets per window seconds"""
+    for seconds, unit in LIMIT_UNITS:
+        if window >= seconds:
+            break
+    rate = max(1, round(threshold * seconds / window))
+    return f'limit rate over {rate}/{unit} burst {threshold} packets'
+
+def autoban_rules(policies):
+    """Rules of the autoban chain: drop banned sources, then meter each enabled trigger"""
+    rules = []
+    for trigger in AUTOBAN_TRIGGERS:
+        for suffix, _, saddr in AUTOBAN_FAMILIES:
+            rules.append(f'{saddr} @autoban_{trigger}_{suffix} counter drop')
+    
+    for policy in policies:
+        if not policy['enabled'] or policy['name'] not in AUTOBAN_TRIGGERS:
+            continue
+        trigger = policy['name']
+        limit = autoban_limit(policy['threshold'], policy['window_seconds'])
+        for (suffix, _, saddr), match in zip(AUTOBAN_FAMILIES, AUTOBAN_TRIGGERS[trigger]):
+            rules.append(
+                f"{match} update @autoban_{trigger}_meter_{suffix} "
+                f"{{ {saddr} timeout {policy['window_seconds']}s {limit} }} "
+                f"add @autoban_{trigger}_{suffix} {{ {saddr} timeout {policy['ban_seconds']}s }} counter drop"
+            )
+    return rules
+
+def _autoban_table():
+    for item in load_nftables_template():
+        if isinstance(item, dict) and item['kind'] == 'auto-ban':
+            return item['table']
+    return None
+
+def apply_autoban_rules():
+    """Replace the live autoban chain rules in one transaction (ban sets are kept)"""
+    table = _autoban_table()
+    if table is None:
+        logger.warning(f"{NFTABLES_TEMPLATE} has no @auto-ban anchor - auto-ban policies have no effect")
+        return True
+    
+    lines = _template_defines(load_nftables_template()) + [f'flush chain {table} autoban']
+    lines.extend(f'add rule {table} autoban {rule}' for rule in autoban_rules(load_autoban_policies()))
+    result = run_nft_script('\n'.join(lines) + '\n')
+    if not result['success']:
+        logger.debug(f"Live auto-ban update failed: {result['error']}")
+    return result['success']
+
+def apply_autoban_policies():
+    """Writer task: regenerate the config and update the autoban chain"""
+    if not generate_nftables_config():
+        raise RuntimeError('Failed to generate config')
+    if apply_autoban_rules():
+        return None
+    
+    # The live ruleset predates the auto-ban chain - load it in full
+    logger.debug("Reloading nftables")
+    if not reload_nftables():
+        raise RuntimeError('Failed to reload firewall')
+    return reconcile_ruleset()
+
+def autoban_kernel_bans():
+    """{trigger: {address: seconds left}} from the live ban sets"""
+    table = _autoban_table()
+    bans = {}
+    if table is None:
+        return bans
+    for trigger in AUTOBAN_TRIGGERS:
+        for suffix, _, _ in AUTOBAN_FAMILIES:
+            result = nft_executor().run(f'list set {table} autoban_{trigger}_{suffix}', json_output=True)
+            if not result['success']:
+                continue
+            for item in json.loads(result['output']).get('nftables', []):
+                for elem in item.get('set', {}).get('elem', []):
+                    if isinstance(elem, dict) and 'elem' in elem:
+                        address, expires = elem['elem'].get('val'), elem['elem'].get('expires')
+                    else:
+                        address, expires = elem, None
+                    if isinstance(address, str):
+                        bans.setdefault(trigger, {})[address] = expires
+    return bans
+
+def _blacklist_covers(known, network):
+    """True if network or any prefix containing it is in known"""
+    return any(network.supernet(new_prefix=prefix) in known for prefix in range(network.prefixlen + 1))
+
+def sync_autobans():
+    """Writer task: copy new kernel auto-bans into firewall_blacklist and the blacklist sets
+    
+    Each banned address gets a row of its own with its own expiry - never
+    aggregated, so deleting the row can lift exactly that kernel ban.
+    """
+    report = {}
+    kernel_bans = autoban_kernel_bans()
+    if not kernel_bans:
+        return report
+    
+    with db_transaction() as conn:
+        known = set(load_blacklist_networks(conn))
+        rows = []
+        elements = {'blacklist_v4': [], 'blacklist_v6': []}
+        for trigger, bans in kernel_bans.items():
+            for address, expires in sorted(bans.items()):
+                network = ipaddress.ip_network(address)
+                if _blacklist_covers(known, network):
+                    continue
+                known.add(network)
+                entry = _blacklist_entry(network)
+                rows.append((entry, f'{AUTOBAN_REASON}{trigger}', blacklist_expiry(expires)))
+                elements[_blacklist_set(network)].append(_blacklist_element(entry, expires))
+                report[trigger] = report.get(trigger, 0) + 1
+        if not rows:
+            return report
+        
+        conn.executemany('INSERT INTO firewall_blacklist (ip_address, reason, expires_at) VALUES (?, ?, ?)', rows)
+        lines = []
+        for set_name, entries in elements.items():
+            for i in range(0, len(entries), BLACKLIST_CHUNK_SIZE):
+                lines.append(f"add element inet filter {set_name} {{ {', '.join(entries[i:i + BLACKLIST_CHUNK_SIZE])} }}")
+        result = run_nft_script('\n'.join(lines) + '\n')
+        if not result['success']:
+            raise NftError(f"Failed to update firewall sets: {result['error'].strip()}")
+    
+    record_audit('Auto-ban sync', report)
+    return report
+
+def lift_autobans(trigger, network):
+    """Writer task: delete a trigger's kernel bans inside network (a blacklist row being removed)"""
+    addresses = [address for address in autoban_kernel_bans().get(trigger, {})
+                 if ipaddress.ip_address(address) in network]
+    if not addresses:
+        return {'lifted': 0}
+    suffix = 'v6' if network.version == 6 else 'v4'
+    result = run_nft_script(f"delete element {_autoban_table()} autoban_{trigger}_{suffix} {{ {', '.join(addresses)} }}\n")
+    if not result['success']:
+        raise NftError(f"Failed to lift auto-ban: {result['error'].strip()}")
+    return {'lifted': len(addresses)}
+
+def start_autoban_sync():
+    """Background thread queueing sync_autobans() every AUTOBAN_SYNC_INTERVAL seconds"""
+    global _autoban_syncer
+    
+    def syncer():
+        while True:
+            time.sleep(AUTOBAN_SYNC_INTERVAL)
+            if any(policy['enabled'] for policy in load_autoban_policies()):
+                submit_job('task', {'run': sync_autobans}, 'Auto-ban sync')
+    
+    if _autoban_syncer is None or not _autoban_syncer.is_alive():
+        _autoban_syncer = threading.Thread(target=syncer, name='autoban-sync', daemon=True)
+        _autoban_syncer.start()
+    return _autoban_syncer
+
+def parse_autoban_policy(data, current):
+    """Validated autoban_policies values from request data, ValueError if out of range"""
+    values = {}
+    for field, key, maximum in (('threshold', 'threshold', AUTOBAN_MAX_THRESHOLD),
+                                ('window_seconds', 'window', AUTOBAN_MAX_WINDOW),
+                                ('ban_seconds', 'ttl', AUTOBAN_MAX_BAN)):
+        value = data.get(key, current[field])
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(f'{key} must be an integer')
+        value = int(value)
+        if not 1 <= value <= maximum:
+            raise ValueError(f'{key} must be between 1 and {maximum}')
+        values[field] = value
+    values['enabled'] = 1 if data.get('enabled', current['enabled']) else 0
+    return values
+
+@app.route('/api/autoban', methods=['GET'])
+def get_autoban_policies():
+    """Auto-ban policies with the number of sources each currently bans"""
+    bans = autoban_kernel_bans()
+    policies = []
+    for policy in load_autoban_policies():
+        policy['banned'] = len(bans.get(policy['name'], {}))
+        policies.append(policy)
+    return jsonify({'success': True, 'policies': policies})
+
+@app.route('/api/autoban/<name>', methods=['POST'])
+def update_autoban_policy(name):
+    """Set threshold (packets), window and ttl (seconds) and enabled for one trigger"""
+    data = request.json or {}
+    current = next((policy for policy in load_autoban_policies() if policy['name'] == name), None)
+    if current is None or name not in AUTOBAN_TRIGGERS:
+        return jsonify({'error': 'Unknown auto-ban policy'}), 404
+    
+    try:
+        values = parse_autoban_policy(data, current)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    
+    with db_transaction() as conn:
+        conn.execute(
+            '''UPDATE autoban_policies SET threshold = ?, window_seconds = ?, ban_seconds = ?,
+                   enabled = ?, updated_at = CURRENT_TIMESTAMP WHERE name = ?''',
+            (values['threshold'], values['window_seconds'], values['ban_seconds'], values['enabled'], name)
+        )
+    
+    record_audit('Update auto-ban policy', dict(values, name=name))
+    
+    job = submit_job('task', {'run': apply_autoban_policies}, f'Auto-ban policy {name}')
+    return job_response(job, dict(values, name=name))
+
+# ==================== RULE METRICS ====================
+#
+# A sampler thread lists the ruleset every METRICS_INTERVAL seconds and
+# attributes rule counters to policies (by their live-mode chain) and to
+# custom rules (by comment). Rates come from the delta to the previous
+# sample. Requests are served from memory, so scrapers never spawn nft.
+
+POLICY_CHAIN = re.compile(r'^policy_(\d+)(?:_(nat|drop))?(?:_\d+)?$')
+
+_metrics = {'sampled_at': None}
+_metrics_lock = threading.Lock()
+_metrics_sampler = None
+
+def _rule_counter(rule):
+    """(packets, bytes) of a rule's anonymous counter, None without one"""
+    for expr in rule.get('expr', []):
+        counter = expr.get('counter') if isinstance(expr, dict) else None
+        if isinstance(counter, dict):
+            return counter.get('packets', 0), counter.get('bytes', 0)
+    return None
+
+def collect_rule_counters(ruleset, custom_rules=None):
+    """Sum rule counters per (kind, id, field) - kind is 'policy' or 'custom_rule'
+    
+    With custom_rules (compiled mode) their verdict map element counters are
+    attributed back to the rules.
+    """
+    totals = {}
+    if custom_rules is not None:
+        for (rule_id, chain), counter in custom_rule_element_counters(ruleset, custom_rules).items():
+            totals[('custom_rule', rule_id, chain)] = counter
+    for item in ruleset:
+        rule = item.get('rule')
+        if not rule:
+            continue
+        counter = _rule_counter(rule)
+        if counter is None:
+            continue
+        
+        chain = POLICY_CHAIN.match(rule.get('chain', ''))
+        comment = CUSTOM_RULE_COMMENT.match(rule.get('comment', ''))
+        if chain:
+            key = ('policy', int(chain.group(1)), chain.group(2) or 'rule')
+        elif comment:
+            key = ('custom_rule', int(comment.group(1)), rule['chain'])
+        else:
+            continue
+        packets, nbytes = totals.get(key, (0, 0))
+        totals[key] = (packets + counter[0], nbytes + counter[1])
+    return totals
+
+def sample_metrics():
+    """Take one counter sample and compute rates against the previous one"""
+    ruleset = list_live_ruleset()
+    now = time.monotonic()
+    with _metrics_lock:
+        previous = _metrics.get('totals', {})
+        elapsed = now - _metrics['monotonic'] if _metrics['sampled_at'] else None
+    
+    totals = collect_rule_counters(ruleset or [], _enabled_custom_rules() if NFT_COMPILED_RULES else None)
+    series = []
+    for (kind, object_id, field), (packets, nbytes) in sorted(totals.items()):
+        entry = {'kind': kind, 'id': object_id, 'field': field, 'packets': packets, 'bytes': nbytes,
+                 'packets_per_second': None, 'bytes_per_second': None}
+        last = previous.get((kind, object_id, field))
+        # Counters start over when the ruleset is reloaded - no rate for that interval
+        if last and elapsed and packets >= last[0] and nbytes >= last[1]:
+            entry['packets_per_second'] = round((packets - last[0]) / elapsed, 3)
+            entry['bytes_per_second'] = round((nbytes - last[1]) / elapsed, 3)
+        series.append(entry)
+    
+    with _metrics_lock:
+        _metrics.update(
+            sampled_at=datetime.now(timezone.utc).isoformat(),
+            monotonic=now,
+            firewall_active=ruleset is not None and any(
+                'table' in item and item['table'].get('family') == 'inet' and item['table'].get('name') == 'filter'
+                for item in ruleset),
+            totals=totals,
+            series=series,
+        )
+    return series
+
+def start_metrics_sampler():
+    """Background thread sampling rule counters every METRICS_INTERVAL seconds"""
+    global _metrics_sampler
+    
+    def sampler():
+        while True:
+            try:
+                sample_metrics()
+            except Exception as e:
+                logger.warning(f"Metrics sampler error: {e}")
+            time.sleep(METRICS_INTERVAL)
+    
+    if _metrics_sampler is None or not _metrics_sampler.is_alive():
+        _metrics_sampler = threading.Thread(target=sampler, name='metrics-sampler', daemon=True)
+        _metrics_sampler.start()
+    return _metrics_sampler
+
+def metrics_snapshot():
+    with _metrics_lock:
+        return {key: value for key, value in _metrics.items() if key not in ('totals', 'monotonic')}
+
+def _prometheus_labels(entry):
+    label = 'policy_id' if entry['kind'] == 'policy' else 'rule_id'
+    name = 'kind' if entry['kind'] == 'policy' else 'chain'
+    return f'{label}="{entry["id"]}",{name}="{entry["field"]}"'
+
+def render_prometheus_metrics(snapshot):
+    """Prometheus text exposition format for a metrics snapshot"""
+    lines = [
+        '# HELP seer_firewall_active Whether the inet filter table is loaded.',
+        '# TYPE seer_firewall_active gauge',
+        f"seer_firewall_active {1 if snapshot.get('firewall_active') else 0}",
+    ]
+    for kind in ('policy', 'custom_rule'):
+        entries = [entry for entry in snapshot.get('series', []) if entry['kind'] == kind]
+        for unit in ('packets', 'bytes'):
+            name = f'seer_{kind}_{unit}_total'
+            lines.append(f"# HELP {name} {unit.capitalize()} matched by {'policy' if kind == 'policy' else 'custom'} rules.")
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{{{_prometheus_labels(entry)}}} {entry[unit]}' for entry in entries)
+            
+            name = f'seer_{kind}_{unit}_per_second'
+            lines.append(f'# HELP {name} {unit.capitalize()} per second over the last sample interval.')
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(f'{name}{{{_prometheus_labels(entry)}}} {entry[unit + "_per_second"]}'
+                         for entry in entries if entry[unit + '_per_second'] is not None)
+    return '\n'.join(lines) + '\n'
+
+def _metric_json(entry, id_name, field_name):
+    values = {key: value for key, value in entry.items() if key not in ('kind', 'id', 'field')}
+    return dict(values, **{id_name: entry['id'], field_name: entry['field']})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Rule hit counters and rates (JSON, or ?format=prometheus)"""
+    if _metrics['sampled_at'] is None:
+        # Sampler not running (or first interval) - take one sample now
+        sample_metrics()
+    snapshot = metrics_snapshot()
+    
+    if request.args.get('format') == 'prometheus':
+        return app.response_class(render_prometheus_metrics(snapshot), mimetype='text/plain; version=0.0.4')
+    
+    return jsonify({
+        'success': True,
+        'sampled_at': snapshot['sampled_at'],
+        'interval': METRICS_INTERVAL,
+        'firewall_active': snapshot['firewall_active'],
+        'policies': [_metric_json(entry, 'policy_id', 'kind') for entry in snapshot['series'] if entry['kind'] == 'policy'],
+        'custom_rules': [_metric_json(entry, 'rule_id', 'chain') for entry in snapshot['series'] if entry['kind'] == 'custom_rule'],
+    })
+
+# ==================== DROP LOG ====================
+#
+# The log_drop chain writes one '[NFT DROP] IN=.. SRC=.. DPT=..' line per
+# dropped packet to the kernel log. A reader thread follows the journal,
+# /dev/kmsg or a file and keeps fixed-size state only: a ring buffer of
+# recent drops and per-bucket counters (pruned to the heaviest hitters)
+# for the top-N over the last DROP_WINDOW seconds.
+
+DROP_LOG_PREFIX = '[NFT DROP] '
+
+_drop_events = deque(maxlen=DROP_LOG_BUFFER)
+_drop_buckets = deque(maxlen=DROP_WINDOW // DROP_BUCKET_SECONDS)
+_drop_stats = {'parsed': 0, 'stream_dropped': 0}
+_drop_subscribers = []
+_drops_lock = threading.Lock()
+_drop_reader = None
+
+def parse_drop_line(line):
+    """key=value fields of an [NFT DROP] kernel log line, None for other lines"""
+    start = line.find(DROP_LOG_PREFIX)
+    if start < 0:
+        return None
+    fields = {}
+    for token in line[start + len(DROP_LOG_PREFIX):].split():
+        key, sep, value = token.partition('=')
+        if sep:
+            fields[key] = value
+    return fields
+
+def _count_bounded(counts, key):
+    """Increment counts[key]; past 2x capacity keep only the heaviest keys"""
+    counts[key] = counts.get(key, 0) + 1
+    if len(counts) > 2 * DROP_TOP_CAPACITY:
+        heaviest = heapq.nlargest(DROP_TOP_CAPACITY, counts.items(), key=lambda item: item[1])
+        counts.clear()
+        counts.update(heaviest)
+
+def ingest_drop_line(line, now=None):
+    """Record one kernel log line, returns the drop event (None if not a drop)"""
+    fields = parse_drop_line(line)
+    if fields is None:
+        return None
+    
+    now = time.time() if now is None else now
+    proto = fields.get('PROTO')
+    event = {
+        'time': now,
+        'in': fields.get('IN') or None,
+        'out': fields.get('OUT') or None,
+        'src': fields.get('SRC'),
+        'dst': fields.get('DST'),
+        'proto': proto,
+        'spt': fields.get('SPT'),
+        'dpt': fields.get('DPT'),
+    }
+    start = int(now // DROP_BUCKET_SECONDS) * DROP_BUCKET_SECONDS
+    
+    with _drops_lock:
+        _drop_events.append(event)
+        _drop_stats['parsed'] += 1
+        if not _drop_buckets or _drop_buckets[-1]['start'] != start:
+            _drop_buckets.append({'start': start, 'total': 0, 'sources': {}, 'ports': {}, 'interfaces': {}})
+        bucket = _drop_buckets[-1]
+        bucket['total'] += 1
+        if event['src']:
+            _count_bounded(bucket['sources'], event['src'])
+        if event['dpt']:
+            _count_bounded(bucket['ports'], f"{proto.lower() if proto else '?'}/{event['dpt']}")
+        if event['in']:
+            _count_bounded(bucket['interfaces'], event['in'])
+        subscribers = list(_drop_subscribers)
+    
+    skipped = 0
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # Slow client - skip events rather than buffer without bound
+            skipped += 1
+    if skipped:
+        with _drops_lock:
+            _drop_stats['stream_dropped'] += skipped
+    return event
+
+def drop_summary(window=DROP_WINDOW, top=10, now=None):
+    """Totals and top sources, ports and interfaces over the last window seconds"""
+    now = time.time() if now is None else now
+    cutoff = now - window
+    totals = {'sources': {}, 'ports': {}, 'interfaces': {}}
+    count = 0
+    
+    with _drops_lock:
+        for bucket in _drop_buckets:
+            if bucket['start'] + DROP_BUCKET_SECONDS <= cutoff:
+                continue
+            count += bucket['total']
+            for name, merged in totals.items():
+                for key, value in bucket[name].items():
+                    merged[key] = merged.get(key, 0) + value
+        recent = list(islice(reversed(_drop_events), top))
+        stats = dict(_drop_stats)
+    
+    def ranked(counts):
+        return [{'value': key, 'count': value}
+                for key, value in heapq.nlargest(top, counts.items(), key=lambda item: item[1])]
+    
+    return dict(
+        stats,
+        window=window,
+        total=count,
+        rate=round(count / window, 3),
+        top_sources=ranked(totals['sources']),
+        top_ports=ranked(totals['ports']),
+        top_interfaces=ranked(totals['interfaces']),
+        recent=recent,
+    )
+
+def follow_drop_log(source, follow=True):
+    """Yield kernel log lines from 'journal', 'kmsg' or a file path
+    
+    A file is read from the start (fixtures, replays), then followed
+    unless follow=False.
+    """
+    if source == 'journal':
+        process = subprocess.Popen(
+            ['journalctl', '-k', '-f', '-n', '0', '-o', 'cat'],
+            stdout=subprocess.PIPE, text=True, errors='replace'
+        )
+        try:
+            yield from process.stdout
+        finally:
+            process.kill()
+        return
+    
+    path = '/dev/kmsg' if source == 'kmsg' else source
+    with open(path, 'r', errors='replace') as f:
+        if source == 'kmsg':
+            # Only new messages, not the whole ring buffer
+            f.seek(0, os.SEEK_END)
+        while True:
+            yield from f
+            if not follow:
+                return
+            time.sleep(0.5)
+
+def start_drop_log_reader(source=None):
+    """Background thread feeding the drop log aggregates, restarted if the source ends"""
+    global _drop_reader
+    source = source or DROP_LOG_SOURCE
+    
+    def reader():
+        while True:
+            try:
+                for line in follow_drop_log(source):
+                    ingest_drop_line(line)
+                logger.warning(f"Drop log source {source} ended, reopening")
+            except Exception as e:
+                logger.warning(f"Drop log reader error ({source}): {e}")
+            time.sleep(5)
+    
+    if _drop_reader is None or not _drop_reader.is_alive():
+        _drop_reader = threading.Thread(target=reader, name='drop-log-reader', daemon=True)
+        _drop_reader.start()
+    return _drop_reader
+
+@app.route('/api/drops/summary', methods=['GET'])
+def get_drop_summary():
+    """Dropped packets over a window (?window=seconds, ?top=N)"""
+    window = min(max(request.args.get('window', DROP_WINDOW, type=int), DROP_BUCKET_SECONDS), DROP_WINDOW)
+    top = min(max(request.args.get('top', 10, type=int), 1), 100)
+    return jsonify(dict(drop_summary(window, top), success=True))
+
+@app.route('/api/drops/stream', methods=['GET'])
+def stream_drops():
+    """Server-sent events, one 'drop' event per dropped packet"""
+    subscriber = queue.Queue(maxsize=DROP_STREAM_BACKLOG)
+    with _drops_lock:
+        if len(_drop_subscribers) >= DROP_STREAM_MAX_CLIENTS:
+            return jsonify({'error': 'Too many drop log streams'}), 503
+        _drop_subscribers.append(subscriber)
+    
+    def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=DROP_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: drop\ndata: {json.dumps(event)}\n\n'
+        finally:
+            with _drops_lock:
+                _drop_subscribers.remove(subscriber)
+    
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+if __name__ == '__main__':
+    setup_logging()
+    logger.info("SEER Firewall API starting")
     
     # Initialize database
     try:
-        conn = get_db()
         with open('database.sql', 'r') as f:
-            conn.executescript(f.read())
-        conn.close()
-        print("✓ Database initialized")
+            get_db().executescript(f.read())
+        logger.info("Database initialized")
     except FileNotFoundError:
-        print("⚠ database.sql not found - assuming database already initialized")
+        logger.warning("database.sql not found - assuming database already initialized")
+    except Exception as e:
+        logger.warning(f"Database initialization warning: {e}")
+    
+    try:
+        migrate_database()
     except Exception as e:
-        print(f"⚠ Database initialization warning: {e}")
+        logger.warning(f"Database migration warning: {e}")
     
-    # Restore custom rules on startup (critical for persistence!)
-    print("\nRestoring custom firewall rules...")
-    restore_custom_rules()
+    # Restore custom rules, policy gates and blacklist on startup (critical for persistence!)
+    logger.info("Reconciling live ruleset with database")
+    try:
+        report = reconcile_ruleset()
+        logger.info("Reconciled ruleset", extra={'report': report})
+    except Exception as e:
+        logger.warning(f"Reconcile failed ({e}), falling back to full custom rule restore")
+        restore_custom_rules()
+    
+    # Baseline snapshot, and a dead-man timer still waiting from before the restart
+    try:
+        record_snapshot('Startup')
+    except Exception as e:
+        logger.warning(f"Could not record ruleset snapshot: {e}")
+    start_rollback_timer()
+    
+    # Expired blacklist rows (the kernel expires the set elements itself)
+    start_blacklist_reaper()
+    
+    # Single writer for every ruleset change made through the API
+    start_apply_worker()
+    
+    # Rule hit counters for /api/metrics
+    start_metrics_sampler()
+    
+    # [NFT DROP] kernel log lines for /api/drops
+    start_drop_log_reader()
+    
+    # Kernel auto-bans into firewall_blacklist
+    start_autoban_sync()
+    
+    # Batched audit writes and daily rollups of old entries
+    start_audit_writer()
+    start_audit_retention()
+    
+    # Re-apply schedules when a time zone offset changes (DST)
+    start_schedule_watch()
+    
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
     
-    print("\n" + "=" * 50)
-    print("Starting Flask API on 0.0.0.0:5000")
-    print("=" * 50 + "\n")
+    logger.info(f"Starting {'waitress' if serve else 'Flask'} API on 0.0.0.0:5000")
     
-    # Run Flask app (debug=False to avoid _ctypes dependency issues)
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    if serve:
+        serve(app, host='0.0.0.0', port=5000, threads=WSGI_THREADS)
+    else:
+        logger.warning("waitress not installed - falling back to the Flask development server")
+        # Run Flask app (debug=False to avoid _ctypes dependency issues)
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
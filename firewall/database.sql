@@ -12,7 +12,7 @@ CREATE TABLE IF NOT EXISTS policy_rules (
     action TEXT NOT NULL,
     nat_enabled INTEGER DEFAULT 0, -- 0 = OFF, 1 = ON
     rule_enabled INTEGER DEFAULT 1, -- 0 = DISABLED, 1 = ENABLED
-    schedule TEXT DEFAULT 'Always',
+    schedule TEXT DEFAULT 'Always', -- 'Always' or '<days> HH:MM-HH:MM [time zone]', enforced by the kernel
     usage TEXT DEFAULT 'General',
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
@@ -36,7 +36,8 @@ INSERT OR IGNORE INTO policy_rules (id, policy, source, destination, type, proto
 (14, 'ICMP Rate Limit', 'WAN', 'Firewall', 'ICMP', 'ICMP', 'RATE-LIMIT', 0, 1, 'Always', 'Network'),
 (15, 'SSH Access', 'Tailnet/WAN', 'Firewall:22', 'SSH', 'TCP', 'RATE-LIMIT', 0, 1, 'Always', 'Management'),
 (16, 'LAN to WAN Forward', 'LAN', 'WAN', 'Forward', 'All', 'ACCEPT', 1, 1, 'Always', 'Routing'),
-(17, 'Firewall Outbound', 'Firewall', 'WAN', 'Output', 'HTTP/HTTPS/DNS/NTP', 'ACCEPT', 0, 1, 'Always', 'System');
+(17, 'Firewall Outbound', 'Firewall', 'WAN', 'Output', 'HTTP/HTTPS/DNS/NTP', 'ACCEPT', 0, 1, 'Always', 'System'),
+(18, 'Flow Offload', 'LAN/WAN', 'LAN/WAN', 'Fast Path', 'TCP/UDP', 'OFFLOAD', 0, 0, 'Always', 'Performance');
 
 -- Blacklist Table
 CREATE TABLE IF NOT EXISTS blacklist (
@@ -47,6 +48,15 @@ CREATE TABLE IF NOT EXISTS blacklist (
     expires_at DATETIME
 );
 
+-- Firewall Blacklist Table (IPs and CIDR prefixes, used by the API)
+CREATE TABLE IF NOT EXISTS firewall_blacklist (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ip_address TEXT UNIQUE NOT NULL,
+    reason TEXT,
+    added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME
+);
+
 -- Audit Log Table
 CREATE TABLE IF NOT EXISTS audit_log (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,12 +67,31 @@ CREATE TABLE IF NOT EXISTS audit_log (
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Firewall Audit Log (written by the API)
+CREATE TABLE IF NOT EXISTS firewall_audit_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT NOT NULL,
+    rule_id INTEGER,
+    details TEXT,
+    user TEXT DEFAULT 'admin',
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Firewall Audit Daily Counts (audit rows past retention, rolled up per day)
+CREATE TABLE IF NOT EXISTS firewall_audit_daily (
+    day TEXT NOT NULL, -- YYYY-MM-DD (UTC)
+    action TEXT NOT NULL,
+    rule_id INTEGER NOT NULL DEFAULT 0, -- 0 = not rule specific
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, action, rule_id)
+);
+
 -- Custom Rules Table (user-defined firewall rules)
 CREATE TABLE IF NOT EXISTS custom_rules (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
     description TEXT,
-    port INTEGER NOT NULL,
+    port INTEGER NOT NULL, -- single port; ranges/lists ('10000-20000', '80,443') are stored as TEXT
     protocol TEXT NOT NULL, -- TCP, UDP, Both
     usage TEXT DEFAULT 'Custom',
     action TEXT DEFAULT 'ACCEPT', -- ACCEPT or DROP
@@ -70,14 +99,130 @@ CREATE TABLE IF NOT EXISTS custom_rules (
     access_lan INTEGER DEFAULT 0, -- 0 = No, 1 = Yes
     access_tailnet INTEGER DEFAULT 0, -- 0 = No, 1 = Yes
     access_wan INTEGER DEFAULT 0, -- 0 = No, 1 = Yes
+    source_group_id INTEGER, -- address_groups.id, NULL = no group source
+    schedule TEXT DEFAULT 'Always', -- 'Always' or '<days> HH:MM-HH:MM [time zone]'
     enabled INTEGER DEFAULT 1, -- 0 = DISABLED, 1 = ENABLED
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Address Groups (named IP/CIDR sets custom rules can use as their source)
+CREATE TABLE IF NOT EXISTS address_groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL,
+    description TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS address_group_members (
+    group_id INTEGER NOT NULL,
+    address TEXT NOT NULL, -- IP or CIDR, canonical form
+    PRIMARY KEY (group_id, address)
+);
+
+-- Policy Profiles (named sets of policy changes applied in one reload)
+CREATE TABLE IF NOT EXISTS policy_profiles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL,
+    description TEXT,
+    changes TEXT NOT NULL, -- JSON list of {rule_id, field, value}
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Ruleset Snapshots (applied states keyed by a hash of the template and rule tables)
+CREATE TABLE IF NOT EXISTS ruleset_snapshots (
+    hash TEXT PRIMARY KEY, -- sha256 of the template hash and the rows in 'state'
+    description TEXT,
+    state TEXT NOT NULL, -- JSON {table: [rows]} of the ruleset-defining tables, without timestamps
+    config TEXT NOT NULL, -- rendered nftables.conf
+    elements TEXT NOT NULL, -- nft script filling the verdict maps and address group sets
+    template_hash TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Dead-man timer: the snapshot re-applied unless the change is confirmed by the deadline
+CREATE TABLE IF NOT EXISTS snapshot_rollback (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    snapshot_hash TEXT NOT NULL,
+    deadline DATETIME NOT NULL -- UTC
+);
+
+-- Custom Rule Handles (nftables handles installed for each custom rule)
+CREATE TABLE IF NOT EXISTS custom_rule_handles (
+    rule_id INTEGER NOT NULL,
+    chain TEXT NOT NULL, -- input, forward, output
+    handle INTEGER NOT NULL,
+    PRIMARY KEY (chain, handle)
+);
+
+-- Auto-ban Policies (per-source rate meters that ban offenders in the kernel)
+CREATE TABLE IF NOT EXISTS autoban_policies (
+    name TEXT PRIMARY KEY, -- trigger: ssh, icmp, scan
+    threshold INTEGER NOT NULL, -- packets per window before a source is banned
+    window_seconds INTEGER NOT NULL,
+    ban_seconds INTEGER NOT NULL,
+    enabled INTEGER DEFAULT 0, -- 0 = DISABLED, 1 = ENABLED
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT OR IGNORE INTO autoban_policies (name, threshold, window_seconds, ban_seconds, enabled) VALUES
+('ssh', 10, 60, 3600, 0),
+('icmp', 100, 10, 600, 0),
+('scan', 30, 60, 3600, 0);
+
+-- Flowtable Config (fast path for established LAN <-> WAN flows, toggled by policy 18)
+CREATE TABLE IF NOT EXISTS flowtable_config (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    devices TEXT NOT NULL DEFAULT 'br0,eth1', -- comma-separated interface names
+    hw_offload INTEGER DEFAULT 0, -- 1 = 'flags offload' (NIC hardware offload)
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT OR IGNORE INTO flowtable_config (id, devices, hw_offload) VALUES (1, 'br0,eth1', 0);
+
+-- State Generations (bumped by the triggers below on every write, so API
+-- processes sharing this database know when their read caches are stale)
+CREATE TABLE IF NOT EXISTS state_generation (
+    name TEXT PRIMARY KEY, -- table name
+    generation INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO state_generation (name) VALUES
+('policy_rules'),
+('custom_rules'),
+('firewall_blacklist');
+
+CREATE TRIGGER IF NOT EXISTS policy_rules_insert_generation AFTER INSERT ON policy_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'policy_rules'; END;
+CREATE TRIGGER IF NOT EXISTS policy_rules_update_generation AFTER UPDATE ON policy_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'policy_rules'; END;
+CREATE TRIGGER IF NOT EXISTS policy_rules_delete_generation AFTER DELETE ON policy_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'policy_rules'; END;
+
+CREATE TRIGGER IF NOT EXISTS custom_rules_insert_generation AFTER INSERT ON custom_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'custom_rules'; END;
+CREATE TRIGGER IF NOT EXISTS custom_rules_update_generation AFTER UPDATE ON custom_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'custom_rules'; END;
+CREATE TRIGGER IF NOT EXISTS custom_rules_delete_generation AFTER DELETE ON custom_rules
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'custom_rules'; END;
+
+CREATE TRIGGER IF NOT EXISTS firewall_blacklist_insert_generation AFTER INSERT ON firewall_blacklist
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'firewall_blacklist'; END;
+CREATE TRIGGER IF NOT EXISTS firewall_blacklist_update_generation AFTER UPDATE ON firewall_blacklist
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'firewall_blacklist'; END;
+CREATE TRIGGER IF NOT EXISTS firewall_blacklist_delete_generation AFTER DELETE ON firewall_blacklist
+BEGIN UPDATE state_generation SET generation = generation + 1 WHERE name = 'firewall_blacklist'; END;
+
 -- Indexes for performance
 CREATE INDEX IF NOT EXISTS idx_policy_rules_enabled ON policy_rules(rule_enabled);
 CREATE INDEX IF NOT EXISTS idx_blacklist_ip ON blacklist(ip_address);
 CREATE INDEX IF NOT EXISTS idx_audit_timestamp ON audit_log(timestamp);
+CREATE INDEX IF NOT EXISTS idx_firewall_audit_log_timestamp ON firewall_audit_log(timestamp);
+CREATE INDEX IF NOT EXISTS idx_firewall_audit_log_rule ON firewall_audit_log(rule_id, id);
+CREATE INDEX IF NOT EXISTS idx_firewall_audit_log_action ON firewall_audit_log(action, id);
 CREATE INDEX IF NOT EXISTS idx_custom_rules_enabled ON custom_rules(enabled);
 CREATE INDEX IF NOT EXISTS idx_custom_rules_port ON custom_rules(port);
+CREATE INDEX IF NOT EXISTS idx_custom_rule_handles_rule ON custom_rule_handles(rule_id);
@@ -81,8 +81,8 @@ main() {
     # Step 4: Install Python packages
     print_header "Step 4: Installing Python Packages"
     source venv/bin/activate
-    pip install flask flask-cors
-    print_success "Installed flask and flask-cors"
+    pip install flask flask-cors waitress
+    print_success "Installed flask, flask-cors and waitress"
     deactivate
     echo ""
     
@@ -207,6 +207,12 @@ update_files() {
         print_success "Updated api.py"
     fi
     
+    # Update nftables template (the API renders /etc/nftables.conf from it)
+    if [[ -f "$SCRIPT_DIR/firewall/nftables.conf" ]]; then
+        sudo cp "$SCRIPT_DIR/firewall/nftables.conf" "/etc/nftables.conf.template"
+        print_success "Updated nftables.conf.template"
+    fi
+    
     # Update database schema (if needed)
     if [[ -f "$SCRIPT_DIR/firewall/database.sql" ]]; then
         sudo cp "$SCRIPT_DIR/firewall/database.sql" "$INSTALL_DIR/"
@@ -222,7 +228,7 @@ update_python_packages() {
     if [[ -d "venv" ]]; then
         print_info "Updating pip and packages..."
         source venv/bin/activate
-        pip install --upgrade pip flask flask-cors
+        pip install --upgrade pip flask flask-cors waitress
         print_success "Python packages updated"
         deactivate
     else
@@ -244,8 +250,7 @@ update_nftables_config() {
             print_success "Backed up current nftables.conf"
             
             sudo cp "$SCRIPT_DIR/firewall/nftables.conf" "/etc/nftables.conf"
-            sudo cp "$SCRIPT_DIR/firewall/nftables.conf" "/etc/nftables.conf.template"
-            print_success "Updated nftables.conf and template"
+            print_success "Updated nftables.conf"
             
             print_info "Reloading firewall..."
             sudo systemctl restart nftables